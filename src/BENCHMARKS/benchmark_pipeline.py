@@ -0,0 +1,241 @@
+"""
+    This code is a Python script that benchmarks every stage of STEP 1 to STEP 4 on a synthetic corpus.
+
+    The script:
+        generates a synthetic corpus of BENCHMARK_DOCUMENTS documents of BENCHMARK_WORDS_PER_DOCUMENT words each,
+        as PDF or text files (BENCHMARK_CORPUS_FORMAT), always the same for the same settings,
+        runs the functions of the steps on it, one stage at a time, with the deterministic stand-in embeddings model and LLM
+        (PATH_TO_GGML_MODEL="stand-in:<BENCHMARK_EMBEDDING_DIMENSION>"), so it runs on a CPU-only machine without a model file or network,
+        records the wall time, the throughput and the peak resident memory of every stage in BENCHMARK_RESULTS_FILE, and
+        compares them with BENCHMARK_BASELINE_FILE, reporting every stage that got slower or bigger by more than BENCHMARK_REGRESSION_TOLERANCE.
+
+    The first run, when there is no baseline yet, saves its results as the baseline.
+    The script exits with status 1 when a regression is found, so it can gate a CI job.
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+
+from typing import Dict
+
+from dotenv import load_dotenv
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.benchmark_corpus import generate_corpus
+from HELPERS.benchmark_stages import compare_with_baseline, measure_stage
+from HELPERS.step_1_save_chunked_docs import save_documents
+from HELPERS.step_2_embeddings_store import EMBEDDINGS_FILE_EXTENSION
+from HELPERS.step_2_save_embeddings import save_embeddings
+from HELPERS.step_3_loading_embeddings import load_embeddings
+from HELPERS.step_3_save_vectorstore import save_vectorstore
+from STEPS.STEP_1_loading_documents import load_documents
+from STEPS.STEP_2_create_embeddings import iter_embeddings
+from STEPS.STEP_3_create_vector_store import create_vectorstore_from_json
+from STEPS.STEP_4_use_the_vector_store import (
+    Q_and_A_implementation,
+    using_vectorstore_similarity_search,
+)
+
+
+def run_benchmarks(
+    benchmark_directory: str,
+    document_count: int,
+    words_per_document: int,
+    corpus_format: str = "pdf",
+    query_count: int = 20,
+    embedding_dimension: int = 384,
+    chunk_format: str = "json",
+    docstore: str = "disk",
+) -> Dict[str, object]:
+    """
+    Runs every stage of the pipeline on a synthetic corpus and measures it.
+
+    Args:
+        - benchmark_directory (str): Path to the directory where the corpus and the outputs of every step are written.
+        - document_count (int): Number of documents of the corpus.
+        - words_per_document (int): Number of words of every document.
+        - corpus_format (str): "pdf" or "txt".
+        - query_count (int): Number of queries of the STEP 4 stages.
+        - embedding_dimension (int): Dimension of the stand-in embeddings.
+        - chunk_format (str): Format the chunks are saved in, "json" or "store".
+        - docstore (str): Format the docstore of the vectorstore is saved in, "memory" or "disk".
+
+    Returns:
+        - Dict[str, object]: The settings of the run, the machine it ran on, and the measurements of every stage.
+    """
+
+    run_directory = os.path.join(benchmark_directory, "run")
+    if os.path.exists(run_directory):
+        shutil.rmtree(run_directory)
+
+    docs_directory = os.path.join(run_directory, "documents")
+    chunks_directory = os.path.join(run_directory, "chunked_data")
+    embeddings_directory = os.path.join(run_directory, "embeddings_data")
+    vectorstore_directory = os.path.join(run_directory, "vectorstore_data")
+    model_path = f"stand-in:{embedding_dimension}"
+
+    # The steps read the saved embeddings from these variables
+    os.environ["SAVING_EMBEDDINGS_DIRECTORY"] = embeddings_directory
+    os.environ["SAVING_EMBEDDINGS_FILE_NAME"] = "benchmark"
+
+    generate_corpus(
+        docs_directory,
+        document_count=document_count,
+        words_per_document=words_per_document,
+        file_format=corpus_format,
+    )
+
+    stages = {}
+
+    documents, stages["load_documents"] = measure_stage(
+        "load_documents",
+        lambda: load_documents(docs_directory),
+        lambda documents: sum(len(document["chunks"]) for document in documents),
+    )
+    chunk_count = stages["load_documents"]["items"]
+
+    _, stages["save_documents"] = measure_stage(
+        "save_documents",
+        lambda: save_documents(documents, chunks_directory, chunk_format=chunk_format),
+        chunk_count,
+    )
+
+    # iter_embeddings is what create_embeddings runs, keeping the references needed to save the embeddings
+    embeddings, stages["create_embeddings"] = measure_stage(
+        "create_embeddings",
+        lambda: list(iter_embeddings(chunks_directory, model_path)),
+        chunk_count,
+    )
+
+    _, stages["save_embeddings"] = measure_stage(
+        "save_embeddings",
+        lambda: save_embeddings(embeddings, "benchmark", embeddings_directory),
+        chunk_count,
+    )
+
+    _, stages["load_embeddings"] = measure_stage(
+        "load_embeddings",
+        lambda: load_embeddings(
+            os.path.join(embeddings_directory, "benchmark" + EMBEDDINGS_FILE_EXTENSION)
+        ),
+        chunk_count,
+    )
+
+    vectorstore, stages["create_vectorstore_from_json"] = measure_stage(
+        "create_vectorstore_from_json",
+        lambda: create_vectorstore_from_json(chunks_directory, model_path),
+        chunk_count,
+    )
+
+    _, stages["save_vectorstore"] = measure_stage(
+        "save_vectorstore",
+        lambda: save_vectorstore(
+            vectorstore, vectorstore_directory, "benchmark", docstore=docstore
+        ),
+        chunk_count,
+    )
+
+    vectorstore_path = os.path.join(vectorstore_directory, "benchmark.faiss")
+    queries = [f"what does document {i} say about faiss" for i in range(query_count)]
+
+    answer_docs, stages["using_vectorstore_similarity_search"] = measure_stage(
+        "using_vectorstore_similarity_search",
+        lambda: [
+            using_vectorstore_similarity_search(model_path, vectorstore_path, query)
+            for query in queries
+        ],
+        query_count,
+    )
+
+    _, stages["Q_and_A_implementation"] = measure_stage(
+        "Q_and_A_implementation",
+        lambda: [
+            Q_and_A_implementation(model_path, docs, query)
+            for docs, query in zip(answer_docs, queries)
+        ],
+        query_count,
+    )
+
+    return {
+        "settings": {
+            "document_count": document_count,
+            "words_per_document": words_per_document,
+            "corpus_format": corpus_format,
+            "query_count": query_count,
+            "embedding_dimension": embedding_dimension,
+            "chunk_format": chunk_format,
+            "docstore": docstore,
+            "chunk_count": chunk_count,
+        },
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": stages,
+    }
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n####################### BENCHMARKING THE PIPELINE ########################\n")
+
+    benchmark_directory = os.getenv("BENCHMARK_DIRECTORY", "./data/benchmark")
+    results_file = os.getenv(
+        "BENCHMARK_RESULTS_FILE", os.path.join(benchmark_directory, "results.json")
+    )
+    baseline_file = os.getenv(
+        "BENCHMARK_BASELINE_FILE", os.path.join(benchmark_directory, "baseline.json")
+    )
+
+    results = run_benchmarks(
+        benchmark_directory=benchmark_directory,
+        document_count=int(os.getenv("BENCHMARK_DOCUMENTS", "50")),
+        words_per_document=int(os.getenv("BENCHMARK_WORDS_PER_DOCUMENT", "2000")),
+        corpus_format=os.getenv("BENCHMARK_CORPUS_FORMAT", "pdf"),
+        query_count=int(os.getenv("BENCHMARK_QUERIES", "20")),
+        embedding_dimension=int(os.getenv("BENCHMARK_EMBEDDING_DIMENSION", "384")),
+        chunk_format=os.getenv("CHUNK_STORE_FORMAT", "json"),
+        docstore=os.getenv("VECTORSTORE_DOCSTORE", "disk"),
+    )
+
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=4)
+
+    print("\n####################### BENCHMARK RESULTS SAVED ########################\n")
+    print(results_file)
+
+    if not os.path.exists(baseline_file):
+        shutil.copyfile(results_file, baseline_file)
+        print("\nNo baseline found, these results are the new baseline: " + baseline_file)
+        sys.exit(0)
+
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+
+    if baseline["settings"] != results["settings"]:
+        print("\nThe baseline was run with other settings, not comparing: " + baseline_file)
+        sys.exit(0)
+
+    regressions = compare_with_baseline(
+        results["stages"],
+        baseline["stages"],
+        tolerance=float(os.getenv("BENCHMARK_REGRESSION_TOLERANCE", "0.2")),
+    )
+
+    print("\n####################### COMPARED WITH THE BASELINE ########################\n")
+
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    if not regressions:
+        print("No regression")
+
+    sys.exit(1 if regressions else 0)
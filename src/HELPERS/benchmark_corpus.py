@@ -0,0 +1,149 @@
+"""
+    This code defines the functions used by the benchmarks to generate a synthetic corpus of documents.
+
+    The documents are made of words drawn from a fixed vocabulary with a seeded random generator,
+    so the same settings always generate the same corpus, on any machine and without network access.
+
+    The functions:
+        synthetic_words generates the words of one document,
+        write_pdf writes lines of text as a minimal PDF file (readable by PyPDFLoader) without any PDF library, and
+        generate_corpus writes a directory of text or PDF documents.
+"""
+
+import os
+import random
+
+from typing import List
+
+
+VOCABULARY = (
+    "llama vector index chunk embedding document query answer model token "
+    "search memory cache batch latency throughput faiss langchain prompt context "
+    "alpha beta gamma delta epsilon zeta theta lambda sigma omega "
+    "river mountain forest ocean desert valley island harbor bridge tower "
+    "report policy budget market energy health science history music sport"
+).split()
+
+PDF_LINES_PER_PAGE = 60
+PDF_WORDS_PER_LINE = 12
+
+
+def synthetic_words(rng: random.Random, word_count: int) -> List[str]:
+    """
+    Generates the words of a synthetic document.
+
+    Args:
+        - rng (random.Random): The seeded random generator.
+        - word_count (int): Number of words of the document.
+
+    Returns:
+        - List[str]: The words of the document.
+    """
+
+    return [rng.choice(VOCABULARY) for _ in range(word_count)]
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(file_path: str, lines: List[str]) -> None:
+    """
+    Writes lines of text as a PDF file, PDF_LINES_PER_PAGE lines per page.
+
+    Args:
+        - file_path (str): Path of the PDF file.
+        - lines (List[str]): The lines of text.
+
+    Returns:
+        - None
+    """
+
+    pages = [
+        lines[start : start + PDF_LINES_PER_PAGE]
+        for start in range(0, len(lines), PDF_LINES_PER_PAGE)
+    ] or [[]]
+
+    # Objects 1 and 2 are the catalog and the page tree, object 3 the font, then a page and its content per page
+    page_object_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (" ".join(f"{i} 0 R" for i in page_object_ids), len(pages)),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_object_id, page_lines in zip(page_object_ids, pages):
+        content = "BT /F1 10 Tf 20 810 Td 13 TL %s ET" % " ".join(
+            f"({_pdf_escape(line)}) '" for line in page_lines
+        )
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Contents {page_object_id + 1} 0 R /Resources << /Font << /F1 3 0 R >> >> >>"
+        )
+        objects.append(
+            "<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for i, pdf_object in enumerate(objects):
+        offsets.append(len(output))
+        output += f"{i + 1} 0 obj\n{pdf_object}\nendobj\n".encode("latin-1")
+
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode("latin-1")
+    output += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode("latin-1")
+
+    with open(file_path, "wb") as f:
+        f.write(output)
+
+
+def generate_corpus(
+    directory_path: str,
+    document_count: int,
+    words_per_document: int,
+    file_format: str = "pdf",
+    seed: int = 0,
+) -> List[str]:
+    """
+    Writes a directory of synthetic documents.
+
+    Args:
+        - directory_path (str): Path to the directory of the documents. It is created if it doesn't exist.
+        - document_count (int): Number of documents.
+        - words_per_document (int): Number of words of every document.
+        - file_format (str): "pdf" or "txt".
+        - seed (int): Seed of the random generator.
+
+    Returns:
+        - List[str]: The paths of the documents.
+    """
+
+    if file_format not in ("pdf", "txt"):
+        raise ValueError(f"Unknown corpus format {file_format}, expected pdf or txt")
+
+    os.makedirs(directory_path, exist_ok=True)
+    rng = random.Random(seed)
+
+    file_paths = []
+    for i in range(document_count):
+        words = synthetic_words(rng, words_per_document)
+        lines = [
+            " ".join(words[start : start + PDF_WORDS_PER_LINE])
+            for start in range(0, len(words), PDF_WORDS_PER_LINE)
+        ]
+
+        file_path = os.path.join(directory_path, f"document_{i:05d}.{file_format}")
+        if file_format == "pdf":
+            write_pdf(file_path, lines)
+        else:
+            with open(file_path, "w") as f:
+                f.write("\n".join(lines))
+        file_paths.append(file_path)
+
+    return file_paths
@@ -0,0 +1,100 @@
+"""
+    This code defines the functions used by the benchmarks to measure the stages of the pipeline
+    and to compare the measurements with a baseline.
+
+    The measure_stage function runs a stage once and records:
+        its wall time in seconds,
+        the number of items it processed (chunks, queries, ...) and its throughput in items per second, and
+        the peak resident memory of the process during the stage, sampled by a background thread,
+        and how much it grew over the resident memory at the start of the stage.
+
+    The compare_with_baseline function reports the stages that got slower, or used more memory,
+    than in the baseline by more than a tolerance.
+"""
+
+import time
+
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from HELPERS.instrumentation import PeakMemorySampler
+
+
+def measure_stage(
+    name: str,
+    stage: Callable[[], Any],
+    item_count: Union[int, Callable[[Any], int]],
+) -> Tuple[Any, Dict[str, Union[str, float, int]]]:
+    """
+    Runs a stage of the pipeline once and measures it.
+
+    Args:
+        - name (str): Name of the stage.
+        - stage (Callable[[], Any]): The stage, called without arguments.
+        - item_count (Union[int, Callable[[Any], int]]): Number of items processed by the stage,
+          or a function computing it from the result of the stage.
+
+    Returns:
+        - Tuple[Any, Dict[str, Union[str, float, int]]]: The result of the stage, and its measurements.
+    """
+
+    with PeakMemorySampler() as memory:
+        start_time = time.perf_counter()
+        result = stage()
+        seconds = time.perf_counter() - start_time
+
+    items = item_count(result) if callable(item_count) else item_count
+    measurements = {
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds if seconds > 0 else 0.0,
+        "peak_rss_bytes": memory.peak_bytes,
+        "rss_growth_bytes": memory.peak_bytes - memory.start_bytes,
+    }
+
+    print(
+        f"{name:<40} {seconds:>9.3f}s {measurements['items_per_second']:>12.1f} items/s "
+        f"{memory.peak_bytes / 2**20:>9.1f} MiB peak"
+    )
+
+    return result, measurements
+
+
+def compare_with_baseline(
+    stages: Dict[str, Dict[str, float]],
+    baseline_stages: Dict[str, Dict[str, float]],
+    tolerance: float = 0.2,
+) -> List[str]:
+    """
+    Compares the measurements of the stages with the measurements of a baseline run.
+
+    Args:
+        - stages (Dict[str, Dict[str, float]]): The measurements of every stage, by stage name.
+        - baseline_stages (Dict[str, Dict[str, float]]): The measurements of the baseline run, by stage name.
+        - tolerance (float): Relative slowdown (or memory growth) allowed before a stage is reported, e.g. 0.2 for 20%.
+
+    Returns:
+        - List[str]: A description of every regression. Empty if there is none.
+    """
+
+    regressions = []
+
+    for name, measurements in stages.items():
+        baseline = baseline_stages.get(name)
+        if baseline is None:
+            continue
+
+        if baseline["items_per_second"] > 0 and measurements["items_per_second"] < (
+            baseline["items_per_second"] / (1 + tolerance)
+        ):
+            regressions.append(
+                f"{name}: {measurements['items_per_second']:.1f} items/s "
+                f"vs {baseline['items_per_second']:.1f} items/s in the baseline"
+            )
+
+        if measurements["peak_rss_bytes"] > baseline["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {measurements['peak_rss_bytes'] / 2**20:.1f} MiB peak "
+                f"vs {baseline['peak_rss_bytes'] / 2**20:.1f} MiB in the baseline"
+            )
+
+    return regressions
@@ -0,0 +1,424 @@
+"""
+    This code defines the instrumentation layer of the steps: spans that time a stage of the pipeline
+    and record what it processed, written as JSON lines or as Prometheus text.
+
+    A span records:
+        the wall time of the stage in seconds (for an iterator, only the time spent producing its items),
+        item counts (files, chunks, vectors, queries, prompt tokens, ...) and the throughput of each of them,
+        the resident memory of the process at the end of the stage and its peak during the stage.
+
+    The instrumentation is configured with environment variables and is off unless INSTRUMENTATION_OUTPUT is set:
+        INSTRUMENTATION_OUTPUT is the file the spans are written to ("-" for stderr),
+        INSTRUMENTATION_FORMAT is "jsonl" (one JSON object per span, appended) or "prometheus"
+        (a Prometheus text exposition file, e.g. for the node_exporter textfile collector, updated after every span),
+        PROFILE_STAGE is the name of a stage to profile, with the profiler PROFILE_MODE ("cprofile" or "sampling"),
+        and the profile is saved in PROFILE_OUTPUT_DIRECTORY.
+
+    The cProfile profile is saved as a ".prof" file (readable with pstats or snakeviz).
+    The sampling profiler samples the stack of the stage every few milliseconds, which costs much less than cProfile,
+    and saves the samples as collapsed stacks (readable with flamegraph.pl or speedscope).
+
+    The functions:
+        span is a context manager timing a block of code,
+        instrumented is a decorator timing every call of a function, and
+        instrument_iterator times the items produced by an iterator as they are consumed.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+import inspect
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from HELPERS.model_registry import resident_memory_bytes
+
+
+PROMETHEUS_METRIC_PREFIX = "llama_pipeline_stage_"
+SAMPLING_INTERVAL_SECONDS = 0.005
+
+_output_lock = threading.Lock()
+
+
+class PeakMemorySampler:
+    """
+    Samples the resident memory of the process in a background thread and keeps the peak.
+
+    Args:
+        - interval_seconds (float): Time between two samples.
+    """
+
+    def __init__(self, interval_seconds: float = 0.005) -> None:
+        self.interval_seconds = interval_seconds
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            self.peak_bytes = max(self.peak_bytes, resident_memory_bytes())
+
+    def __enter__(self) -> "PeakMemorySampler":
+        self.start_bytes = self.peak_bytes = resident_memory_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, resident_memory_bytes())
+
+
+class _SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval and counts the collapsed stacks.
+    """
+
+    def __init__(self) -> None:
+        self.thread_id = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.active = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(SAMPLING_INTERVAL_SECONDS):
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def enable(self) -> None:
+        # The thread producing the items of an iterator may change between two items
+        self.thread_id = threading.get_ident()
+        if not self._thread.is_alive():
+            self._thread.start()
+        self.active = True
+
+    def disable(self) -> None:
+        self.active = False
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def dump(self, file_path: str) -> None:
+        with open(file_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Span:
+    """
+    The measurements of one run of a stage.
+
+    Args:
+        - name (str): Name of the stage.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.counts: Dict[str, int] = {}
+        self.start_time: Optional[float] = None
+
+    def stop(self) -> None:
+        """
+        Stops the clock of the span, so the work done afterwards (e.g. counting the items) is not timed.
+
+        Returns:
+            - None
+        """
+
+        if self.start_time is not None:
+            self.seconds += time.perf_counter() - self.start_time
+            self.start_time = None
+
+    def count(self, **counts: int) -> None:
+        """
+        Adds to the item counts of the span, e.g. span.count(chunks=32, vectors=32).
+
+        Returns:
+            - None
+        """
+
+        for item, value in counts.items():
+            self.counts[item] = self.counts.get(item, 0) + int(value)
+
+    def record(self, peak_rss_bytes: int) -> Dict[str, Any]:
+        """
+        Builds the JSON record of the span.
+
+        Args:
+            - peak_rss_bytes (int): The peak resident memory of the process during the span.
+
+        Returns:
+            - Dict[str, Any]: The record.
+        """
+
+        return {
+            "timestamp": time.time(),
+            "pid": os.getpid(),
+            "stage": self.name,
+            "seconds": self.seconds,
+            "counts": self.counts,
+            "throughput": {
+                f"{item}_per_second": value / self.seconds if self.seconds > 0 else 0.0
+                for item, value in self.counts.items()
+            },
+            "rss_bytes": resident_memory_bytes(),
+            "peak_rss_bytes": peak_rss_bytes,
+        }
+
+
+def instrumentation_enabled() -> bool:
+    """
+    Checks whether the spans are written anywhere.
+
+    Returns:
+        - bool: True if INSTRUMENTATION_OUTPUT or PROFILE_STAGE is set.
+    """
+
+    return bool(os.getenv("INSTRUMENTATION_OUTPUT") or os.getenv("PROFILE_STAGE"))
+
+
+def _write_jsonl(output: str, record: Dict[str, Any]) -> None:
+    line = json.dumps(record) + "\n"
+    if output == "-":
+        sys.stderr.write(line)
+        return
+    with open(output, "a") as f:
+        f.write(line)
+
+
+def _prometheus_labels(labels: Dict[str, str]) -> str:
+    return ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels.items()
+    )
+
+
+def _write_prometheus(output: str, record: Dict[str, Any]) -> None:
+    stage = {"stage": record["stage"]}
+    counters = {
+        ("runs_total", _prometheus_labels(stage)): 1,
+        ("seconds_total", _prometheus_labels(stage)): record["seconds"],
+    }
+    gauges = {
+        ("last_seconds", _prometheus_labels(stage)): record["seconds"],
+        ("last_peak_rss_bytes", _prometheus_labels(stage)): record["peak_rss_bytes"],
+    }
+    for item, value in record["counts"].items():
+        labels = _prometheus_labels({"stage": record["stage"], "item": item})
+        counters[("items_total", labels)] = value
+        gauges[("last_items_per_second", labels)] = record["throughput"][
+            f"{item}_per_second"
+        ]
+
+    # Keep the metrics of the previous runs (and of the other steps) found in the file
+    samples: Dict[tuple, float] = {}
+    if output != "-" and os.path.exists(output):
+        with open(output, "r") as f:
+            for line in f:
+                if not line.startswith(PROMETHEUS_METRIC_PREFIX):
+                    continue
+                key, _, value = line.rstrip("\n").rpartition(" ")
+                name, _, labels = key[len(PROMETHEUS_METRIC_PREFIX) :].partition("{")
+                samples[(name, labels.rstrip("}"))] = float(value)
+
+    for key, value in counters.items():
+        samples[key] = samples.get(key, 0) + value
+    samples.update(gauges)
+
+    lines = []
+    for metric in sorted({name for name, _ in samples}):
+        metric_type = "counter" if metric.endswith("_total") else "gauge"
+        lines.append(f"# TYPE {PROMETHEUS_METRIC_PREFIX}{metric} {metric_type}")
+        for (name, labels), value in sorted(samples.items()):
+            if name == metric:
+                lines.append(f"{PROMETHEUS_METRIC_PREFIX}{name}{{{labels}}} {value:.15g}")
+    text = "\n".join(lines) + "\n"
+
+    if output == "-":
+        sys.stderr.write(text)
+        return
+    # Replace the file at once, so a scraper never reads half of it
+    temporary_output = output + ".tmp"
+    with open(temporary_output, "w") as f:
+        f.write(text)
+    os.replace(temporary_output, output)
+
+
+def _emit(span: Span, peak_rss_bytes: int) -> None:
+    output = os.getenv("INSTRUMENTATION_OUTPUT")
+    if not output:
+        return
+
+    record = span.record(peak_rss_bytes)
+    with _output_lock:
+        if os.getenv("INSTRUMENTATION_FORMAT", "jsonl") == "prometheus":
+            _write_prometheus(output, record)
+        else:
+            _write_jsonl(output, record)
+
+
+def _make_profiler(name: str) -> Optional[Any]:
+    if os.getenv("PROFILE_STAGE") != name:
+        return None
+    if os.getenv("PROFILE_MODE", "cprofile") == "sampling":
+        return _SamplingProfiler()
+    return cProfile.Profile()
+
+
+def _save_profile(name: str, profiler: Any) -> None:
+    directory = os.getenv("PROFILE_OUTPUT_DIRECTORY", "./data/profiles")
+    os.makedirs(directory, exist_ok=True)
+    file_name = f"{name}-{os.getpid()}-{int(time.time())}"
+
+    if isinstance(profiler, _SamplingProfiler):
+        profiler.close()
+        file_path = os.path.join(directory, file_name + ".collapsed")
+        profiler.dump(file_path)
+    else:
+        file_path = os.path.join(directory, file_name + ".prof")
+        profiler.dump_stats(file_path)
+
+    print(f"\nPROFILE OF {name} SAVED TO {file_path}\n", file=sys.stderr)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span]:
+    """
+    Times a block of code as a stage of the pipeline.
+
+    Args:
+        - name (str): Name of the stage.
+
+    Yields:
+        - Span: The span, whose count method records the items processed by the block.
+    """
+
+    current_span = Span(name)
+    if not instrumentation_enabled():
+        yield current_span
+        return
+
+    profiler = _make_profiler(name)
+    with PeakMemorySampler() as memory:
+        current_span.start_time = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield current_span
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            current_span.stop()
+
+    _emit(current_span, memory.peak_bytes)
+    if profiler is not None:
+        _save_profile(name, profiler)
+
+
+def instrumented(
+    name: str, counts: Optional[Callable[[Any, Dict[str, Any]], Dict[str, int]]] = None
+) -> Callable:
+    """
+    Decorates a function so every call is timed as a stage of the pipeline.
+
+    Args:
+        - name (str): Name of the stage.
+        - counts (Optional[Callable[[Any, Dict[str, Any]], Dict[str, int]]]): Computes the item counts
+          of a call from its result and its arguments (by parameter name).
+
+    Returns:
+        - Callable: The decorator.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not instrumentation_enabled():
+                return function(*args, **kwargs)
+
+            with span(name) as current_span:
+                result = function(*args, **kwargs)
+                current_span.stop()
+                if counts is not None:
+                    arguments = signature.bind(*args, **kwargs)
+                    arguments.apply_defaults()
+                    current_span.count(**counts(result, arguments.arguments))
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_iterator(
+    name: str,
+    iterable: Iterable[Any],
+    counts: Optional[Callable[[Any], Dict[str, int]]] = None,
+) -> Iterator[Any]:
+    """
+    Times the items produced by an iterator as a stage of the pipeline, once the iterator is exhausted.
+
+    Only the time spent producing the items is counted, not the time the consumer spends on them.
+
+    Args:
+        - name (str): Name of the stage.
+        - iterable (Iterable[Any]): The iterator to time.
+        - counts (Optional[Callable[[Any], Dict[str, int]]]): Computes the item counts of each produced item.
+
+    Yields:
+        - Any: The items of the iterator.
+    """
+
+    if not instrumentation_enabled():
+        yield from iterable
+        return
+
+    current_span = Span(name)
+    profiler = _make_profiler(name)
+    iterator = iter(iterable)
+
+    with PeakMemorySampler() as memory:
+        while True:
+            start_time = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                current_span.seconds += time.perf_counter() - start_time
+
+            if counts is not None:
+                current_span.count(**counts(item))
+            yield item
+
+    _emit(current_span, memory.peak_bytes)
+    if profiler is not None:
+        _save_profile(name, profiler)
@@ -0,0 +1,338 @@
+"""
+    This code defines a registry that loads each GGML model at most once per process
+    and shares it between the embeddings model and the LLM.
+
+    LlamaCppEmbeddings and LlamaCpp each load their own copy of the GGML file.
+    The registry instead loads a single llama_cpp.Llama per model path (with embeddings enabled, which still allows generation)
+    and hands the same instance to both a LlamaCppEmbeddings and a LlamaCpp, so the model is held in memory once.
+    llama.cpp is not thread-safe, so every call to the shared instance goes through a lock.
+    Every generation first restores the prompt prefix it shares with earlier prompts from the PromptPrefixCache of the model
+    (see HELPERS/step_4_prompt_cache.py), sized by QA_PREFIX_CACHE_MAX_BYTES and QA_PREFIX_CACHE_DOCUMENTS.
+
+    The functions:
+        get_embeddings_model and get_llm_model load the model on their first call and return the shared instance afterwards,
+        model_registry_stats reports the load time and the resident memory taken by every loaded model,
+        prompt_cache_stats reports the use of the prompt prefix cache of every loaded model,
+        last_prompt_cache_request reports what the cache saved on the last generation of the calling thread,
+        count_tokens counts the tokens of a text with the tokenizer of a model
+        (loading only the vocabulary of the model if the model itself is not loaded), and
+        resident_memory_bytes reports the resident memory of the process.
+
+    The LazyEmbeddings and LazyLLM classes only ask the registry for the model the first time they embed or generate,
+    so a step that never embeds a query (like STEP 3, whose vectors are all precomputed) never loads the model.
+
+    Model paths starting with "stand-in:" load the deterministic stand-in models instead.
+"""
+
+import os
+import re
+import time
+import threading
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langchain.llms.base import LLM
+from langchain.embeddings.base import Embeddings
+
+from HELPERS.stand_in_models import (
+    HashEmbeddings,
+    StandInLLM,
+    is_stand_in_model_path,
+    stand_in_dimension,
+)
+from HELPERS.step_4_prompt_cache import PromptPrefixCache
+
+
+_registry_lock = threading.Lock()
+_embeddings_models: Dict[str, Embeddings] = {}
+_llm_models: Dict[str, LLM] = {}
+_model_stats: Dict[str, Dict[str, object]] = {}
+_tokenizers: Dict[str, Any] = {}
+
+
+def resident_memory_bytes() -> int:
+    """
+    Reports the resident memory of the current process.
+
+    Returns:
+        - int: The resident set size in bytes (the peak resident set size where /proc is not available).
+    """
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _LockedLlama:
+    """
+    Wraps a llama_cpp.Llama shared by several models so only one call runs on it at a time,
+    and restores the cached prefix of every prompt before generating.
+
+    Args:
+        - llama (llama_cpp.Llama): The shared model.
+        - prompt_cache (Optional[PromptPrefixCache]): The snapshots of the prompt prefixes. If None, every prompt is evaluated whole.
+    """
+
+    def __init__(self, llama: Any, prompt_cache: Optional[PromptPrefixCache] = None) -> None:
+        self.llama = llama
+        self.prompt_cache = prompt_cache
+        self.lock = threading.RLock()
+
+    def _prepare(self, args: tuple, kwargs: Dict[str, Any]) -> None:
+        prompt = kwargs.get("prompt", args[0] if args else None)
+        if self.prompt_cache is not None and isinstance(prompt, str):
+            self.prompt_cache.prepare(self.llama, prompt)
+
+    def embed(self, text: str) -> List[float]:
+        with self.lock:
+            return self.llama.embed(text)
+
+    def _stream(self, *args: Any, **kwargs: Any) -> Iterator[Dict]:
+        # The lock is held for the whole generation, not only for the first token
+        with self.lock:
+            self._prepare(args, kwargs)
+            yield from self.llama(*args, **kwargs)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        if kwargs.get("stream"):
+            return self._stream(*args, **kwargs)
+        with self.lock:
+            self._prepare(args, kwargs)
+            return self.llama(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.llama, name)
+
+
+def _load(model_path: str, n_threads: Optional[int]) -> None:
+    rss_before = resident_memory_bytes()
+    start_time = time.perf_counter()
+
+    if is_stand_in_model_path(model_path):
+        embeddings = HashEmbeddings(dimension=stand_in_dimension(model_path))
+        llm = StandInLLM()
+    else:
+        from langchain import LlamaCpp
+        from langchain.embeddings import LlamaCppEmbeddings
+
+        embeddings = LlamaCppEmbeddings(model_path=model_path, n_threads=n_threads)
+        embeddings.client = _LockedLlama(
+            embeddings.client,
+            prompt_cache=PromptPrefixCache(
+                max_bytes=int(os.getenv("QA_PREFIX_CACHE_MAX_BYTES", "1073741824")),
+                max_documents=int(os.getenv("QA_PREFIX_CACHE_DOCUMENTS", "1")),
+            ),
+        )
+        # construct skips the validator that would load the model a second time
+        llm = LlamaCpp.construct(
+            model_path=model_path, n_threads=n_threads, client=embeddings.client
+        )
+
+    _embeddings_models[model_path] = embeddings
+    _llm_models[model_path] = llm
+    _model_stats[model_path] = {
+        "model_path": model_path,
+        "load_seconds": time.perf_counter() - start_time,
+        "resident_memory_bytes": resident_memory_bytes() - rss_before,
+    }
+
+    print(
+        f"\nLOADED MODEL {model_path} IN {_model_stats[model_path]['load_seconds']:.2f}s "
+        f"(+{_model_stats[model_path]['resident_memory_bytes'] / 2**20:.1f} MiB RESIDENT)\n"
+    )
+
+
+def get_embeddings_model(
+    model_path: str, n_threads: Optional[int] = None
+) -> Embeddings:
+    """
+    Returns the shared embeddings model of a model path, loading it on the first call.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp, if this call loads the model. If None, llama.cpp decides.
+
+    Returns:
+        - Embeddings: The embeddings model, sharing its weights with get_llm_model(model_path).
+    """
+
+    with _registry_lock:
+        if model_path not in _embeddings_models:
+            _load(model_path, n_threads)
+        return _embeddings_models[model_path]
+
+
+def get_llm_model(model_path: str, n_threads: Optional[int] = None) -> LLM:
+    """
+    Returns the shared LLM of a model path, loading it on the first call.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp, if this call loads the model. If None, llama.cpp decides.
+
+    Returns:
+        - LLM: The LLM, sharing its weights with get_embeddings_model(model_path).
+    """
+
+    with _registry_lock:
+        if model_path not in _llm_models:
+            _load(model_path, n_threads)
+        return _llm_models[model_path]
+
+
+def model_registry_stats() -> List[Dict[str, object]]:
+    """
+    Reports the models loaded by this process.
+
+    Returns:
+        - List[Dict[str, object]]: For every loaded model, its path, its load time in seconds,
+          and the resident memory (in bytes) the process gained while loading it.
+    """
+
+    with _registry_lock:
+        return [dict(stats) for stats in _model_stats.values()]
+
+
+def _prompt_caches() -> List[Tuple[str, PromptPrefixCache]]:
+    with _registry_lock:
+        items = list(_llm_models.items())
+    # Stand-in models have no client, and so no cache
+    return [
+        (model_path, llm.client.prompt_cache)
+        for model_path, llm in items
+        if isinstance(getattr(llm, "client", None), _LockedLlama) and llm.client.prompt_cache is not None
+    ]
+
+
+def prompt_cache_stats() -> List[Dict[str, object]]:
+    """
+    Reports the use of the prompt prefix cache of the models loaded by this process.
+
+    Returns:
+        - List[Dict[str, object]]: For every loaded model with a prompt prefix cache, its path and the stats of its cache
+          (hit rate, prompt tokens saved, snapshots and their bytes, see PromptPrefixCache.stats).
+    """
+
+    return [
+        {"model_path": model_path, **prompt_cache.stats()}
+        for model_path, prompt_cache in _prompt_caches()
+    ]
+
+
+def last_prompt_cache_request() -> Optional[Dict[str, object]]:
+    """
+    Reports what the prompt prefix cache saved on the last generation of the calling thread.
+
+    Returns:
+        - Optional[Dict[str, object]]: Whether a snapshot was restored, the tokens of the prompt and the tokens it saved
+          from being evaluated (see PromptPrefixCache.prepare). None if no model with a cache generated in this thread.
+    """
+
+    for _, prompt_cache in _prompt_caches():
+        stats = prompt_cache.last_request_stats()
+        if stats is not None:
+            return stats
+    return None
+
+
+def _get_tokenizer(model_path: str) -> Any:
+    with _registry_lock:
+        if model_path in _llm_models:
+            return _llm_models[model_path].client
+        if model_path not in _tokenizers:
+            from llama_cpp import Llama
+
+            # The vocabulary is enough to tokenize, and takes a fraction of the memory of the weights
+            _tokenizers[model_path] = Llama(model_path=model_path, vocab_only=True)
+        return _tokenizers[model_path]
+
+
+def count_tokens(model_path: str, text: str) -> int:
+    """
+    Counts the tokens of a text with the tokenizer of a model.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - text (str): The text.
+
+    Returns:
+        - int: The number of tokens. Stand-in models count words and punctuation marks.
+    """
+
+    if is_stand_in_model_path(model_path):
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+    return len(_get_tokenizer(model_path).tokenize(text.encode("utf-8")))
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Embeddings model that only loads the shared model of the registry the first time it embeds a text.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp. If None, llama.cpp decides.
+    """
+
+    def __init__(self, model_path: str, n_threads: Optional[int] = None) -> None:
+        self.model_path = model_path
+        self.n_threads = n_threads
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds a list of texts.
+
+        Args:
+            - texts (List[str]): The texts to embed.
+
+        Returns:
+            - List[List[float]]: The embedding of each text.
+        """
+
+        return get_embeddings_model(self.model_path, self.n_threads).embed_documents(
+            texts
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query.
+
+        Args:
+            - text (str): The text to embed.
+
+        Returns:
+            - List[float]: The embedding of the text.
+        """
+
+        return get_embeddings_model(self.model_path, self.n_threads).embed_query(text)
+
+
+class LazyLLM(LLM):
+    """
+    LLM that only loads the shared model of the registry the first time it generates.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp. If None, llama.cpp decides.
+    """
+
+    model_path: str
+    n_threads: Optional[int] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "lazy"
+
+    def _call(
+        self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None
+    ) -> str:
+        return get_llm_model(self.model_path, self.n_threads)._call(
+            prompt, stop=stop, run_manager=run_manager
+        )
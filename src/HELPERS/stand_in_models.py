@@ -0,0 +1,150 @@
+"""
+    This code defines deterministic stand-in models that can replace the GGML model
+    when there is no model file available, for example when testing or benchmarking the pipeline.
+
+    A model path starting with "stand-in:" selects a stand-in model instead of a GGML file,
+    e.g. PATH_TO_GGML_MODEL="stand-in:64" selects 64-dimensional stand-in embeddings.
+
+    The HashEmbeddings class embeds a text by hashing each of its words into one of the dimensions of the vector
+    (the "hashing trick"), so texts sharing words get similar vectors and the same text always gets the same vector.
+
+    The StandInLLM class answers every prompt with a short deterministic text derived from a hash of the prompt,
+    and can stream it word by word like LlamaCpp.stream (optionally waiting token_delay_seconds before every word).
+"""
+
+import re
+import math
+import time
+import hashlib
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+
+STAND_IN_MODEL_PREFIX = "stand-in:"
+DEFAULT_STAND_IN_DIMENSION = 64
+
+
+def is_stand_in_model_path(model_path: str) -> bool:
+    """
+    Checks whether a model path selects a stand-in model instead of a GGML file.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+
+    Returns:
+        - bool: True if the path selects a stand-in model.
+    """
+
+    return model_path.startswith(STAND_IN_MODEL_PREFIX)
+
+
+def stand_in_dimension(model_path: str) -> int:
+    """
+    Reads the embedding dimension from a "stand-in:<dimension>" model path.
+
+    Args:
+        - model_path (str): A "stand-in:<dimension>" string. The dimension is optional.
+
+    Returns:
+        - int: The embedding dimension of the stand-in model.
+    """
+
+    dimension = model_path[len(STAND_IN_MODEL_PREFIX) :]
+    return int(dimension) if dimension else DEFAULT_STAND_IN_DIMENSION
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for LlamaCppEmbeddings based on feature hashing of words.
+
+    Args:
+        - dimension (int): The dimension of the embeddings.
+    """
+
+    def __init__(self, dimension: int = DEFAULT_STAND_IN_DIMENSION) -> None:
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds a list of texts.
+
+        Args:
+            - texts (List[str]): The texts to embed.
+
+        Returns:
+            - List[List[float]]: The embedding of each text.
+        """
+
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query.
+
+        Args:
+            - text (str): The text to embed.
+
+        Returns:
+            - List[float]: The embedding of the text.
+        """
+
+        return self._embed(text)
+
+
+class StandInLLM(LLM):
+    """
+    Deterministic stand-in for LlamaCpp that answers with a hash of the prompt.
+
+    Args:
+        - answer_words (int): Number of words in every answer.
+        - n_ctx (int): Size of the context window the prompts are packed for, like LlamaCpp.n_ctx.
+    """
+
+    answer_words: int = 16
+    n_ctx: int = 512
+    token_delay_seconds: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stand-in"
+
+    def _call(
+        self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None
+    ) -> str:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return " ".join(
+            digest[(i * 4) % 60 : (i * 4) % 60 + 4] for i in range(self.answer_words)
+        )
+
+    def stream(
+        self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None
+    ) -> Iterator[Dict]:
+        """
+        Yields the answer to a prompt one word at a time, in the format of LlamaCpp.stream.
+
+        Args:
+            - prompt (str): The prompt to answer.
+            - stop (Optional[List[str]]): Ignored, like every stop sequence of the stand-in model.
+
+        Yields:
+            - Dict: A completion chunk, whose ["choices"][0]["text"] is the next word.
+        """
+
+        words = self._call(prompt).split(" ")
+        for i, word in enumerate(words):
+            if self.token_delay_seconds:
+                time.sleep(self.token_delay_seconds)
+            yield {"choices": [{"text": word if i == 0 else " " + word, "logprobs": None}]}
@@ -0,0 +1,124 @@
+"""
+    This code defines the functions used to measure the startup time of the command line interface (cli.py)
+    and of each of its commands, so a change that makes a command slower to start shows up.
+
+    Every measurement runs in a new Python process, so nothing is already imported:
+        command_seconds times a whole command line (e.g. "cli.py --help", which should not import any step), and
+        import_time_breakdown runs a statement with "python -X importtime" and adds up the time spent importing
+        every top-level package (langchain, faiss, numpy, ...), so the packages that make a command slow to start can be named.
+
+    The startup_report function measures the CLI and the imports of the step script behind every command.
+
+    Only the standard library is imported here: measuring the startup time must not add to it.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from typing import Dict, List, Optional
+
+
+def command_seconds(arguments: List[str], cwd: Optional[str] = None) -> float:
+    """
+    Times a Python command line in a new process.
+
+    Args:
+        - arguments (List[str]): The arguments of the Python interpreter, e.g. ["cli.py", "--help"].
+        - cwd (Optional[str]): The directory the command runs in. If None, the current directory.
+
+    Returns:
+        - float: The wall time of the command in seconds, from starting the interpreter to its exit.
+    """
+
+    start_time = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + arguments,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start_time
+
+
+def import_time_breakdown(statement: str, cwd: Optional[str] = None, top: int = 10) -> Dict[str, object]:
+    """
+    Runs a Python statement in a new process with "-X importtime", and breaks its import time down by top-level package.
+
+    Args:
+        - statement (str): The Python statement, e.g. "import langchain".
+        - cwd (Optional[str]): The directory the statement runs in. If None, the current directory.
+        - top (int): Number of packages reported.
+
+    Returns:
+        - Dict[str, object]: The wall time of the process and the total import time in seconds, the number of modules imported,
+          and the top packages by import time, as {"package": ..., "seconds": ..., "modules": ...}, slowest first.
+    """
+
+    start_time = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    seconds = time.perf_counter() - start_time
+
+    # "import time: <self us> | <cumulative us> | <indented module name>", the header line excepted
+    packages: Dict[str, Dict[str, float]] = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+
+        package = fields[2].strip().split(".")[0]
+        # The self times of the modules of a package add up to the time its imports took
+        entry = packages.setdefault(package, {"package": package, "seconds": 0.0, "modules": 0})
+        entry["seconds"] += int(fields[0]) / 1e6
+        entry["modules"] += 1
+
+    ranked = sorted(packages.values(), key=lambda entry: entry["seconds"], reverse=True)
+
+    return {
+        "seconds": seconds,
+        "import_seconds": sum(entry["seconds"] for entry in ranked),
+        "modules": sum(entry["modules"] for entry in ranked),
+        "packages": ranked[:top],
+    }
+
+
+def startup_report(
+    src_directory: str, step_scripts: Dict[str, str], top: int = 10
+) -> Dict[str, Dict[str, object]]:
+    """
+    Measures the startup time of the command line interface, and the imports of the step script of every command.
+
+    Args:
+        - src_directory (str): Path to the src directory, where cli.py is.
+        - step_scripts (Dict[str, str]): The step script of every command, relative to src_directory.
+        - top (int): Number of packages reported for every command.
+
+    Returns:
+        - Dict[str, Dict[str, object]]: "cli --help" with its wall time in seconds, then the import time breakdown
+          (see import_time_breakdown) of every command, by command name.
+    """
+
+    report: Dict[str, Dict[str, object]] = {
+        "cli --help": {"seconds": command_seconds(["cli.py", "--help"], cwd=src_directory)}
+    }
+
+    for command, script in step_scripts.items():
+        # Loads the script without running its step: only its imports (and definitions) run
+        report[command] = import_time_breakdown(
+            f"import runpy; runpy.run_path({os.path.join(src_directory, script)!r}, run_name='startup')",
+            cwd=src_directory,
+            top=top,
+        )
+
+    return report
@@ -0,0 +1,396 @@
+"""
+    This code defines the chunk store: a single binary file holding every chunk of every document,
+    which replaces the "<document> Chunks.json" files of STEP 1 when CHUNK_STORE_FORMAT is "store".
+
+    The JSON files have to be parsed completely every time STEP 2 or STEP 3 reads a chunk.
+    The chunk store is opened with mmap instead: reading a chunk only decodes its own bytes,
+    any chunk can be read in O(1) from its row number (or from its document and chunk id),
+    and reading every chunk in order is a sequential scan of the file.
+
+    The file ("chunks.chunkstore", in the chunks directory) starts with a 128 bytes header:
+        the magic bytes "LLCHKV01", the format version and the number of documents (two little-endian uint32),
+        the number of chunks (a little-endian uint64), and
+        the position of each of the following sections in the file (little-endian uint64),
+    followed by the sections:
+        the UTF-8 text of every chunk, one after the other,
+        the offsets of every text in that blob (uint64, one more than the number of chunks),
+        the UTF-8 chunk ids ("chunk_1", ...), one after the other, and their offsets (uint64),
+        the document of every chunk, as an index in the list of documents (uint32), and
+        the list of document names, as a JSON array.
+    The chunks of a document are always stored next to each other, in their original order.
+
+    The ChunkStoreWriter class writes the file one document at a time, the ChunkStore class reads it,
+    and convert_json_chunks imports a directory of "<document> Chunks.json" files into a chunk store.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+
+CHUNK_STORE_FILE_NAME = "chunks.chunkstore"
+
+MAGIC = b"LLCHKV01"
+VERSION = 1
+HEADER_SIZE = 128
+HEADER_FORMAT = "<8sIIQQQQQQQQ"
+
+
+def chunk_store_path(json_chunks_directory: str) -> str:
+    """
+    Builds the path of the chunk store of a chunks directory.
+
+    Args:
+        - json_chunks_directory (str): Path to the chunks directory.
+
+    Returns:
+        - str: Path to the chunk store.
+    """
+
+    return os.path.join(json_chunks_directory, CHUNK_STORE_FILE_NAME)
+
+
+class ChunkStoreWriter:
+    """
+    Writes a chunk store one document at a time.
+
+    The texts are written to the file as they arrive; only their offsets, chunk ids and documents are kept in memory.
+    The file is written under a temporary name and moved into place by close(), so readers never see half of it.
+
+    Args:
+        - file_path (str): Path to the chunk store to write.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.file_path = file_path
+        self._temporary_path = file_path + ".tmp"
+        self._file = open(self._temporary_path, "wb")
+        self._file.write(b"\0" * HEADER_SIZE)
+
+        self._text_offsets = [0]
+        self._keys = bytearray()
+        self._key_offsets = [0]
+        self._document_ids: List[int] = []
+        self._documents: List[str] = []
+
+    def add_document(
+        self, document: Dict[str, Union[str, List[Dict[str, str]]]]
+    ) -> None:
+        """
+        Appends the chunks of a document to the store.
+
+        Args:
+            - document (Dict[str, Union[str, List[Dict[str, str]]]]): The name and chunked data of the document, as produced by STEP 1.
+
+        Returns:
+            - None
+        """
+
+        document_id = len(self._documents)
+        self._documents.append(document["name"])
+
+        for chunk in document["chunks"]:
+            for key, text in chunk.items():
+                data = text.encode("utf-8")
+                self._file.write(data)
+                self._text_offsets.append(self._text_offsets[-1] + len(data))
+
+                self._keys += key.encode("utf-8")
+                self._key_offsets.append(len(self._keys))
+                self._document_ids.append(document_id)
+                break
+
+    def _write_section(self, data: bytes) -> int:
+        position = self._file.tell()
+        self._file.write(data)
+        return position
+
+    def close(self) -> None:
+        """
+        Writes the sections and the header, and moves the file into place.
+
+        Returns:
+            - None
+        """
+
+        text_offsets_position = self._write_section(
+            np.asarray(self._text_offsets, dtype="<u8").tobytes()
+        )
+        keys_position = self._write_section(bytes(self._keys))
+        key_offsets_position = self._write_section(
+            np.asarray(self._key_offsets, dtype="<u8").tobytes()
+        )
+        document_ids_position = self._write_section(
+            np.asarray(self._document_ids, dtype="<u4").tobytes()
+        )
+        documents_position = self._write_section(
+            json.dumps(self._documents).encode("utf-8")
+        )
+        end_position = self._file.tell()
+
+        self._file.seek(0)
+        self._file.write(
+            struct.pack(
+                HEADER_FORMAT,
+                MAGIC,
+                VERSION,
+                len(self._documents),
+                len(self._document_ids),
+                HEADER_SIZE,
+                text_offsets_position,
+                keys_position,
+                key_offsets_position,
+                document_ids_position,
+                documents_position,
+                end_position,
+            ).ljust(HEADER_SIZE, b"\0")
+        )
+        self._file.close()
+        os.replace(self._temporary_path, self.file_path)
+
+    def abort(self) -> None:
+        """
+        Discards the file being written, leaving any previous chunk store in place.
+
+        Returns:
+            - None
+        """
+
+        self._file.close()
+        os.remove(self._temporary_path)
+
+    def __enter__(self) -> "ChunkStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ChunkStore:
+    """
+    Reads a chunk store through mmap.
+
+    Args:
+        - file_path (str): Path to the chunk store.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+
+        with open(file_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            document_count,
+            chunk_count,
+            texts_position,
+            text_offsets_position,
+            keys_position,
+            key_offsets_position,
+            document_ids_position,
+            documents_position,
+            end_position,
+        ) = struct.unpack_from(HEADER_FORMAT, self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file_path} is not a supported chunk store")
+
+        self._texts_position = texts_position
+        self._keys_position = keys_position
+        self._text_offsets = np.frombuffer(
+            self._mmap, dtype="<u8", count=chunk_count + 1, offset=text_offsets_position
+        )
+        self._key_offsets = np.frombuffer(
+            self._mmap, dtype="<u8", count=chunk_count + 1, offset=key_offsets_position
+        )
+        self._document_ids = np.frombuffer(
+            self._mmap, dtype="<u4", count=chunk_count, offset=document_ids_position
+        )
+        self.documents: List[str] = json.loads(
+            self._mmap[documents_position:end_position].decode("utf-8")
+        )
+        if len(self.documents) != document_count:
+            raise ValueError(f"{file_path} has a corrupted list of documents")
+
+        self._rows: Dict[Tuple[str, str], int] = {}
+        self._document_rows: Dict[str, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._document_ids)
+
+    def text(self, row: int) -> str:
+        """
+        Reads the text of a chunk.
+
+        Args:
+            - row (int): The row of the chunk in the store.
+
+        Returns:
+            - str: The text of the chunk.
+        """
+
+        start = self._texts_position + int(self._text_offsets[row])
+        end = self._texts_position + int(self._text_offsets[row + 1])
+        return self._mmap[start:end].decode("utf-8")
+
+    def reference(self, row: int) -> Tuple[str, str]:
+        """
+        Reads the document and chunk id of a chunk.
+
+        Args:
+            - row (int): The row of the chunk in the store.
+
+        Returns:
+            - Tuple[str, str]: The document name and the chunk id.
+        """
+
+        start = self._keys_position + int(self._key_offsets[row])
+        end = self._keys_position + int(self._key_offsets[row + 1])
+        return (
+            self.documents[int(self._document_ids[row])],
+            self._mmap[start:end].decode("utf-8"),
+        )
+
+    def row_of(self, document: str, chunk: str) -> int:
+        """
+        Finds the row of a chunk from its document and chunk id.
+
+        Args:
+            - document (str): Name of the document.
+            - chunk (str): Id of the chunk in the document, e.g. "chunk_1".
+
+        Returns:
+            - int: The row of the chunk. Raises KeyError if the store has no such chunk.
+        """
+
+        if not self._rows:
+            # Built once, on the first lookup
+            self._rows = {self.reference(row): row for row in range(len(self))}
+
+        return self._rows[(document, chunk)]
+
+    def document_chunks(self, document: str) -> List[Tuple[str, str]]:
+        """
+        Reads the chunks of a single document.
+
+        Args:
+            - document (str): Name of the document.
+
+        Returns:
+            - List[Tuple[str, str]]: The chunk id and the text of each chunk of the document. Raises KeyError if the store has no such document.
+        """
+
+        if not self._document_rows:
+            # The chunks of a document are contiguous: find where every run of document ids starts and ends
+            boundaries = np.flatnonzero(np.diff(self._document_ids)) + 1
+            starts = np.concatenate(([0], boundaries)).tolist() if len(self) else []
+            ends = np.concatenate((boundaries, [len(self)])).tolist() if len(self) else []
+            for start, end in zip(starts, ends):
+                name = self.documents[int(self._document_ids[start])]
+                self._document_rows[name] = (start, end)
+            for name in self.documents:
+                self._document_rows.setdefault(name, (0, 0))
+
+        start, end = self._document_rows[document]
+        return [
+            (self.reference(row)[1], self.text(row)) for row in range(start, end)
+        ]
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str]]:
+        # Convert the offsets once, so the scan does not pay for numpy scalars
+        text_offsets = self._text_offsets.tolist()
+        key_offsets = self._key_offsets.tolist()
+        document_ids = self._document_ids.tolist()
+
+        texts_position, keys_position, data = (
+            self._texts_position,
+            self._keys_position,
+            self._mmap,
+        )
+        for row, document_id in enumerate(document_ids):
+            yield (
+                self.documents[document_id],
+                data[
+                    keys_position + key_offsets[row] : keys_position + key_offsets[row + 1]
+                ].decode("utf-8"),
+                data[
+                    texts_position + text_offsets[row] : texts_position + text_offsets[row + 1]
+                ].decode("utf-8"),
+            )
+
+    def close(self) -> None:
+        """
+        Closes the mmap of the store.
+
+        Returns:
+            - None
+        """
+
+        self._text_offsets = self._key_offsets = self._document_ids = None
+        self._mmap.close()
+
+
+def write_chunk_store(
+    documents: Iterable[Dict[str, Union[str, List[Dict[str, str]]]]], file_path: str
+) -> None:
+    """
+    Writes a chunk store from a stream of documents.
+
+    Args:
+        - documents (Iterable[Dict[str, Union[str, List[Dict[str, str]]]]]): The name and chunked data of each document.
+        - file_path (str): Path to the chunk store to write.
+
+    Returns:
+        - None
+    """
+
+    with ChunkStoreWriter(file_path) as writer:
+        for document in documents:
+            writer.add_document(document)
+
+
+def convert_json_chunks(json_chunks_directory: str) -> int:
+    """
+    Imports a directory of "<document> Chunks.json" files into a chunk store in the same directory.
+
+    Args:
+        - json_chunks_directory (str): Path to the directory of JSON chunks.
+
+    Returns:
+        - int: The number of chunks imported.
+    """
+
+    from HELPERS.step_2_loading_chunks import iter_json_chunks
+
+    def documents() -> Iterator[Dict[str, Union[str, List[Dict[str, str]]]]]:
+        document: Dict = {"name": None, "chunks": []}
+        for name, chunk, text in iter_json_chunks(json_chunks_directory):
+            if name != document["name"]:
+                if document["name"] is not None:
+                    yield document
+                document = {"name": name, "chunks": []}
+            document["chunks"].append({chunk: text})
+        if document["name"] is not None:
+            yield document
+
+    file_path = chunk_store_path(json_chunks_directory)
+    write_chunk_store(documents(), file_path)
+
+    store = ChunkStore(file_path)
+    chunk_count = len(store)
+    store.close()
+
+    return chunk_count
@@ -0,0 +1,272 @@
+"""
+    This code defines the ChunkDeduplicator class used by STEP 1 to remove duplicate chunks before they are embedded.
+
+    Headers, footers and other boilerplate repeated across the pages and the documents of a corpus end up
+    in many chunks with the same text. Every one of them costs an embedding call in STEP 2 and a vector in STEP 3.
+
+    The ChunkDeduplicator goes through the documents in order and keeps the first occurrence of every chunk:
+        in "exact" mode, a chunk is a duplicate when its text, ignoring case and whitespace, was already kept, and
+        in "near" mode, a chunk is also a duplicate when the estimated Jaccard similarity of its word shingles
+        with a kept chunk is at least near_threshold (MinHash signatures, with LSH bands to find the candidates).
+
+    Duplicates are removed from their document, but not forgotten: the references of every kept chunk list
+    the (document, chunk id) of all the duplicates it stands for, and save_chunk_references saves them
+    next to the JSON chunks (in DUPLICATE_CHUNKS_FILE_NAME) with the reduction ratio of the run.
+    STEP 3 reads them back with load_chunk_references, and lists them in the metadata of the kept chunks.
+"""
+
+import os
+import json
+import zlib
+import hashlib
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+DUPLICATE_CHUNKS_FILE_NAME = "duplicate_chunks.json"
+DEDUPLICATION_MODES = ("off", "exact", "near")
+
+# MinHash parameters: 64 hash functions, in 16 bands of 4 rows, over shingles of 3 words
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+SHINGLE_SIZE = 3
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_chunk_text(text: str) -> str:
+    """
+    Normalizes the text of a chunk before it is compared: lowercase, with single spaces.
+
+    Args:
+        - text (str): The text of the chunk.
+
+    Returns:
+        - str: The normalized text.
+    """
+
+    return " ".join(text.lower().split())
+
+
+class ChunkDeduplicator:
+    """
+    Removes exact and near-duplicate chunks from a stream of documents, keeping the first occurrence of every chunk.
+
+    Args:
+        - mode (str): "exact" or "near".
+        - near_threshold (float): Minimum estimated Jaccard similarity of two chunks for "near" duplicates.
+    """
+
+    def __init__(self, mode: str = "exact", near_threshold: float = 0.9) -> None:
+        if mode not in DEDUPLICATION_MODES or mode == "off":
+            raise ValueError(f"Unknown deduplication mode {mode}, expected exact or near")
+
+        self.mode = mode
+        self.near_threshold = near_threshold
+
+        self.total_chunks = 0
+        self.kept_chunks = 0
+        self.references: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+
+        self._exact: Dict[str, Tuple[str, str]] = {}
+        self._signatures: Dict[Tuple[str, str], np.ndarray] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[Tuple[str, str]]] = {}
+
+        rng = np.random.default_rng(0)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+    @property
+    def reduction_ratio(self) -> float:
+        """
+        The fraction of the chunks that were removed as duplicates.
+        """
+
+        return 1 - self.kept_chunks / self.total_chunks if self.total_chunks else 0.0
+
+    def _signature(self, normalized_text: str) -> Optional[np.ndarray]:
+        words = normalized_text.split()
+        if len(words) < SHINGLE_SIZE:
+            return None
+
+        shingles = {
+            " ".join(words[i : i + SHINGLE_SIZE])
+            for i in range(len(words) - SHINGLE_SIZE + 1)
+        }
+        hashes = np.array(
+            [zlib.crc32(shingle.encode("utf-8")) & _MERSENNE_PRIME for shingle in shingles],
+            dtype=np.uint64,
+        )
+
+        # (a * x + b) mod p for every hash function and every shingle, then the minimum over the shingles
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+    def _find_near_duplicate(
+        self, signature: np.ndarray
+    ) -> Optional[Tuple[str, str]]:
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        candidates = set()
+        for band in range(MINHASH_BANDS):
+            key = (band, signature[band * rows : (band + 1) * rows].tobytes())
+            candidates.update(self._buckets.get(key, ()))
+
+        # Keep the most similar candidate, if it is similar enough
+        best, best_similarity = None, self.near_threshold
+        for candidate in sorted(candidates):
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        return best
+
+    def _index_near(self, reference: Tuple[str, str], signature: np.ndarray) -> None:
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        self._signatures[reference] = signature
+        for band in range(MINHASH_BANDS):
+            key = (band, signature[band * rows : (band + 1) * rows].tobytes())
+            self._buckets.setdefault(key, []).append(reference)
+
+    def deduplicate(
+        self, document: Dict[str, Union[str, List[Dict[str, str]]]]
+    ) -> Dict[str, Union[str, List[Dict[str, str]]]]:
+        """
+        Removes the chunks of a document that duplicate a chunk already kept, from this or a previous document.
+
+        Args:
+            - document (Dict[str, Union[str, List[Dict[str, str]]]]): The name and chunked data of the document.
+
+        Returns:
+            - Dict[str, Union[str, List[Dict[str, str]]]]: The document with only its kept chunks, under their original chunk ids.
+        """
+
+        kept = []
+
+        for chunk in document["chunks"]:
+            for key, text in chunk.items():
+                reference = (document["name"], key)
+                normalized_text = normalize_chunk_text(text)
+                self.total_chunks += 1
+
+                digest = hashlib.sha1(normalized_text.encode("utf-8")).hexdigest()
+                original = self._exact.get(digest)
+
+                signature = None
+                if original is None and self.mode == "near":
+                    signature = self._signature(normalized_text)
+                    if signature is not None:
+                        original = self._find_near_duplicate(signature)
+
+                if original is not None:
+                    self.references[original].append(reference)
+                    break
+
+                self._exact[digest] = reference
+                if signature is not None:
+                    self._index_near(reference, signature)
+                self.references[reference] = []
+                self.kept_chunks += 1
+                kept.append({key: text})
+                break
+
+        return {"name": document["name"], "chunks": kept}
+
+    def iter_deduplicated(
+        self, documents: Iterable[Dict[str, Union[str, List[Dict[str, str]]]]]
+    ) -> Iterator[Dict[str, Union[str, List[Dict[str, str]]]]]:
+        """
+        Removes the duplicate chunks of a stream of documents, one document at a time.
+
+        Args:
+            - documents (Iterable[Dict[str, Union[str, List[Dict[str, str]]]]]): The documents, in order.
+
+        Yields:
+            - Dict[str, Union[str, List[Dict[str, str]]]]: Each document with only its kept chunks.
+        """
+
+        for document in documents:
+            yield self.deduplicate(document)
+
+    def report(self) -> str:
+        """
+        Describes how many chunks were removed.
+
+        Returns:
+            - str: The number of chunks kept, out of the total, and the reduction ratio.
+        """
+
+        return (
+            f"DEDUPLICATED CHUNKS ({self.mode}): kept {self.kept_chunks} of {self.total_chunks}, "
+            f"{self.reduction_ratio:.1%} fewer chunks to embed"
+        )
+
+
+def save_chunk_references(
+    deduplicator: Optional[ChunkDeduplicator], save_json_chunks_directory: str
+) -> None:
+    """
+    Saves the duplicates of every kept chunk, and the reduction ratio, next to the JSON chunks.
+
+    Args:
+        - deduplicator (Optional[ChunkDeduplicator]): The deduplicator that went through the documents.
+          If None, a references file left by a previous run is removed.
+        - save_json_chunks_directory (str): The path to the directory of the JSON chunks.
+
+    Returns:
+        - None
+    """
+
+    file_path = os.path.join(save_json_chunks_directory, DUPLICATE_CHUNKS_FILE_NAME)
+
+    if deduplicator is None:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return
+
+    duplicates: Dict[str, Dict[str, List[List[str]]]] = {}
+    for (document, chunk), chunk_duplicates in deduplicator.references.items():
+        if chunk_duplicates:
+            duplicates.setdefault(document, {})[chunk] = [
+                list(reference) for reference in chunk_duplicates
+            ]
+
+    os.makedirs(save_json_chunks_directory, exist_ok=True)
+    with open(file_path, "w") as f:
+        json.dump(
+            {
+                "mode": deduplicator.mode,
+                "total_chunks": deduplicator.total_chunks,
+                "kept_chunks": deduplicator.kept_chunks,
+                "reduction_ratio": deduplicator.reduction_ratio,
+                "duplicates": duplicates,
+            },
+            f,
+        )
+
+
+def load_chunk_references(
+    json_chunks_directory: str,
+) -> Dict[Tuple[str, str], List[Tuple[str, str]]]:
+    """
+    Loads the duplicates of every kept chunk saved by save_chunk_references.
+
+    Args:
+        - json_chunks_directory (str): The path to the directory of the JSON chunks.
+
+    Returns:
+        - Dict[Tuple[str, str], List[Tuple[str, str]]]: The (document, chunk id) of the duplicates of every kept chunk
+          that has duplicates. Empty if the chunks were not deduplicated.
+    """
+
+    file_path = os.path.join(json_chunks_directory, DUPLICATE_CHUNKS_FILE_NAME)
+    if not os.path.exists(file_path):
+        return {}
+
+    with open(file_path, "r") as f:
+        duplicates = json.load(f)["duplicates"]
+
+    return {
+        (document, chunk): [tuple(reference) for reference in chunk_duplicates]
+        for document, chunks in duplicates.items()
+        for chunk, chunk_duplicates in chunks.items()
+    }
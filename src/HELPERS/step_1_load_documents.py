@@ -0,0 +1,209 @@
+"""
+    This code defines the functions used by STEP 1 to load documents from a directory and split them into smaller chunks.
+
+    The load_and_chunk_document function loads a single document using the appropriate loader
+    (PyPDFLoader for PDF files, UnstructuredFileLoader otherwise), splits it into smaller chunks using a CharacterTextSplitter,
+    and returns a dictionary containing the document name and chunked data.
+
+    The iter_loaded_documents function goes through all the files in a directory in filename order
+    and yields the result of load_and_chunk_document for each of them, one document at a time,
+    so the caller decides how many documents are held in memory.
+
+    With workers > 0, the files are fanned out to a pool of worker processes (each building its text splitter once),
+    and the results are still yielded in filename order as soon as they are ready.
+    A file that fails to load is reported and skipped instead of aborting the whole batch.
+
+    The size of the chunks and their overlap are measured in characters by default,
+    or in tokens of the model's tokenizer when a tokenizer_model_path is given.
+"""
+
+import os
+import sys
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from langchain.document_loaders import UnstructuredFileLoader
+from langchain.document_loaders import PyPDFLoader
+
+from langchain.text_splitter import CharacterTextSplitter
+
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from HELPERS.model_registry import count_tokens
+
+
+def make_text_splitter(
+    chunk_size: int = 100,
+    chunk_overlap: int = 50,
+    tokenizer_model_path: Optional[str] = None,
+) -> CharacterTextSplitter:
+    """
+    Creates the text splitter used to split every document into smaller chunks.
+
+    Args:
+        - chunk_size (int): Maximum size of a chunk.
+        - chunk_overlap (int): Size of the text repeated between two consecutive chunks.
+        - tokenizer_model_path (Optional[str]): Path to the GGML model whose tokenizer measures the sizes.
+          If None, the sizes are measured in characters.
+
+    Returns:
+        - CharacterTextSplitter: The text splitter.
+    """
+
+    return CharacterTextSplitter(
+        separator=" ",
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=(
+            partial(count_tokens, tokenizer_model_path) if tokenizer_model_path else len
+        ),
+    )
+
+
+def load_and_chunk_document(
+    file_path: str, text_splitter: CharacterTextSplitter
+) -> Dict[str, Union[str, List[Dict[str, str]]]]:
+    """
+    Load a single document and split it into smaller chunks.
+
+    Args:
+        - file_path (str): Path to the document.
+        - text_splitter (CharacterTextSplitter): The text splitter used to split the document.
+
+    Returns:
+        - Dict[str, Union[str, List[Dict[str, str]]]]: A dictionary with the following keys:
+            - 'name': The name of the document file, without its extension.
+            - 'chunks': A list of dictionaries containing the chunked data of the document. Each dictionary has a key in the format 'chunk_i' (where i is the chunk number) and a value that is the text content of the chunk.
+    """
+
+    file_name = os.path.basename(file_path)
+
+    # Determine loader based on file type
+    if file_name.endswith(".pdf"):
+        loader = PyPDFLoader(file_path=file_path)
+    else:
+        loader = UnstructuredFileLoader(file_path=file_path)
+
+    # Load document
+    document = loader.load()
+
+    # Split document into smaller chunks
+    chunks = [
+        {"chunk_" + str(i + 1): chunk.page_content}
+        for i, chunk in enumerate(text_splitter.split_documents(documents=document))
+    ]
+
+    return {"name": os.path.splitext(file_name)[0], "chunks": chunks}
+
+
+def _report_skipped_file(file_path: str, error: str) -> None:
+    print(f"SKIPPING {file_path}: {error}", file=sys.stderr)
+
+
+# The text splitter of a worker process, created once by _init_loading_worker
+_worker_text_splitter: Optional[CharacterTextSplitter] = None
+
+
+def _init_loading_worker(
+    chunk_size: int, chunk_overlap: int, tokenizer_model_path: Optional[str]
+) -> None:
+    global _worker_text_splitter
+    _worker_text_splitter = make_text_splitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        tokenizer_model_path=tokenizer_model_path,
+    )
+
+
+def _load_and_chunk_in_worker(
+    file_path: str,
+) -> Tuple[Optional[Dict[str, Union[str, List[Dict[str, str]]]]], Optional[str]]:
+    try:
+        return load_and_chunk_document(file_path, _worker_text_splitter), None
+    except Exception as error:
+        return None, repr(error)
+
+
+def iter_loaded_documents(
+    docs_directory_path: str,
+    workers: int = 0,
+    chunk_size: int = 100,
+    chunk_overlap: int = 50,
+    tokenizer_model_path: Optional[str] = None,
+) -> Iterator[Dict[str, Union[str, List[Dict[str, str]]]]]:
+    """
+    Load documents from a directory one at a time and split them into smaller chunks.
+
+    A document that fails to load is reported on stderr and skipped instead of aborting the whole directory.
+
+    Args:
+        - docs_directory_path (str): Path to directory containing documents.
+        - workers (int): Number of worker processes loading and splitting the documents. If 0, the documents are loaded in this process.
+        - chunk_size (int): Maximum size of a chunk.
+        - chunk_overlap (int): Size of the text repeated between two consecutive chunks.
+        - tokenizer_model_path (Optional[str]): Path to the GGML model whose tokenizer measures the sizes. If None, in characters.
+
+    Yields:
+        - Dict[str, Union[str, List[Dict[str, str]]]]: The name and chunked data of each document, in filename order.
+    """
+
+    file_paths = [
+        os.path.join(docs_directory_path, file_name)
+        for file_name in sorted(os.listdir(docs_directory_path))
+    ]
+
+    if workers <= 0:
+        text_splitter = make_text_splitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            tokenizer_model_path=tokenizer_model_path,
+        )
+
+        # Iterate through all the files in the directory
+        for file_path in file_paths:
+            try:
+                document = load_and_chunk_document(
+                    file_path=file_path, text_splitter=text_splitter
+                )
+            except Exception as error:
+                _report_skipped_file(file_path, repr(error))
+                continue
+
+            yield document
+        return
+
+    # Workers are forked where possible so the step scripts are not re-imported in every worker
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in start_methods else None)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_loading_worker,
+        initargs=(chunk_size, chunk_overlap, tokenizer_model_path),
+    ) as executor:
+        # Keep a bounded window of files in flight, and hand the results back in filename order
+        remaining_paths = iter(file_paths)
+        in_flight: deque = deque(
+            (file_path, executor.submit(_load_and_chunk_in_worker, file_path))
+            for file_path in islice(remaining_paths, 2 * workers)
+        )
+
+        while in_flight:
+            file_path, future = in_flight.popleft()
+            document, error = future.result()
+
+            next_path = next(remaining_paths, None)
+            if next_path is not None:
+                in_flight.append(
+                    (next_path, executor.submit(_load_and_chunk_in_worker, next_path))
+                )
+
+            if error is not None:
+                _report_skipped_file(file_path, error)
+                continue
+
+            yield document
@@ -12,19 +12,35 @@
     and to save the documents to JSON files with dynamic names. 
     
     The resulting JSON files are saved in the directory specified by the save_json_chunks_directory argument.
+
+    When chunk_format is "store", the documents are saved to a single chunk store in that directory instead
+    (see HELPERS/step_1_chunk_store.py). Saving JSON files removes a chunk store left by a previous run,
+    since STEP 2 and STEP 3 read the chunk store first.
+
+    The remove_deleted_documents function removes the JSON files of the documents that are no longer in the
+    documents directory, so update mode removes their vectors from the vectorstore.
+    The JSON file of a document that is still there is kept even if it failed to load in this run.
 """
 
 import os
 import json
 
 
-from typing import List, Dict, Union
+from typing import Iterable, List, Dict, Optional, Union
+
+from HELPERS.step_1_chunk_store import chunk_store_path, write_chunk_store
+from HELPERS.step_2_loading_chunks import JSON_CHUNKS_SUFFIX, document_name_from_json_file
+
+
+CHUNK_FORMATS = ("json", "store")
 
 
 def save_documents(
-    documents: List[Dict[str, Union[str, List[Dict[str, str]]]]],
+    documents: Iterable[Dict[str, Union[str, List[Dict[str, str]]]]],
     save_json_chunks_directory: str,
-) -> None:
+    chunk_format: str = "json",
+    docs_directory_path: Optional[str] = None,
+) -> List[str]:
     """
     Saves a list of objects to JSON files. Each object in the list should have two properties:
         - the name of the document that was chunked,
@@ -35,24 +51,77 @@ def save_documents(
     The content of the JSON file should be the chunked data.
 
     Args:
-        - documents (List[Dict[str, Union[str, List[Dict[str, str]]]]]):
-            A list of objects, where each object has two properties:
+        - documents (Iterable[Dict[str, Union[str, List[Dict[str, str]]]]]):
+            A list (or any iterable, e.g. a generator) of objects, where each object has two properties:
                 - the name of the document that was chunked,
                 - and the chunked data itself.
+            Each object is written as soon as it is produced.
         - save_json_chunks_directory (str): The path to the directory where the JSON files will be saved.
+        - chunk_format (str): "json" for one JSON file per document, or "store" for a single chunk store.
+        - docs_directory_path (Optional[str]): Path to the directory the documents were loaded from.
+            If given, the JSON files of the documents deleted from it are removed once every document is saved.
 
     Returns:
-        - None
+        - List[str]: The names of the deleted documents whose JSON files were removed.
     """
 
     # Create directory for chunked data if it doesn't exist
     if not os.path.exists(save_json_chunks_directory):
         os.makedirs(save_json_chunks_directory)
 
+    if chunk_format not in CHUNK_FORMATS:
+        raise ValueError(f"Unknown chunk format {chunk_format}, expected json or store")
+
+    store_path = chunk_store_path(save_json_chunks_directory)
+    if chunk_format == "store":
+        write_chunk_store(documents, store_path)
+        return []
+
+    # A chunk store left by a previous run would be read instead of the new JSON files
+    if os.path.exists(store_path):
+        os.remove(store_path)
+
     # Save documents to JSON file with dynamic name
     for doc in documents:
         json_file_path = os.path.join(
-            save_json_chunks_directory, f"{doc['name']} Chunks.json"
+            save_json_chunks_directory, f"{doc['name']}{JSON_CHUNKS_SUFFIX}"
         )
         with open(json_file_path, "w") as f:
             json.dump(doc["chunks"], f)
+
+    if docs_directory_path is None:
+        return []
+
+    return remove_deleted_documents(save_json_chunks_directory, docs_directory_path)
+
+
+def remove_deleted_documents(save_json_chunks_directory: str, docs_directory_path: str) -> List[str]:
+    """
+    Removes the JSON files of the documents that are no longer in the documents directory.
+
+    A document is matched to its JSON file by its name, the file name without its extension,
+    so a document that is still in the directory keeps its JSON file even if it failed to load.
+
+    Args:
+        - save_json_chunks_directory (str): The path to the directory where the JSON files are saved.
+        - docs_directory_path (str): Path to the directory the documents are loaded from.
+
+    Returns:
+        - List[str]: The names of the documents whose JSON files were removed.
+    """
+
+    document_names = {
+        os.path.splitext(file_name)[0] for file_name in os.listdir(docs_directory_path)
+    }
+
+    removed = []
+    for file_name in sorted(os.listdir(save_json_chunks_directory)):
+        if not file_name.endswith(JSON_CHUNKS_SUFFIX):
+            continue
+
+        document_name = document_name_from_json_file(file_name)
+        if document_name not in document_names:
+            os.remove(os.path.join(save_json_chunks_directory, file_name))
+            removed.append(document_name)
+
+    return removed
@@ -0,0 +1,168 @@
+"""
+    This code defines the functions used to embed chunks batch by batch.
+
+    The iter_chunk_batches function groups a stream of chunks into batches of a fixed number of chunks.
+
+    The embed_chunk_batches function:
+        looks every chunk of a batch up in the EmbeddingsCache, if a cache directory is given,
+        embeds the chunks missing from the cache, either in this process or with a pool of worker processes,
+        stores the new embeddings in the cache, and
+        yields the embeddings of each batch in the original chunk order, together with the (document, chunk id) and text of its chunks.
+
+    The model is only loaded once a chunk actually needs embedding.
+"""
+
+import time
+from collections import deque
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from HELPERS.step_2_embeddings_cache import EmbeddingsCache
+from HELPERS.step_2_embeddings_pool import (
+    default_threads_per_worker,
+    embeddings_model_factory,
+    iter_embedded_batches_in_pool,
+    load_embeddings_model,
+)
+
+
+def iter_chunk_batches(
+    chunks: Iterable[Tuple[str, str, str]], batch_size: int
+) -> Iterator[Tuple[List[Tuple[str, str]], List[str]]]:
+    """
+    Groups the chunks of consecutive documents into batches of batch_size chunks.
+
+    Args:
+        - chunks (Iterable[Tuple[str, str, str]]): The document name, chunk id and text of each chunk.
+        - batch_size (int): Number of chunks in each batch.
+
+    Yields:
+        - Tuple[List[Tuple[str, str]], List[str]]: The (document, chunk id) and the text of every chunk of a batch.
+    """
+
+    references: list = []
+    texts: list = []
+
+    for document, chunk, text in chunks:
+        references.append((document, chunk))
+        texts.append(text)
+
+        if len(texts) == batch_size:
+            yield references, texts
+            references, texts = [], []
+
+    if texts:
+        yield references, texts
+
+
+def embed_chunk_batches(
+    batches: Iterable[Tuple[List[Tuple[str, str]], List[str]]],
+    path_to_ggml_model: str,
+    cache_directory: Optional[str] = None,
+    cache_max_entries: int = 1_000_000,
+    workers: int = 0,
+    threads_per_worker: Optional[int] = None,
+) -> Iterator[Tuple[List[Tuple[str, str]], List[str], List[List[float]]]]:
+    """
+    Creates embeddings for batches of chunks using the LlamaCppEmbeddings model, one batch at a time.
+
+    Batches are only pulled from the input when the model (or a worker of the pool) is ready for them.
+
+    Args:
+        - batches (Iterable[Tuple[List[Tuple[str, str]], List[str]]]): The (document, chunk id) and text of the chunks of each batch.
+        - path_to_ggml_model (str): Path to the LlamaCppEmbeddings model.
+        - cache_directory (Optional[str]): Path to the directory of the embeddings cache. If None, no cache is used.
+        - cache_max_entries (int): Maximum number of embeddings kept in the cache.
+        - workers (int): Number of worker processes embedding the chunks. If 0, the chunks are embedded in this process.
+        - threads_per_worker (Optional[int]): Number of llama.cpp threads in each worker. Defaults to an even split of the CPU cores.
+
+    Yields:
+        - Tuple[List[Tuple[str, str]], List[str], List[List[float]]]: The (document, chunk id) and text of every chunk of a batch, and their embeddings.
+    """
+
+    cache = None
+    if cache_directory:
+        cache = EmbeddingsCache(
+            cache_directory=cache_directory,
+            model_path=path_to_ggml_model,
+            max_entries=cache_max_entries,
+        )
+
+    # Batches whose missing chunks are being embedded, in order
+    pending: deque = deque()
+
+    def missing_batches() -> Iterator[List[str]]:
+        for references, texts in batches:
+            if cache is None:
+                cached_list = [None] * len(texts)
+            else:
+                cached_list = cache.get_many(texts)
+
+            pending.append((references, texts, cached_list))
+            yield [text for text, cached in zip(texts, cached_list) if cached is None]
+
+    if workers > 0:
+        embedded_batches = iter_embedded_batches_in_pool(
+            batches=missing_batches(),
+            embeddings_factory=embeddings_model_factory(
+                path_to_ggml_model,
+                threads_per_worker or default_threads_per_worker(workers),
+            ),
+            workers=workers,
+        )
+    else:
+        embedded_batches = _embed_batches_in_process(
+            missing_batches(), path_to_ggml_model
+        )
+
+    embedded_count = 0
+    start_time = time.perf_counter()
+
+    for missing_embeddings in embedded_batches:
+        references, texts, cached_list = pending.popleft()
+
+        if missing_embeddings:
+            missing_texts = [
+                text for text, cached in zip(texts, cached_list) if cached is None
+            ]
+            if cache is not None:
+                cache.put_many(missing_texts, missing_embeddings)
+            embedded_count += len(missing_embeddings)
+
+        # Put the new embeddings back in the original chunk order
+        missing_iterator = iter(missing_embeddings)
+        yield references, texts, [
+            cached if cached is not None else next(missing_iterator)
+            for cached in cached_list
+        ]
+
+    elapsed_time = time.perf_counter() - start_time
+    print(
+        f"EMBEDDED {embedded_count} CHUNKS IN {elapsed_time:.2f}s "
+        f"({embedded_count / max(elapsed_time, 1e-9):.1f} chunks/sec, "
+        f"{max(workers, 1)} worker(s))"
+    )
+
+    if cache is not None:
+        print(
+            f"EMBEDDINGS CACHE: {cache.hits} hits, {cache.misses} misses, "
+            f"{len(cache)} entries"
+        )
+        cache.close()
+
+
+def _embed_batches_in_process(
+    batches: Iterator[List[str]], path_to_ggml_model: str
+) -> Iterator[List[List[float]]]:
+    # The model is only loaded once a chunk actually needs embedding
+    embeddings = None
+
+    for texts in batches:
+        if not texts:
+            yield []
+            continue
+
+        if embeddings is None:
+            embeddings = load_embeddings_model(path_to_ggml_model)
+
+        yield embeddings.embed_documents(texts)
@@ -0,0 +1,180 @@
+"""
+    This code defines a class called EmbeddingsCache, a persistent on-disk cache of chunk embeddings.
+
+    Each entry is keyed by a hash of the chunk text together with the identity of the GGML model
+    (its path, size and modification time), so replacing or re-quantizing the model invalidates
+    every entry without any manual cleanup.
+
+    The cache is stored in a single sqlite3 file inside the cache directory.
+    The vectors are stored as packed float32 bytes.
+
+    The cache:
+        is consulted before the LlamaCppEmbeddings model is called,
+        evicts the least recently used entries once it holds more than max_entries vectors, and
+        counts hits and misses so a run can report how much work it skipped.
+"""
+
+import os
+import sqlite3
+import hashlib
+from array import array
+
+from typing import List, Optional
+
+
+CACHE_FILE_NAME = "embeddings_cache.sqlite3"
+
+
+def model_identity(model_path: str) -> str:
+    """
+    Builds a string identifying a GGML model file by its path, size and modification time.
+
+    Args:
+        - model_path (str): Path to the GGML model.
+
+    Returns:
+        - str: The identity of the model. Paths that do not exist on disk are identified by the path alone.
+    """
+
+    absolute_path = os.path.abspath(model_path)
+    if not os.path.exists(absolute_path):
+        return model_path
+
+    stat = os.stat(absolute_path)
+    return f"{absolute_path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class EmbeddingsCache:
+    """
+    Persistent, size-bounded cache of embeddings keyed by chunk text and model identity.
+
+    Args:
+        - cache_directory (str): Path to the directory where the cache file will be saved.
+        - model_path (str): Path to the GGML model the cached embeddings were created with.
+        - max_entries (int): Maximum number of embeddings kept before the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self, cache_directory: str, model_path: str, max_entries: int = 1_000_000
+    ) -> None:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.model_identity = model_identity(model_path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._connection = sqlite3.connect(
+            os.path.join(cache_directory, CACHE_FILE_NAME)
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._clock = self._connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(
+            (self.model_identity + "\0" + text).encode("utf-8")
+        ).hexdigest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Looks up the embeddings of several texts at once.
+
+        Args:
+            - texts (List[str]): The texts to look up.
+
+        Returns:
+            - List[Optional[List[float]]]: The cached embedding of each text, or None where it is not cached.
+        """
+
+        keys = [self._key(text) for text in texts]
+        found = {}
+
+        # sqlite limits the number of bound parameters, so query in slices
+        for start in range(0, len(keys), 500):
+            batch = keys[start : start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                batch,
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+
+        # Mark the hits as recently used
+        if found:
+            tick = self._tick()
+            self._connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(tick, key) for key in found],
+            )
+            self._connection.commit()
+
+        results = [found.get(key) for key in keys]
+        hits = sum(1 for result in results if result is not None)
+        self.hits += hits
+        self.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        """
+        Stores the embeddings of several texts and evicts the least recently used entries if the cache is full.
+
+        Args:
+            - texts (List[str]): The embedded texts.
+            - vectors (List[List[float]]): The embedding of each text.
+
+        Returns:
+            - None
+        """
+
+        tick = self._tick()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            [
+                (self._key(text), array("f", vector).tobytes(), tick)
+                for text, vector in zip(texts, vectors)
+            ],
+        )
+        self._evict()
+        self._connection.commit()
+
+    def _evict(self) -> None:
+        count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[
+            0
+        ]
+        if count <= self.max_entries:
+            return
+
+        self._connection.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Commits pending writes and closes the cache file.
+
+        Returns:
+            - None
+        """
+
+        self._connection.commit()
+        self._connection.close()
@@ -0,0 +1,223 @@
+"""
+    This code defines the functions used to embed chunks with a pool of worker processes.
+
+    The load_embeddings_model function loads the LlamaCppEmbeddings model from a GGML path,
+    or a deterministic stand-in model when the path starts with "stand-in:", through the model registry of the process.
+
+    The iter_embedded_batches_in_pool function:
+        starts N worker processes that each load the model once, using threads_per_worker threads,
+        pulls batches of texts from its input only when a worker can take them (a bounded queue),
+        collects the embedded batches as they finish, and
+        yields them back in their original order.
+
+    The embed_texts_in_pool function splits a list of texts into batches and collects the result as one list.
+"""
+
+import os
+import queue
+import multiprocessing
+from functools import partial
+
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+from HELPERS.model_registry import get_embeddings_model
+
+
+def load_embeddings_model(
+    model_path: str, n_threads: Optional[int] = None
+) -> Embeddings:
+    """
+    Loads the embeddings model for the given path.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp. If None, llama.cpp decides.
+
+    Returns:
+        - Embeddings: The loaded embeddings model.
+    """
+
+    return get_embeddings_model(model_path, n_threads=n_threads)
+
+
+def embeddings_model_factory(
+    model_path: str, n_threads: Optional[int] = None
+) -> Callable[[], Embeddings]:
+    """
+    Builds a picklable factory that loads the embeddings model inside a worker process.
+
+    Args:
+        - model_path (str): Path to the GGML model, or a "stand-in:<dimension>" string.
+        - n_threads (Optional[int]): Number of threads used by llama.cpp in each worker.
+
+    Returns:
+        - Callable[[], Embeddings]: A function loading the embeddings model.
+    """
+
+    return partial(load_embeddings_model, model_path, n_threads)
+
+
+def _worker_loop(
+    embeddings_factory: Callable[[], Embeddings],
+    task_queue: multiprocessing.Queue,
+    result_queue: multiprocessing.Queue,
+) -> None:
+    # Load the model once, on the first batch that needs it, then embed batches until the sentinel arrives
+    embeddings = None
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        batch_index, texts = task
+        if not texts:
+            result_queue.put((batch_index, [], None))
+            continue
+
+        try:
+            if embeddings is None:
+                embeddings = embeddings_factory()
+            result_queue.put((batch_index, embeddings.embed_documents(texts), None))
+        except Exception as error:
+            result_queue.put((batch_index, None, repr(error)))
+
+
+def iter_embedded_batches_in_pool(
+    batches: Iterable[List[str]],
+    embeddings_factory: Callable[[], Embeddings],
+    workers: int,
+    queue_size: Optional[int] = None,
+) -> Iterator[List[List[float]]]:
+    """
+    Embeds batches of texts with a pool of worker processes that each load the embeddings model once.
+
+    The batches are only pulled from the input when a worker can take them,
+    so at most queue_size batches are waiting or being embedded at any time.
+
+    Args:
+        - batches (Iterable[List[str]]): The batches of texts to embed.
+        - embeddings_factory (Callable[[], Embeddings]): Picklable function loading the embeddings model in a worker.
+        - workers (int): Number of worker processes.
+        - queue_size (Optional[int]): Maximum number of batches in flight. Defaults to 2 per worker.
+
+    Yields:
+        - List[List[float]]: The embeddings of each batch, in the order of the batches.
+    """
+
+    # Workers are forked where possible so the step scripts are not re-imported in every worker
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in start_methods else None)
+
+    max_in_flight = queue_size or 2 * workers
+    task_queue = context.Queue(maxsize=max_in_flight)
+    result_queue = context.Queue()
+
+    processes = [
+        context.Process(
+            target=_worker_loop,
+            args=(embeddings_factory, task_queue, result_queue),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    batches = iter(batches)
+    exhausted = False
+    sent_count = 0
+    next_to_yield = 0
+    results: Dict[int, List[List[float]]] = {}
+
+    try:
+        while True:
+            # Keep the workers busy without letting more than max_in_flight batches pile up
+            while not exhausted and sent_count - next_to_yield < max_in_flight:
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                task_queue.put((sent_count, batch))
+                sent_count += 1
+
+            if exhausted and next_to_yield == sent_count:
+                break
+
+            try:
+                batch_index, vectors, error = result_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError("All embedding workers exited before finishing")
+                continue
+
+            if error is not None:
+                raise RuntimeError(f"Embedding worker failed: {error}")
+
+            results[batch_index] = vectors
+
+            # Yield the finished batches in their original order
+            while next_to_yield in results:
+                yield results.pop(next_to_yield)
+                next_to_yield += 1
+
+        for _ in processes:
+            task_queue.put(None)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def embed_texts_in_pool(
+    texts: List[str],
+    embeddings_factory: Callable[[], Embeddings],
+    workers: int,
+    batch_size: int = 32,
+    queue_size: Optional[int] = None,
+) -> List[List[float]]:
+    """
+    Embeds texts with a pool of worker processes that each load the embeddings model once.
+
+    Args:
+        - texts (List[str]): The texts to embed.
+        - embeddings_factory (Callable[[], Embeddings]): Picklable function loading the embeddings model in a worker.
+        - workers (int): Number of worker processes.
+        - batch_size (int): Number of texts sent to a worker at once.
+        - queue_size (Optional[int]): Maximum number of batches in flight. Defaults to 2 per worker.
+
+    Returns:
+        - List[List[float]]: The embedding of each text, in the order of the texts.
+    """
+
+    batches = (texts[start : start + batch_size] for start in range(0, len(texts), batch_size))
+
+    all_vectors: List[List[float]] = []
+    for vectors in iter_embedded_batches_in_pool(
+        batches=batches,
+        embeddings_factory=embeddings_factory,
+        workers=workers,
+        queue_size=queue_size,
+    ):
+        all_vectors.extend(vectors)
+
+    return all_vectors
+
+
+def default_threads_per_worker(workers: int) -> int:
+    """
+    Splits the CPU cores of the machine evenly between the workers.
+
+    Args:
+        - workers (int): Number of worker processes.
+
+    Returns:
+        - int: Number of llama.cpp threads to use in each worker.
+    """
+
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
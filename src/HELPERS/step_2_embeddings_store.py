@@ -0,0 +1,327 @@
+"""
+    This code defines the on-disk format of the embeddings: a contiguous matrix file with a small header,
+    and a sidecar manifest mapping each row of the matrix to the (document, chunk id) it was created from.
+
+    The matrix file ("<name>.embeddings") starts with a 64 bytes header:
+        the magic bytes "LLEMBV01",
+        the format version, the data type code and the dimension of the vectors (three little-endian uint32), and
+        the number of rows (a little-endian uint64),
+    followed by the rows themselves, one vector after the other, stored as:
+        float32 (data type 0), the exact vectors,
+        float16 (data type 1), half the size, or
+        int8 (data type 2), a quarter of the size: every row is scaled so its largest component is 127,
+        and the float32 scale of every row is stored after the last row (symmetric scalar quantization).
+
+    The manifest ("<name>.manifest.jsonl") has one JSON line per row: ["document name", "chunk_i"].
+
+    The EmbeddingsStoreWriter class writes both files incrementally, one batch at a time,
+    and the open_embeddings_store function opens them again with mmap, without copying the vectors into memory
+    (open_embeddings_matrix only opens the matrix).
+    An int8 file is opened as an Int8EmbeddingsMatrix, which gives back float32 rows when it is indexed.
+"""
+
+import os
+import json
+import struct
+
+from typing import Any, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+EMBEDDINGS_FILE_EXTENSION = ".embeddings"
+MANIFEST_FILE_EXTENSION = ".manifest.jsonl"
+
+MAGIC = b"LLEMBV01"
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_FORMAT = "<8sIIIQ"
+
+DTYPE_FLOAT32 = 0
+DTYPE_FLOAT16 = 1
+DTYPE_INT8 = 2
+
+STORE_DTYPES = {"float32": DTYPE_FLOAT32, "float16": DTYPE_FLOAT16, "int8": DTYPE_INT8}
+
+
+def manifest_path_for(file_path: str) -> str:
+    """
+    Builds the path of the manifest belonging to an embeddings file.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file.
+
+    Returns:
+        - str: Path to the ".manifest.jsonl" file.
+    """
+
+    return os.path.splitext(file_path)[0] + MANIFEST_FILE_EXTENSION
+
+
+def _pack_header(dimension: int, count: int, dtype: int = DTYPE_FLOAT32) -> bytes:
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, dtype, dimension, count)
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+def read_header(file_path: str) -> Tuple[int, int, int]:
+    """
+    Reads the header of an embeddings file.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file.
+
+    Returns:
+        - Tuple[int, int, int]: The dimension of the vectors, the number of rows and the data type code of the rows.
+    """
+
+    with open(file_path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+
+    magic, version, dtype, dimension, count = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != MAGIC or version != VERSION or dtype not in STORE_DTYPES.values():
+        raise ValueError(f"{file_path} is not a supported embeddings file")
+
+    return dimension, count, dtype
+
+
+def quantize_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes float vectors to int8, with one scale per vector.
+
+    Args:
+        - matrix (np.ndarray): The (rows, dimension) float matrix.
+
+    Returns:
+        - Tuple[np.ndarray, np.ndarray]: The int8 codes, and the float32 scale of every row (codes * scale gives the vectors back).
+    """
+
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+
+    return codes, scales.astype(np.float32)
+
+
+class Int8EmbeddingsMatrix:
+    """
+    Read-only view of the int8 rows of an embeddings file, giving back float32 rows when it is indexed.
+
+    Args:
+        - codes (np.ndarray): The (rows, dimension) int8 codes, usually memory-mapped.
+        - scales (np.ndarray): The float32 scale of every row.
+    """
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray) -> None:
+        self.codes = codes
+        self.scales = scales
+        self.shape = codes.shape
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, rows: Union[int, slice, List[int], np.ndarray]) -> np.ndarray:
+        scales = np.asarray(self.scales[rows], dtype=np.float32)
+        codes = np.asarray(self.codes[rows], dtype=np.float32)
+        return codes * (scales[..., None] if codes.ndim == 2 else scales)
+
+    def __array__(self, dtype: Optional[Any] = None) -> np.ndarray:
+        matrix = self[:]
+        return matrix if dtype is None else matrix.astype(dtype, copy=False)
+
+
+class EmbeddingsStoreWriter:
+    """
+    Writes an embeddings file and its manifest incrementally.
+
+    Both files are written next to their final path (".tmp") and only replace it in close(),
+    so a reader that memory-mapped the previous file (e.g. the exact re-ranking of STEP 4) keeps reading it,
+    and a file that was not closed properly never replaces it.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file to write.
+        - dtype (str): Data type of the rows: "float32", "float16" or "int8".
+    """
+
+    def __init__(self, file_path: str, dtype: str = "float32") -> None:
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unknown embeddings data type {dtype}, expected float32, float16 or int8")
+
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.file_path = file_path
+        self.dtype = dtype
+        self.dimension = 0
+        self.count = 0
+        self._scales: List[np.ndarray] = []
+
+        self._file = open(file_path + ".tmp", "wb")
+        self._file.write(_pack_header(dimension=0, count=0, dtype=STORE_DTYPES[dtype]))
+        self._manifest = open(manifest_path_for(file_path) + ".tmp", "w")
+
+    def append(
+        self, vectors: List[List[float]], references: List[Tuple[str, str]]
+    ) -> None:
+        """
+        Appends a batch of rows to the store.
+
+        Args:
+            - vectors (List[List[float]]): The embeddings of the batch.
+            - references (List[Tuple[str, str]]): The (document, chunk id) each embedding was created from.
+
+        Returns:
+            - None
+        """
+
+        if len(vectors) != len(references):
+            raise ValueError("Every vector needs exactly one (document, chunk id) reference")
+        if not len(vectors):
+            return
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if self.dimension == 0:
+            self.dimension = matrix.shape[1]
+        elif matrix.shape[1] != self.dimension:
+            raise ValueError(
+                f"Expected vectors of dimension {self.dimension}, got {matrix.shape[1]}"
+            )
+
+        if self.dtype == "int8":
+            codes, scales = quantize_int8(matrix)
+            self._file.write(codes.tobytes())
+            self._scales.append(scales)
+        else:
+            self._file.write(matrix.astype(self.dtype).tobytes())
+        for document, chunk in references:
+            self._manifest.write(json.dumps([document, chunk]) + "\n")
+
+        self.count += len(matrix)
+
+    def close(self) -> None:
+        """
+        Writes the final header, closes both files and moves them to their final paths.
+
+        Returns:
+            - None
+        """
+
+        self._manifest.close()
+        if self._scales:
+            # The scales of the int8 rows follow the last row
+            self._file.write(np.concatenate(self._scales).astype("<f4").tobytes())
+        self._file.seek(0)
+        self._file.write(
+            _pack_header(
+                dimension=self.dimension, count=self.count, dtype=STORE_DTYPES[self.dtype]
+            )
+        )
+        self._file.close()
+
+        os.replace(manifest_path_for(self.file_path) + ".tmp", manifest_path_for(self.file_path))
+        os.replace(self.file_path + ".tmp", self.file_path)
+
+    def abort(self) -> None:
+        """
+        Discards the files being written, leaving any previous embeddings file and manifest in place.
+
+        Returns:
+            - None
+        """
+
+        self._manifest.close()
+        self._file.close()
+        os.remove(manifest_path_for(self.file_path) + ".tmp")
+        os.remove(self.file_path + ".tmp")
+
+    def __enter__(self) -> "EmbeddingsStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def embeddings_store_dtype(file_path: str) -> str:
+    """
+    Reads the data type of the rows of an embeddings file from its header.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file.
+
+    Returns:
+        - str: "float32", "float16" or "int8".
+    """
+
+    _, _, dtype = read_header(file_path)
+    return {code: name for name, code in STORE_DTYPES.items()}[dtype]
+
+
+def open_embeddings_matrix(file_path: str) -> np.ndarray:
+    """
+    Opens the matrix of an embeddings file with mmap, without reading its manifest.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file.
+
+    Returns:
+        - np.ndarray: A read-only (rows, dimension) matrix backed by the file (float32, float16, or an Int8EmbeddingsMatrix).
+    """
+
+    dimension, count, dtype = read_header(file_path)
+
+    if count == 0:
+        return np.zeros((0, dimension), dtype=np.float32)
+
+    if dtype == DTYPE_INT8:
+        codes = np.memmap(
+            file_path, dtype=np.int8, mode="r", offset=HEADER_SIZE, shape=(count, dimension)
+        )
+        scales = np.memmap(
+            file_path,
+            dtype="<f4",
+            mode="r",
+            offset=HEADER_SIZE + count * dimension,
+            shape=(count,),
+        )
+        return Int8EmbeddingsMatrix(codes, scales)
+
+    return np.memmap(
+        file_path,
+        dtype=np.float16 if dtype == DTYPE_FLOAT16 else np.float32,
+        mode="r",
+        offset=HEADER_SIZE,
+        shape=(count, dimension),
+    )
+
+
+def open_embeddings_store(file_path: str) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
+    """
+    Opens an embeddings file with mmap and reads its manifest.
+
+    Args:
+        - file_path (str): Path to the ".embeddings" file.
+
+    Returns:
+        - Tuple[np.ndarray, List[Tuple[str, str]]]:
+            - a read-only (rows, dimension) matrix backed by the file (float32, float16, or an Int8EmbeddingsMatrix), and
+            - the (document, chunk id) of each row.
+    """
+
+    matrix = open_embeddings_matrix(file_path)
+    count = len(matrix)
+
+    with open(manifest_path_for(file_path), "r") as f:
+        references = [tuple(json.loads(line)) for line in f]
+
+    if len(references) != count:
+        raise ValueError(
+            f"{file_path} has {count} rows but its manifest has {len(references)}"
+        )
+
+    return matrix, references
@@ -0,0 +1,167 @@
+"""
+    This code defines a function called iter_json_chunks that reads back the chunks saved by STEP 1.
+
+    The function takes one argument:
+        json_chunks_directory which is the path to the directory containing the "<document> Chunks.json" files.
+
+    The function:
+        goes through the JSON files in filename order, so every run sees the chunks in the same order,
+        extracts the chunk id and the text of every chunk, and
+        yields them one by one together with the name of their document.
+
+    The iter_chunks, load_document_chunks and load_chunk_texts functions read the chunk store of the directory
+    (see HELPERS/step_1_chunk_store.py) when STEP 1 wrote one, and fall back to the JSON files otherwise.
+"""
+
+import os
+import json
+
+from typing import Iterator, List, Tuple
+
+from HELPERS.step_1_chunk_store import ChunkStore, chunk_store_path
+from HELPERS.step_1_deduplicate_chunks import DUPLICATE_CHUNKS_FILE_NAME
+
+
+JSON_CHUNKS_SUFFIX = " Chunks.json"
+
+
+def document_name_from_json_file(file_name: str) -> str:
+    """
+    Gets the name of a document back from the name of its JSON chunks file.
+
+    Args:
+        - file_name (str): Name of the JSON file, e.g. "report Chunks.json".
+
+    Returns:
+        - str: Name of the document, e.g. "report".
+    """
+
+    if file_name.endswith(JSON_CHUNKS_SUFFIX):
+        return file_name[: -len(JSON_CHUNKS_SUFFIX)]
+
+    return os.path.splitext(file_name)[0]
+
+
+def iter_json_chunks(json_chunks_directory: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Iterates through the chunks of every JSON file in the specified directory.
+
+    Args:
+        - json_chunks_directory (str): Path to directory containing JSON files.
+
+    Yields:
+        - Tuple[str, str, str]: The document name, the chunk id (e.g. "chunk_1") and the text of each chunk.
+    """
+
+    for filename in sorted(os.listdir(json_chunks_directory)):
+        # The duplicate chunks file of STEP 1 is not a document
+        if filename.endswith(".json") and filename != DUPLICATE_CHUNKS_FILE_NAME:
+            with open(os.path.join(json_chunks_directory, filename), "r") as f:
+                chunks = json.load(f)
+
+            document = document_name_from_json_file(filename)
+
+            # Each chunk is a single-key dict: {"chunk_i": text}
+            for chunk in chunks:
+                for key, value in chunk.items():
+                    yield document, key, value
+                    break
+
+
+def load_json_document_chunks(
+    json_chunks_directory: str, document: str
+) -> List[Tuple[str, str]]:
+    """
+    Reads the chunks of a single document.
+
+    Args:
+        - json_chunks_directory (str): Path to directory containing JSON files.
+        - document (str): Name of the document.
+
+    Returns:
+        - List[Tuple[str, str]]: The chunk id and the text of each chunk of the document.
+    """
+
+    with open(
+        os.path.join(json_chunks_directory, document + JSON_CHUNKS_SUFFIX), "r"
+    ) as f:
+        chunks = json.load(f)
+
+    return [next(iter(chunk.items())) for chunk in chunks]
+
+
+def iter_chunks(json_chunks_directory: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Iterates through the chunks of the specified directory, from its chunk store if it has one, or from its JSON files.
+
+    Args:
+        - json_chunks_directory (str): Path to the chunks directory.
+
+    Yields:
+        - Tuple[str, str, str]: The document name, the chunk id (e.g. "chunk_1") and the text of each chunk.
+    """
+
+    file_path = chunk_store_path(json_chunks_directory)
+    if not os.path.exists(file_path):
+        yield from iter_json_chunks(json_chunks_directory)
+        return
+
+    store = ChunkStore(file_path)
+    try:
+        yield from store
+    finally:
+        store.close()
+
+
+def load_document_chunks(
+    json_chunks_directory: str, document: str
+) -> List[Tuple[str, str]]:
+    """
+    Reads the chunks of a single document, from the chunk store of the directory if it has one, or from its JSON file.
+
+    Args:
+        - json_chunks_directory (str): Path to the chunks directory.
+        - document (str): Name of the document.
+
+    Returns:
+        - List[Tuple[str, str]]: The chunk id and the text of each chunk of the document.
+    """
+
+    file_path = chunk_store_path(json_chunks_directory)
+    if not os.path.exists(file_path):
+        return load_json_document_chunks(json_chunks_directory, document)
+
+    store = ChunkStore(file_path)
+    try:
+        return store.document_chunks(document)
+    finally:
+        store.close()
+
+
+def load_chunk_texts(
+    json_chunks_directory: str, references: List[Tuple[str, str]]
+) -> List[str]:
+    """
+    Reads the text of the chunks with the given (document, chunk id), in order.
+
+    Args:
+        - json_chunks_directory (str): Path to the chunks directory.
+        - references (List[Tuple[str, str]]): The (document, chunk id) of every chunk to read.
+
+    Returns:
+        - List[str]: The text of each chunk.
+    """
+
+    file_path = chunk_store_path(json_chunks_directory)
+    if not os.path.exists(file_path):
+        texts_by_reference = {
+            (document, chunk): text
+            for document, chunk, text in iter_json_chunks(json_chunks_directory)
+        }
+        return [texts_by_reference[reference] for reference in references]
+
+    store = ChunkStore(file_path)
+    try:
+        return [store.text(store.row_of(*reference)) for reference in references]
+    finally:
+        store.close()
@@ -1,32 +1,46 @@
 """
-    This function takes in three parameters: 
-    
-    "embeddings" which is an instance of the "Embeddings" class, 
-    "file_name" which is a string representing the name of the file to be saved, and 
+    This function takes in three parameters:
+
+    "embeddings" which is an iterable of batches, each batch being the (document, chunk id) references
+    of the embedded chunks and their embeddings,
+    "file_name" which is a string representing the name of the file to be saved, and
     "directory_path" which is a string representing the path to the directory where the file will be saved.
 
-    The function first creates a directory at the specified path if it does not already exist. 
-    It then creates a file path by joining the directory path and file name with a ".pkl" extension. 
-    Finally, it saves the embeddings object to the binary file using the "pickle" module.
+    The function first creates a directory at the specified path if it does not already exist.
+    It then creates a file path by joining the directory path and file name with a ".embeddings" extension.
+    Finally, it writes the batches one after the other to a float32 embeddings file, and the references
+    to its ".manifest.jsonl" sidecar, as they are produced.
+    The rows can also be stored as float16 or int8 (the dtype argument) to halve or quarter the size of the file.
 """
 
 
-import pickle
 import os
 
-from langchain.embeddings.base import Embeddings
+from typing import Iterable, List, Tuple
+
+from HELPERS.step_2_embeddings_store import (
+    EMBEDDINGS_FILE_EXTENSION,
+    EmbeddingsStoreWriter,
+)
 
 
 def save_embeddings(
-    embeddings: Embeddings, file_name: str, directory_path: str
+    embeddings: Iterable[Tuple[List[Tuple[str, str]], List[List[float]]]],
+    file_name: str,
+    directory_path: str,
+    dtype: str = "float32",
 ) -> None:
     """
-    Save embeddings to a binary file with the specified file name and directory path.
+    Save embeddings to a float32 embeddings file with the specified file name and directory path.
 
     Args:
-        - embeddings (Embeddings): The embeddings to be saved.
+        - embeddings (Iterable[Tuple[List[Tuple[str, str]], List[List[float]]]]):
+            The batches of embeddings to be saved, each batch being:
+                - the (document, chunk id) of every embedded chunk,
+                - and the embeddings themselves.
         - file_name (str): The name of the file to save the embeddings to.
         - directory_path (str): The path to the directory where the file will be saved.
+        - dtype (str): Data type of the saved rows: "float32", "float16" or "int8".
 
     Returns:
         - None
@@ -35,8 +49,9 @@ def save_embeddings(
     directory = os.path.join(os.getcwd(), directory_path)
     if not os.path.exists(directory):
         os.makedirs(directory)
-    file_path = os.path.join(directory, file_name + ".pkl")
+    file_path = os.path.join(directory, file_name + EMBEDDINGS_FILE_EXTENSION)
 
-    # Save embeddings to binary file
-    with open(file_path, "wb") as f:
-        pickle.dump(embeddings, f)
+    # Save embeddings batch by batch to the embeddings file
+    with EmbeddingsStoreWriter(file_path, dtype=dtype) as writer:
+        for references, vectors in embeddings:
+            writer.append(vectors=vectors, references=references)
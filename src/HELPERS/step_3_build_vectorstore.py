@@ -0,0 +1,373 @@
+"""
+    This code defines the functions used by STEP 3 to build and update a FAISS vectorstore with stable per-chunk ids.
+
+    Every chunk gets an id derived from its (document, chunk id), so the same chunk always has the same id
+    in the FAISS index (an IndexIDMap2), in index_to_docstore_id and in the docstore.
+    This is what allows the vectors of a single document to be removed or replaced later without rebuilding the index.
+
+    The vectorstore manifest records, for every indexed document, a hash of its chunks and the ids of its chunks.
+    Comparing it with the chunks directory tells which documents are new, changed or deleted since the last build.
+
+    The functions:
+        chunk_id computes the stable id of a chunk,
+        create_faiss_index creates (and trains, if needed) an index from a FAISS index factory spec,
+        apply_search_parameters sets the search-time parameters (nprobe, efSearch) of an index,
+        build_vectorstore creates a FAISS vectorstore from texts, embeddings and (document, chunk id) references,
+        add_to_vectorstore and remove_from_vectorstore add and remove chunks by id,
+        supports_remove_ids tells whether an index can remove vectors at all (HNSW indexes cannot),
+        set_chunk_references lists the duplicates STEP 1 removed in the "duplicates" metadata of the chunks they duplicate,
+        build_vectorstore_manifest hashes the documents of the chunks directory, and
+        diff_vectorstore_manifest compares two manifests.
+"""
+
+import hashlib
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.embeddings.base import Embeddings
+
+from HELPERS.step_3_disk_docstore import DiskDocstore
+
+
+ADD_BATCH_SIZE = 65536
+
+def chunk_id(document: str, chunk: str) -> int:
+    """
+    Computes the stable id of a chunk from its document name and chunk id.
+
+    Args:
+        - document (str): Name of the document.
+        - chunk (str): Id of the chunk in the document, e.g. "chunk_1".
+
+    Returns:
+        - int: A non-negative 63 bits id, usable as a FAISS id.
+    """
+
+    digest = hashlib.sha1(f"{document}\0{chunk}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") & 0x7FFFFFFFFFFFFFFF
+
+
+def _documents_and_ids(
+    texts: List[str], references: List[Tuple[str, str]]
+) -> Tuple[Dict[str, Document], Dict[int, str], np.ndarray]:
+    ids = np.array(
+        [chunk_id(document, chunk) for document, chunk in references], dtype=np.int64
+    )
+    documents = {
+        str(id_): Document(
+            page_content=text, metadata={"source": document, "chunk": chunk}
+        )
+        for id_, text, (document, chunk) in zip(ids.tolist(), texts, references)
+    }
+    index_to_docstore_id = {id_: str(id_) for id_ in ids.tolist()}
+
+    return documents, index_to_docstore_id, ids
+
+
+def create_faiss_index(
+    embeddings: np.ndarray,
+    index_factory: str = "Flat",
+    training_sample_size: int = 100_000,
+) -> faiss.Index:
+    """
+    Creates an empty FAISS index from an index factory spec, trained on a sample of the embeddings if the spec needs it.
+
+    Args:
+        - embeddings (np.ndarray): The (chunks, dimension) matrix of embeddings.
+        - index_factory (str): FAISS index factory spec, e.g. "Flat", "IVF1024,Flat", "HNSW32" or "IVF1024,PQ32".
+        - training_sample_size (int): Maximum number of embeddings used to train the index.
+
+    Returns:
+        - faiss.Index: The empty index, wrapped in an IndexIDMap2 so vectors can be added with the ids of their chunks.
+    """
+
+    index = faiss.index_factory(embeddings.shape[1], index_factory)
+
+    if not index.is_trained:
+        # Train on a random sample of the rows, read in file order
+        rows = np.arange(len(embeddings))
+        if len(rows) > training_sample_size:
+            rows = np.sort(
+                np.random.default_rng(0).choice(
+                    rows, size=training_sample_size, replace=False
+                )
+            )
+        index.train(np.ascontiguousarray(embeddings[rows], dtype=np.float32))
+
+    return faiss.IndexIDMap2(index)
+
+
+def apply_search_parameters(
+    index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+) -> None:
+    """
+    Sets the search-time parameters of a FAISS index, skipping the ones its index type does not have.
+
+    Args:
+        - index (faiss.Index): The FAISS index.
+        - nprobe (Optional[int]): Number of inverted lists visited by IVF indexes.
+        - ef_search (Optional[int]): Size of the candidate list of HNSW indexes.
+
+    Returns:
+        - None
+    """
+
+    parameter_space = faiss.ParameterSpace()
+
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None:
+            continue
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            # e.g. nprobe on an HNSW index
+            pass
+
+
+def build_vectorstore(
+    texts: List[str],
+    embeddings: np.ndarray,
+    references: List[Tuple[str, str]],
+    embedding: Embeddings,
+    index_factory: str = "Flat",
+    training_sample_size: int = 100_000,
+) -> FAISS:
+    """
+    Creates a FAISS vectorstore whose vectors are identified by the stable id of their chunk.
+
+    Args:
+        - texts (List[str]): The text of every chunk.
+        - embeddings (np.ndarray): The (chunks, dimension) matrix of embeddings.
+        - references (List[Tuple[str, str]]): The (document, chunk id) of every chunk.
+        - embedding (Embeddings): The embeddings model used to embed queries.
+        - index_factory (str): FAISS index factory spec. Defaults to an exact ("Flat") L2 index.
+        - training_sample_size (int): Maximum number of embeddings used to train the index.
+
+    Returns:
+        - FAISS: FAISS vectorstore created from the chunks.
+    """
+
+    index = create_faiss_index(
+        embeddings=embeddings,
+        index_factory=index_factory,
+        training_sample_size=training_sample_size,
+    )
+
+    vectorstore = FAISS(embedding.embed_query, index, InMemoryDocstore({}), {})
+
+    # Add the rows in slices, so a memory-mapped matrix is never copied into memory as a whole
+    for start in range(0, len(texts), ADD_BATCH_SIZE):
+        end = start + ADD_BATCH_SIZE
+        add_to_vectorstore(
+            vectorstore, texts[start:end], embeddings[start:end], references[start:end]
+        )
+
+    return vectorstore
+
+
+def add_to_vectorstore(
+    vectorstore: FAISS,
+    texts: List[str],
+    embeddings: np.ndarray,
+    references: List[Tuple[str, str]],
+) -> None:
+    """
+    Adds chunks to a FAISS vectorstore built by build_vectorstore.
+
+    Args:
+        - vectorstore (FAISS): The vectorstore to add the chunks to.
+        - texts (List[str]): The text of every chunk.
+        - embeddings (np.ndarray): The (chunks, dimension) matrix of embeddings.
+        - references (List[Tuple[str, str]]): The (document, chunk id) of every chunk.
+
+    Returns:
+        - None
+    """
+
+    if not texts:
+        return
+
+    documents, index_to_docstore_id, ids = _documents_and_ids(texts, references)
+
+    vectorstore.index.add_with_ids(
+        np.ascontiguousarray(embeddings, dtype=np.float32), ids
+    )
+    vectorstore.docstore.add(documents)
+    vectorstore.index_to_docstore_id.update(index_to_docstore_id)
+
+
+def supports_remove_ids(index: faiss.Index) -> bool:
+    """
+    Tells whether vectors can be removed from a FAISS index.
+
+    Args:
+        - index (faiss.Index): The FAISS index (e.g. the IndexIDMap2 of build_vectorstore).
+
+    Returns:
+        - bool: False for the index types that cannot remove vectors (HNSW, with or without a scalar quantizer).
+    """
+
+    try:
+        # Removing no vector still fails on the index types without remove_ids
+        index.remove_ids(np.array([], dtype=np.int64))
+    except RuntimeError:
+        return False
+
+    return True
+
+
+def remove_from_vectorstore(vectorstore: FAISS, ids: Iterable[int]) -> int:
+    """
+    Removes chunks from a FAISS vectorstore built by build_vectorstore.
+
+    Args:
+        - vectorstore (FAISS): The vectorstore to remove the chunks from.
+        - ids (Iterable[int]): The stable ids of the chunks to remove.
+
+    Returns:
+        - int: The number of vectors removed from the index.
+
+    Raises:
+        - ValueError: If the index cannot remove vectors (see supports_remove_ids).
+    """
+
+    ids = [id_ for id_ in ids if id_ in vectorstore.index_to_docstore_id]
+    if not ids:
+        return 0
+
+    if not supports_remove_ids(vectorstore.index):
+        raise ValueError(
+            "Vectors cannot be removed from this type of FAISS index (e.g. HNSW): rebuild the vectorstore instead"
+        )
+
+    removed = vectorstore.index.remove_ids(np.array(ids, dtype=np.int64))
+
+    for id_ in ids:
+        # With a disk docstore, the id mapping removes the chunk from the docstore itself
+        docstore_id = vectorstore.index_to_docstore_id.pop(id_)
+        if isinstance(vectorstore.docstore, InMemoryDocstore):
+            # InMemoryDocstore has no delete method
+            vectorstore.docstore._dict.pop(docstore_id, None)
+
+    return removed
+
+
+def set_chunk_references(
+    vectorstore: FAISS, references: Dict[Tuple[str, str], List[Tuple[str, str]]]
+) -> int:
+    """
+    Sets the "duplicates" metadata of the chunks of a vectorstore: the (document, chunk id) of the duplicates STEP 1 removed.
+
+    Args:
+        - vectorstore (FAISS): The vectorstore, with an InMemoryDocstore or a DiskDocstore.
+        - references (Dict[Tuple[str, str], List[Tuple[str, str]]]): The duplicates of every kept (document, chunk id),
+          as loaded by load_chunk_references. The metadata of the chunks without duplicates is removed.
+
+    Returns:
+        - int: The number of chunks of the vectorstore with duplicates.
+    """
+
+    duplicates = {
+        str(chunk_id(*kept)): [list(reference) for reference in chunk_duplicates]
+        for kept, chunk_duplicates in references.items()
+        if chunk_duplicates
+    }
+
+    docstore = vectorstore.docstore
+    if isinstance(docstore, DiskDocstore):
+        # The Documents of the chunks on disk are built by every search, with these duplicates
+        docstore.duplicates = {
+            docstore_id: chunk_duplicates
+            for docstore_id, chunk_duplicates in duplicates.items()
+            if docstore_id in docstore
+        }
+        documents = docstore._added
+        count = len(docstore.duplicates)
+    else:
+        documents = docstore._dict
+        count = sum(1 for docstore_id in duplicates if docstore_id in documents)
+
+    for docstore_id, document in documents.items():
+        if docstore_id in duplicates:
+            document.metadata["duplicates"] = duplicates[docstore_id]
+        else:
+            document.metadata.pop("duplicates", None)
+
+    return count
+
+
+def document_content_hash(chunks: List[Tuple[str, str]]) -> str:
+    """
+    Hashes the chunks of a document.
+
+    Args:
+        - chunks (List[Tuple[str, str]]): The (chunk id, text) of every chunk of the document, in order.
+
+    Returns:
+        - str: The hex digest of the chunks.
+    """
+
+    digest = hashlib.sha256()
+    for chunk, text in chunks:
+        digest.update(chunk.encode("utf-8") + b"\0" + text.encode("utf-8") + b"\0")
+
+    return digest.hexdigest()
+
+
+def build_vectorstore_manifest(
+    chunks: Iterable[Tuple[str, str, str]]
+) -> Dict[str, Dict[str, object]]:
+    """
+    Builds the vectorstore manifest of a stream of chunks.
+
+    Args:
+        - chunks (Iterable[Tuple[str, str, str]]): The document name, chunk id and text of each chunk.
+
+    Returns:
+        - Dict[str, Dict[str, object]]: For every document, the hash of its chunks ("hash") and their stable ids ("chunk_ids").
+    """
+
+    chunks_by_document: Dict[str, List[Tuple[str, str]]] = {}
+    for document, chunk, text in chunks:
+        chunks_by_document.setdefault(document, []).append((chunk, text))
+
+    return {
+        document: {
+            "hash": document_content_hash(document_chunks),
+            "chunk_ids": [chunk_id(document, chunk) for chunk, _ in document_chunks],
+        }
+        for document, document_chunks in chunks_by_document.items()
+    }
+
+
+def diff_vectorstore_manifest(
+    old_manifest: Dict[str, Dict[str, object]],
+    new_manifest: Dict[str, Dict[str, object]],
+) -> Tuple[List[str], List[str]]:
+    """
+    Compares the manifest of a saved vectorstore with the manifest of the current chunks.
+
+    Args:
+        - old_manifest (Dict[str, Dict[str, object]]): The manifest of the saved vectorstore.
+        - new_manifest (Dict[str, Dict[str, object]]): The manifest of the current chunks.
+
+    Returns:
+        - Tuple[List[str], List[str]]:
+            - the documents that are new or changed, and
+            - the documents that were deleted.
+    """
+
+    changed = [
+        document
+        for document, entry in new_manifest.items()
+        if document not in old_manifest
+        or old_manifest[document]["hash"] != entry["hash"]
+    ]
+    deleted = [document for document in old_manifest if document not in new_manifest]
+
+    return changed, deleted
@@ -0,0 +1,313 @@
+"""
+    This code defines the disk docstore: a docstore that keeps the text of the chunks of a vectorstore on disk
+    and only builds Document objects for the chunks a search returns.
+
+    FAISS.save_local pickles an InMemoryDocstore holding a Document for every chunk, so FAISS.load_local
+    has to read and unpickle the text of the whole corpus before the first query can run.
+    The disk docstore is saved next to the index instead, as up to three files:
+        docstore.chunkstore, a chunk store (see HELPERS/step_1_chunk_store.py) with the text, document and chunk id of every chunk,
+        docstore_ids.npy, the stable id of every chunk (sorted) and its row in the chunk store, and
+        docstore_duplicates.json, if STEP 1 removed duplicate chunks: the (document, chunk id) of the duplicates
+        of every kept chunk, by docstore id, returned in the "duplicates" metadata of the chunk.
+    The chunk store and the ids are opened with mmap, so loading them reads nothing but their headers, and looking up a chunk
+    is a binary search in the ids followed by the decoding of that chunk only. The duplicates are read with json.load.
+
+    The DiskDocstore class can still be updated (STEP 3 in update mode): added Documents are kept in memory
+    and removed ids are masked, until save_disk_docstore writes a new docstore.
+    The DocstoreIdMapping class stands in for FAISS.index_to_docstore_id, which would otherwise hold an entry
+    per chunk: since every vector is identified by the stable id of its chunk, the docstore id of a vector is that id, as a string.
+
+    The functions:
+        save_disk_docstore writes the docstore of a vectorstore (in memory or on disk) to a directory,
+        load_disk_docstore opens it again and returns the docstore and its id mapping, and
+        to_in_memory_vectorstore reads a disk docstore back into an InMemoryDocstore, so the vectorstore can be pickled.
+"""
+
+import os
+import json
+
+from typing import Dict, Iterator, List, MutableMapping, Set, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+from HELPERS.step_1_chunk_store import ChunkStore, ChunkStoreWriter
+
+
+DISK_DOCSTORE_FILE_NAME = "docstore.chunkstore"
+DISK_DOCSTORE_IDS_FILE_NAME = "docstore_ids.npy"
+DISK_DOCSTORE_DUPLICATES_FILE_NAME = "docstore_duplicates.json"
+
+
+class DiskDocstore(Docstore, AddableMixin):
+    """
+    Docstore reading the text of the chunks from a chunk store on disk, by stable chunk id.
+
+    Args:
+        - directory_path (str): Path to the directory holding docstore.chunkstore, docstore_ids.npy
+            and, if there are duplicate chunks, docstore_duplicates.json.
+    """
+
+    def __init__(self, directory_path: str) -> None:
+        self.directory_path = directory_path
+        self._store = ChunkStore(os.path.join(directory_path, DISK_DOCSTORE_FILE_NAME))
+        # Column 0: the sorted stable ids, column 1: their row in the chunk store
+        self._ids = np.load(
+            os.path.join(directory_path, DISK_DOCSTORE_IDS_FILE_NAME), mmap_mode="r"
+        )
+
+        self._added: Dict[str, Document] = {}
+        self._removed: Set[str] = set()
+
+        # The duplicates of the kept chunks, by docstore id
+        self.duplicates: Dict[str, List[List[str]]] = {}
+        duplicates_path = os.path.join(directory_path, DISK_DOCSTORE_DUPLICATES_FILE_NAME)
+        if os.path.exists(duplicates_path):
+            with open(duplicates_path, "r") as f:
+                self.duplicates = json.load(f)
+
+    def _row(self, docstore_id: str) -> int:
+        try:
+            id_ = int(docstore_id)
+        except ValueError:
+            return -1
+
+        position = int(np.searchsorted(self._ids[:, 0], id_))
+        if position < len(self._ids) and int(self._ids[position, 0]) == id_:
+            return int(self._ids[position, 1])
+        return -1
+
+    def __contains__(self, docstore_id: str) -> bool:
+        if docstore_id in self._added:
+            return True
+        return docstore_id not in self._removed and self._row(docstore_id) != -1
+
+    def __len__(self) -> int:
+        return len(self._ids) - len(self._removed) + len(self._added)
+
+    def ids(self) -> Iterator[str]:
+        """
+        Iterates through the docstore ids of every chunk of the docstore.
+
+        Yields:
+            - str: The docstore id of each chunk, the chunks on disk first, in id order.
+        """
+
+        for id_ in self._ids[:, 0].tolist():
+            docstore_id = str(id_)
+            if docstore_id not in self._removed:
+                yield docstore_id
+        yield from self._added
+
+    def search(self, search: str) -> Union[str, Document]:
+        """
+        Builds the Document of a chunk from its docstore id.
+
+        Args:
+            - search (str): The docstore id of the chunk, i.e. its stable id as a string.
+
+        Returns:
+            - Union[str, Document]: The Document of the chunk, or a message if the docstore has no such chunk.
+        """
+
+        if search in self._added:
+            return self._added[search]
+
+        row = -1 if search in self._removed else self._row(search)
+        if row == -1:
+            return f"ID {search} not found."
+
+        document, chunk = self._store.reference(row)
+        metadata = {"source": document, "chunk": chunk}
+        if search in self.duplicates:
+            metadata["duplicates"] = self.duplicates[search]
+
+        return Document(page_content=self._store.text(row), metadata=metadata)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        """
+        Adds Documents to the docstore. They are kept in memory until the docstore is saved again.
+
+        Args:
+            - texts (Dict[str, Document]): The Documents to add, by docstore id.
+
+        Returns:
+            - None
+        """
+
+        overlapping = [docstore_id for docstore_id in texts if docstore_id in self]
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+
+        for docstore_id, document in texts.items():
+            # A chunk removed then added again is served from memory
+            self._removed.discard(docstore_id)
+            self._added[docstore_id] = document
+
+    def delete(self, docstore_ids: List[str]) -> None:
+        """
+        Removes chunks from the docstore.
+
+        Args:
+            - docstore_ids (List[str]): The docstore ids of the chunks to remove.
+
+        Returns:
+            - None
+        """
+
+        for docstore_id in docstore_ids:
+            if self._added.pop(docstore_id, None) is None and self._row(docstore_id) != -1:
+                self._removed.add(docstore_id)
+
+    def close(self) -> None:
+        """
+        Closes the chunk store of the docstore.
+
+        Returns:
+            - None
+        """
+
+        self._store.close()
+
+
+class DocstoreIdMapping(MutableMapping):
+    """
+    Maps the ids of the vectors of a FAISS index to their docstore id, without an entry per vector.
+
+    Every vector is identified by the stable id of its chunk, so its docstore id is that id as a string.
+
+    Args:
+        - docstore (DiskDocstore): The docstore of the vectorstore.
+    """
+
+    def __init__(self, docstore: DiskDocstore) -> None:
+        self.docstore = docstore
+
+    def __getitem__(self, id_: int) -> str:
+        docstore_id = str(int(id_))
+        if docstore_id not in self.docstore:
+            raise KeyError(id_)
+        return docstore_id
+
+    def __setitem__(self, id_: int, docstore_id: str) -> None:
+        # The Document itself is added to the docstore by the caller
+        if docstore_id != str(int(id_)):
+            raise ValueError(f"Vector {id_} must map to the docstore id {id_}, not {docstore_id}")
+
+    def __delitem__(self, id_: int) -> None:
+        self.docstore.delete([self[id_]])
+
+    def __contains__(self, id_: object) -> bool:
+        return isinstance(id_, (int, np.integer)) and str(int(id_)) in self.docstore
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(docstore_id) for docstore_id in self.docstore.ids())
+
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+
+def save_disk_docstore(vectorstore: FAISS, directory_path: str) -> int:
+    """
+    Writes the docstore of a vectorstore built by build_vectorstore to a directory, as a disk docstore.
+
+    Args:
+        - vectorstore (FAISS): The vectorstore, with an InMemoryDocstore or a DiskDocstore.
+        - directory_path (str): Path to the directory to write docstore.chunkstore and docstore_ids.npy
+          (and docstore_duplicates.json, for the chunks with "duplicates" metadata) to.
+
+    Returns:
+        - int: The number of chunks written.
+    """
+
+    # The ids of the index, in the order their vectors were added
+    index_ids = faiss.vector_to_array(vectorstore.index.id_map)
+
+    rows: List[Tuple[int, int]] = []
+    duplicates: Dict[str, List[List[str]]] = {}
+    with ChunkStoreWriter(os.path.join(directory_path, DISK_DOCSTORE_FILE_NAME)) as writer:
+        # Consecutive chunks of the same document are written as one document of the chunk store
+        pending: Dict = {"name": None, "chunks": []}
+        for id_ in index_ids.tolist():
+            document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[id_])
+            if not isinstance(document, Document):
+                raise ValueError(f"Could not find document for id {id_}, got {document}")
+
+            if document.metadata["source"] != pending["name"]:
+                if pending["chunks"]:
+                    writer.add_document(pending)
+                pending = {"name": document.metadata["source"], "chunks": []}
+            pending["chunks"].append({document.metadata["chunk"]: document.page_content})
+            rows.append((id_, len(rows)))
+            if document.metadata.get("duplicates"):
+                duplicates[str(id_)] = document.metadata["duplicates"]
+
+        if pending["chunks"]:
+            writer.add_document(pending)
+
+    ids = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    ids = ids[np.argsort(ids[:, 0], kind="stable")]
+    np.save(os.path.join(directory_path, DISK_DOCSTORE_IDS_FILE_NAME), ids)
+
+    if duplicates:
+        with open(os.path.join(directory_path, DISK_DOCSTORE_DUPLICATES_FILE_NAME), "w") as f:
+            json.dump(duplicates, f)
+
+    return len(ids)
+
+
+def has_disk_docstore(directory_path: str) -> bool:
+    """
+    Tells whether a saved vectorstore has a disk docstore.
+
+    Args:
+        - directory_path (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - bool: True if the folder holds a disk docstore.
+    """
+
+    return os.path.exists(os.path.join(directory_path, DISK_DOCSTORE_IDS_FILE_NAME))
+
+
+def load_disk_docstore(directory_path: str) -> Tuple[DiskDocstore, DocstoreIdMapping]:
+    """
+    Opens the disk docstore of a saved vectorstore.
+
+    Args:
+        - directory_path (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - Tuple[DiskDocstore, DocstoreIdMapping]: The docstore, and the mapping to use as index_to_docstore_id.
+    """
+
+    docstore = DiskDocstore(directory_path)
+    return docstore, DocstoreIdMapping(docstore)
+
+
+def to_in_memory_vectorstore(vectorstore: FAISS) -> FAISS:
+    """
+    Reads every chunk of the disk docstore of a vectorstore into an InMemoryDocstore.
+
+    Args:
+        - vectorstore (FAISS): The vectorstore, with a DiskDocstore.
+
+    Returns:
+        - FAISS: A vectorstore sharing the same index, with an InMemoryDocstore and a dict as index_to_docstore_id.
+    """
+
+    index_to_docstore_id = {id_: str(id_) for id_ in vectorstore.index_to_docstore_id}
+    docstore = InMemoryDocstore(
+        {
+            docstore_id: vectorstore.docstore.search(docstore_id)
+            for docstore_id in index_to_docstore_id.values()
+        }
+    )
+
+    return FAISS(
+        vectorstore.embedding_function, vectorstore.index, docstore, index_to_docstore_id
+    )
@@ -0,0 +1,147 @@
+"""
+    This code defines a function called evaluate_index that measures how well an approximate FAISS index
+    (IVF, HNSW, PQ, ...) matches exact search on the corpus it indexes.
+
+    The function:
+        picks a held-out sample of the embeddings as queries, different from the rows used to train the index,
+        searches them with an exact flat L2 index over the same embeddings (the ground truth) and with the index being evaluated,
+        leaves the query's own chunk out of both result lists, so a chunk finding itself does not count as a hit,
+        computes the recall@k of the index against the ground truth, and
+        times every query on both indexes to report the p50 and p99 latencies.
+
+    When a reranker is given (a quantized index, see HELPERS.step_3_quantization), the two-phase search
+    (candidates from the index, re-ranked by exact distance) is evaluated too, so the recall lost to
+    the quantization and the recall won back by the re-ranking can be compared.
+
+    The result is a plain dict that STEP 3 prints and saves next to the vectorstore, so an index type
+    can be picked for a given corpus size from measurements instead of guesses.
+"""
+
+import time
+
+from typing import Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from HELPERS.step_3_quantization import ExactReranker
+
+
+def _timed_search(
+    index: faiss.Index,
+    queries: np.ndarray,
+    k: int,
+    reranker: Optional[ExactReranker] = None,
+    rerank_candidates: int = 32,
+) -> Tuple[np.ndarray, np.ndarray]:
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = np.empty(len(queries), dtype=np.float64)
+
+    # One query at a time, as STEP 4 searches
+    for i, query in enumerate(queries):
+        start_time = time.perf_counter()
+        if reranker is None:
+            _, result = index.search(query.reshape(1, -1), k)
+        else:
+            _, candidates = index.search(query.reshape(1, -1), max(k, rerank_candidates))
+            result = reranker.rerank(query.reshape(1, -1), candidates, k)
+        latencies[i] = time.perf_counter() - start_time
+        ids[i] = result[0]
+
+    return ids, latencies
+
+
+def _recall(
+    query_ids: np.ndarray, exact_ids: np.ndarray, found_ids: np.ndarray, k: int
+) -> float:
+    hits = 0
+    expected = 0
+    for query_id, exact_row, found_row in zip(query_ids, exact_ids, found_ids):
+        exact_set = [i for i in exact_row if i != query_id and i != -1][:k]
+        found_set = set([i for i in found_row if i != query_id and i != -1][:k])
+        hits += sum(1 for i in exact_set if i in found_set)
+        expected += len(exact_set)
+
+    return hits / expected if expected else 1.0
+
+
+def evaluate_index(
+    index: faiss.Index,
+    embeddings: np.ndarray,
+    ids: np.ndarray,
+    k: int = 4,
+    query_count: int = 200,
+    training_sample_size: int = 100_000,
+    reranker: Optional[ExactReranker] = None,
+    rerank_candidates: int = 32,
+) -> Dict[str, float]:
+    """
+    Reports the recall@k and the query latencies of an index against exact search.
+
+    Args:
+        - index (faiss.Index): The index to evaluate, holding the embeddings under their chunk ids.
+        - embeddings (np.ndarray): The (chunks, dimension) matrix of embeddings held by the index.
+        - ids (np.ndarray): The chunk id of every row of embeddings.
+        - k (int): Number of results per query, as in STEP 4.
+        - query_count (int): Number of held-out queries.
+        - training_sample_size (int): The training sample size the index was built with, used to hold the queries out of it.
+        - reranker (Optional[ExactReranker]): Re-ranks the candidates of a quantized index. If None, only the index is evaluated.
+        - rerank_candidates (int): Number of candidates searched in the index before re-ranking.
+
+    Returns:
+        - Dict[str, float]: The recall@k, and the p50 and p99 latencies (in milliseconds) of the index and of exact search,
+          and of the re-ranked search if there is a reranker.
+    """
+
+    row_count = len(embeddings)
+    rng = np.random.default_rng(1)
+
+    # Prefer rows that were not in the training sample (see create_faiss_index)
+    candidates = np.arange(row_count)
+    if row_count > training_sample_size:
+        training_rows = np.random.default_rng(0).choice(
+            candidates, size=training_sample_size, replace=False
+        )
+        candidates = np.setdiff1d(candidates, training_rows)
+
+    query_rows = np.sort(
+        rng.choice(candidates, size=min(query_count, len(candidates)), replace=False)
+    )
+    queries = np.ascontiguousarray(embeddings[query_rows], dtype=np.float32)
+    query_ids = ids[query_rows]
+
+    # Ground truth: exact search over the same embeddings
+    exact_index = faiss.IndexIDMap2(faiss.IndexFlatL2(embeddings.shape[1]))
+    for start in range(0, row_count, 65536):
+        exact_index.add_with_ids(
+            np.ascontiguousarray(embeddings[start : start + 65536], dtype=np.float32),
+            ids[start : start + 65536],
+        )
+
+    exact_ids, exact_latencies = _timed_search(exact_index, queries, k + 1)
+    approximate_ids, approximate_latencies = _timed_search(index, queries, k + 1)
+
+    evaluation = {
+        "queries": len(queries),
+        "k": k,
+        f"recall@{k}": _recall(query_ids, exact_ids, approximate_ids, k),
+        "p50_ms": float(np.percentile(approximate_latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(approximate_latencies, 99) * 1000),
+        "exact_p50_ms": float(np.percentile(exact_latencies, 50) * 1000),
+        "exact_p99_ms": float(np.percentile(exact_latencies, 99) * 1000),
+    }
+
+    if reranker is not None:
+        reranked_ids, reranked_latencies = _timed_search(
+            index, queries, k + 1, reranker=reranker, rerank_candidates=rerank_candidates
+        )
+        evaluation.update(
+            {
+                "rerank_candidates": rerank_candidates,
+                f"reranked_recall@{k}": _recall(query_ids, exact_ids, reranked_ids, k),
+                "reranked_p50_ms": float(np.percentile(reranked_latencies, 50) * 1000),
+                "reranked_p99_ms": float(np.percentile(reranked_latencies, 99) * 1000),
+            }
+        )
+
+    return evaluation
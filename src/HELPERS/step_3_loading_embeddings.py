@@ -1,31 +1,35 @@
 """
-    This code defines a function called load_embeddings that loads embeddings from a file using the pickle module. 
-        
-    The function takes one argument: 
-        file_path which is the path to the file containing the embeddings. 
-    
-    The function: 
-        opens the file in binary mode, 
-        loads the embeddings using pickle.load(), and 
-        returns the embeddings.
+    This code defines a function called load_embeddings that loads embeddings from an embeddings file using mmap.
+
+    The function takes one argument:
+        file_path which is the path to the file containing the embeddings.
+
+    The function:
+        maps the matrix of the file into memory without copying it (float32, or float16 / int8 when STEP 2 quantized it),
+        reads the (document, chunk id) of every row from the ".manifest.jsonl" sidecar, and
+        returns both.
 """
 
-import pickle
-from langchain.embeddings.base import Embeddings
+from typing import List, Tuple
+
+import numpy as np
+
+from HELPERS.step_2_embeddings_store import open_embeddings_store
 
 
-def load_embeddings(file_path: str) -> Embeddings:
+def load_embeddings(file_path: str) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
     """
-    Loads embeddings from the specified file path using pickle.
+    Loads embeddings from the specified file path using mmap.
 
     Args:
         - file_path (str): Path to file containing embeddings.
 
     Returns:
-        - Embeddings: Loaded embeddings.
+        - Tuple[np.ndarray, List[Tuple[str, str]]]:
+            - the (rows, dimension) matrix of embeddings, backed by the file (int8 rows are given back as float32 when indexed), and
+            - the (document, chunk id) of each row.
     """
 
-    with open(file_path, "rb") as f:
-        embeddings: Embeddings = pickle.load(f)
+    embeddings, references = open_embeddings_store(file_path)
 
-    return embeddings
+    return embeddings, references
@@ -0,0 +1,288 @@
+"""
+    This code defines the scalar quantization of the FAISS index and the exact re-ranking of its results.
+
+    An uncompressed index holds every embedding as float32 in memory, which is what limits the size of the corpus
+    for large llama embedding dimensions. With VECTORSTORE_QUANTIZATION set to "float16" or "int8", STEP 3 builds
+    the index with a FAISS scalar quantizer (SQfp16 or SQ8) instead, which holds 2 or 1 byte(s) per dimension.
+
+    The search is then done in two phases:
+        the compressed index returns rerank_candidates candidates (more than the k results wanted), and
+        the ExactReranker computes the exact distance of the query to each candidate, with the embeddings
+        read from disk (mmap), and keeps the k closest.
+    Only the rows of the candidates are read, so the exact vectors cost disk space, not memory.
+
+    The exact vectors are the float32 rows of the embeddings file of STEP 2: the ExactReranker saves next to the index
+        exact_ids.npy, the stable id of every chunk (sorted) and its row in the embeddings file, and
+        exact_vectors.json, the path of the embeddings file, with its size and modification time,
+    so the rows are memory-mapped where they are instead of being copied. If the embeddings file changed since
+    (STEP 2 ran again), its rows may not be the ones of the index anymore, and the candidates are not re-ranked
+    until STEP 3 runs again. Exact vectors that are not the rows of an embeddings file are copied to exact_vectors.npy.
+
+    A float16 or int8 embeddings file (EMBEDDINGS_STORE_DTYPE) only holds quantized rows: they are no exact vectors,
+    so STEP 3 refuses to quantize the index of such a file.
+
+    The functions:
+        quantized_index_factory turns a FAISS index factory spec into its quantized version,
+        quantization_memory reports the memory taken by the vectors of an index, compared with float32 vectors,
+        load_exact_reranker opens the exact vectors saved next to an index, if there are any.
+"""
+
+import os
+import re
+import json
+
+from typing import Dict, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+
+from HELPERS.step_2_embeddings_store import (
+    embeddings_store_dtype,
+    open_embeddings_matrix,
+)
+
+
+QUANTIZATIONS = {"none": None, "float16": "SQfp16", "int8": "SQ8"}
+
+EXACT_VECTORS_FILE_NAME = "exact_vectors.npy"
+EXACT_VECTORS_REFERENCE_FILE_NAME = "exact_vectors.json"
+EXACT_IDS_FILE_NAME = "exact_ids.npy"
+
+_WRITE_BATCH_SIZE = 65536
+
+
+def quantized_index_factory(index_factory: str, quantization: str) -> str:
+    """
+    Replaces the flat (float32) storage of a FAISS index factory spec with a scalar quantizer.
+
+    Args:
+        - index_factory (str): FAISS index factory spec, e.g. "Flat", "IVF1024,Flat" or "HNSW32".
+        - quantization (str): "none", "float16" or "int8".
+
+    Returns:
+        - str: The spec with the quantizer, e.g. "SQ8", "IVF1024,SQ8" or "HNSW32,SQ8". Unchanged if quantization is "none".
+    """
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}, expected none, float16 or int8")
+
+    code = QUANTIZATIONS[quantization]
+    if code is None:
+        return index_factory
+
+    parts = index_factory.split(",")
+    if parts[-1] == "Flat":
+        parts[-1] = code
+    elif re.fullmatch(r"HNSW\d*", parts[-1]):
+        parts.append(code)
+    else:
+        raise ValueError(
+            f"Cannot quantize the index {index_factory}: it does not store flat vectors"
+        )
+
+    return ",".join(parts)
+
+
+def quantization_memory(index: faiss.Index) -> Dict[str, int]:
+    """
+    Reports the memory taken by the vectors of an index, and the memory float32 vectors would take.
+
+    Args:
+        - index (faiss.Index): The index, wrapped in an IndexIDMap2 by create_faiss_index.
+
+    Returns:
+        - Dict[str, int]: The bytes taken by the vectors of the index, by float32 vectors, and the bytes saved.
+    """
+
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    # HNSW indexes keep their vectors in a storage index
+    if hasattr(inner, "storage"):
+        inner = faiss.downcast_index(inner.storage)
+
+    vectors_bytes = index.ntotal * inner.sa_code_size()
+    float32_bytes = index.ntotal * index.d * 4
+
+    return {
+        "vectors_bytes": vectors_bytes,
+        "float32_vectors_bytes": float32_bytes,
+        "saved_bytes": float32_bytes - vectors_bytes,
+    }
+
+
+class ExactReranker:
+    """
+    Re-ranks the candidates of a compressed index by their exact distance to the query.
+
+    Args:
+        - ids (np.ndarray): The stable id of every exact vector.
+        - embeddings (np.ndarray): The (rows, dimension) matrix of exact embeddings, usually memory-mapped.
+        - rows (Optional[np.ndarray]): The row of every id in embeddings. If None, the i-th id is the i-th row.
+        - embeddings_file (Optional[str]): Path to the float32 ".embeddings" file embeddings is memory-mapped from,
+          so save references its rows instead of copying them.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        embeddings: np.ndarray,
+        rows: Optional[np.ndarray] = None,
+        embeddings_file: Optional[str] = None,
+    ) -> None:
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.arange(len(ids)) if rows is None else np.asarray(rows, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        # Column 0: the sorted stable ids, column 1: their row in embeddings
+        self._ids = np.stack([ids[order], rows[order].astype(np.int64)], axis=1)
+        self.embeddings = embeddings
+        self.embeddings_file = embeddings_file
+
+    @classmethod
+    def _from_files(cls, ids: np.ndarray, embeddings: np.ndarray) -> "ExactReranker":
+        reranker = cls.__new__(cls)
+        reranker._ids = ids
+        reranker.embeddings = embeddings
+        reranker.embeddings_file = None
+        return reranker
+
+    def _rows(self, ids: np.ndarray) -> np.ndarray:
+        if not len(self._ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+
+        positions = np.searchsorted(self._ids[:, 0], ids)
+        positions = np.minimum(positions, len(self._ids) - 1)
+        found = (ids != -1) & (np.asarray(self._ids[positions, 0]) == ids)
+        return np.where(found, np.asarray(self._ids[positions, 1]), -1)
+
+    def rerank(
+        self,
+        query_embeddings: np.ndarray,
+        candidate_ids: np.ndarray,
+        k: int,
+        return_distances: bool = False,
+    ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Keeps the k candidates of every query that are the closest to it, by exact L2 distance.
+
+        Args:
+            - query_embeddings (np.ndarray): The (queries, dimension) float32 embeddings of the queries.
+            - candidate_ids (np.ndarray): The (queries, candidates) ids returned by the compressed index, -1 for none.
+            - k (int): Number of results to keep per query.
+            - return_distances (bool): Whether to return the exact distances of the results too.
+
+        Returns:
+            - Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]: The (queries, k) ids of the results, closest first,
+              -1 where there are fewer than k candidates. With return_distances, the (queries, k) squared L2 distances
+              of the results first (infinite for the candidates without an exact vector, and for missing results).
+        """
+
+        results = np.full((len(candidate_ids), k), -1, dtype=np.int64)
+        result_distances = np.full((len(candidate_ids), k), np.inf, dtype=np.float32)
+
+        for i, (query, ids) in enumerate(zip(query_embeddings, candidate_ids)):
+            rows = self._rows(ids)
+            # Candidates without an exact vector keep their place, after the re-ranked ones
+            known = rows != -1
+            if known.any():
+                unique_rows, inverse = np.unique(rows[known], return_inverse=True)
+                # Read the rows in file order, once each
+                vectors = np.asarray(self.embeddings[unique_rows], dtype=np.float32)[inverse]
+                distances = ((vectors - query) ** 2).sum(axis=1)
+                order = np.argsort(distances, kind="stable")
+                ordered = np.concatenate([ids[known][order], ids[~known & (ids != -1)]])
+                result_distances[i, : min(k, len(order))] = distances[order][:k]
+            else:
+                ordered = ids[ids != -1]
+
+            results[i, : min(k, len(ordered))] = ordered[:k]
+
+        if return_distances:
+            return result_distances, results
+        return results
+
+    def save(self, directory_path: str) -> None:
+        """
+        Saves the ids of the exact vectors next to an index, with the path of the embeddings file they are read from
+        (or a copy of the exact vectors, if they are not memory-mapped from an embeddings file).
+
+        Args:
+            - directory_path (str): Path to the ".faiss" folder of the vectorstore.
+
+        Returns:
+            - None
+        """
+
+        np.save(os.path.join(directory_path, EXACT_IDS_FILE_NAME), np.asarray(self._ids))
+
+        if self.embeddings_file is not None:
+            if embeddings_store_dtype(self.embeddings_file) != "float32":
+                raise ValueError(
+                    f"{self.embeddings_file} does not hold float32 rows, they cannot be used as exact vectors"
+                )
+
+            stat = os.stat(self.embeddings_file)
+            with open(os.path.join(directory_path, EXACT_VECTORS_REFERENCE_FILE_NAME), "w") as f:
+                json.dump(
+                    {
+                        "embeddings_file": os.path.abspath(self.embeddings_file),
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                    },
+                    f,
+                    indent=4,
+                )
+            return
+
+        # Copied in slices, so a memory-mapped matrix is never read into memory as a whole
+        vectors = np.lib.format.open_memmap(
+            os.path.join(directory_path, EXACT_VECTORS_FILE_NAME),
+            mode="w+",
+            dtype=np.float32,
+            shape=self.embeddings.shape,
+        )
+        for start in range(0, len(self.embeddings), _WRITE_BATCH_SIZE):
+            vectors[start : start + _WRITE_BATCH_SIZE] = self.embeddings[
+                start : start + _WRITE_BATCH_SIZE
+            ]
+        vectors.flush()
+        del vectors
+
+
+def load_exact_reranker(path_to_vectorstore: str) -> Optional[ExactReranker]:
+    """
+    Opens the exact vectors saved next to an index with mmap.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - Optional[ExactReranker]: The reranker, or None if the index was saved without exact vectors
+          (or if the embeddings file they are read from changed since).
+    """
+
+    ids_path = os.path.join(path_to_vectorstore, EXACT_IDS_FILE_NAME)
+    if not os.path.exists(ids_path):
+        return None
+
+    reference_path = os.path.join(path_to_vectorstore, EXACT_VECTORS_REFERENCE_FILE_NAME)
+    if not os.path.exists(reference_path):
+        return ExactReranker._from_files(
+            np.load(ids_path, mmap_mode="r"),
+            np.load(os.path.join(path_to_vectorstore, EXACT_VECTORS_FILE_NAME), mmap_mode="r"),
+        )
+
+    with open(reference_path, "r") as f:
+        reference = json.load(f)
+
+    embeddings_file = reference["embeddings_file"]
+    stat = os.stat(embeddings_file) if os.path.exists(embeddings_file) else None
+    if stat is None or (stat.st_size, stat.st_mtime_ns) != (reference["size"], reference["mtime_ns"]):
+        # Its rows may not be the rows the ids point to anymore
+        print(
+            f"WARNING: {embeddings_file} changed since {path_to_vectorstore} was saved, "
+            "the candidates of its index are not re-ranked until STEP 3 runs again"
+        )
+        return None
+
+    return ExactReranker._from_files(
+        np.load(ids_path, mmap_mode="r"), open_embeddings_matrix(embeddings_file)
+    )
@@ -1,24 +1,85 @@
 """
-    This code defines a function called save_vectorstore that saves a FAISS index as a file at the specified directory path and file name. 
+    This code defines a function called save_vectorstore that saves a FAISS index as a file at the specified directory path and file name.
 
-    It imports the os module and the FAISS class from the langchain.vectorstores.faiss module. 
+    It imports the os module and the FAISS class from the langchain.vectorstores.faiss module.
+
+    The function takes seven arguments:
+        vectorstore which is the FAISS index to be saved,
+        directory_path which is the path to the directory where the file will be saved,
+        file_name which is the name of the file to be saved,
+        manifest which is the optional vectorstore manifest (see HELPERS.step_3_build_vectorstore) saved next to the index, and
+        index_params which are the optional index factory spec and search-time parameters saved next to the index, and
+        docstore which is "disk" to save the text of the chunks as a disk docstore (see HELPERS.step_3_disk_docstore)
+        instead of pickling them with the index ("memory"), and
+        reranker which is the optional ExactReranker of a quantized index, whose exact vectors are referenced next to the index.
 
-    The function takes three arguments: 
-        vectorstore which is the FAISS index to be saved, 
-        directory_path which is the path to the directory where the file will be saved, and 
-        file_name which is the name of the file to be saved. 
-        
     The function:
-        creates the directory if it doesn't exist, 
-        creates the file path, and 
-        saves the FAISS index to the file.
+        creates the directory if it doesn't exist,
+        creates the file path,
+        saves the FAISS index and its manifest to a temporary folder, and
+        swaps the temporary folder into place, so a crash never leaves a half-written vectorstore behind.
+
+    The swap moves the saved vectorstore to "<name>.faiss.old" before moving the new one to "<name>.faiss".
+    A crash between the two leaves no "<name>.faiss": saved_vectorstore_path then points every loader to "<name>.faiss.old",
+    and the next save moves it back into place first.
+
+    The load_vectorstore function loads a saved vectorstore with whichever docstore it was saved with,
+    and the load_vectorstore_manifest and load_index_params functions read the manifest and the index parameters back.
 """
 
 import os
+import json
+import shutil
+
+from typing import Dict, Optional
+
+import faiss
+from langchain.embeddings.base import Embeddings
 from langchain.vectorstores.faiss import FAISS
 
+from HELPERS.step_3_disk_docstore import (
+    DiskDocstore,
+    has_disk_docstore,
+    load_disk_docstore,
+    save_disk_docstore,
+    to_in_memory_vectorstore,
+)
+from HELPERS.step_3_quantization import ExactReranker
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+INDEX_PARAMS_FILE_NAME = "index_params.json"
+DOCSTORE_FORMATS = ("memory", "disk")
+PREVIOUS_VECTORSTORE_SUFFIX = ".old"
+
+
+def saved_vectorstore_path(path_to_vectorstore: str) -> str:
+    """
+    Finds the folder a saved vectorstore is read from, recovering from a save interrupted during its swap.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - str: path_to_vectorstore, or its ".old" folder if a save was interrupted after moving the vectorstore there.
+    """
+
+    previous_path = path_to_vectorstore + PREVIOUS_VECTORSTORE_SUFFIX
+    if not os.path.exists(path_to_vectorstore) and os.path.exists(previous_path):
+        return previous_path
+
+    return path_to_vectorstore
 
-def save_vectorstore(vectorstore: FAISS, directory_path: str, file_name: str) -> None:
+
+def save_vectorstore(
+    vectorstore: FAISS,
+    directory_path: str,
+    file_name: str,
+    manifest: Optional[Dict[str, Dict[str, object]]] = None,
+    index_params: Optional[Dict[str, object]] = None,
+    docstore: str = "memory",
+    reranker: Optional[ExactReranker] = None,
+) -> None:
     """
     Saves a FAISS index as a file at the specified directory path and file name.
 
@@ -26,14 +87,119 @@ def save_vectorstore(vectorstore: FAISS, directory_path: str, file_name: str) ->
         - vectorstore (FAISS): FAISS index to be saved.
         - directory_path (str): Path to directory where file will be saved.
         - file_name (str): Name of file to be saved.
+        - manifest (Optional[Dict[str, Dict[str, object]]]): Vectorstore manifest saved next to the index.
+        - index_params (Optional[Dict[str, object]]): Index factory spec and search-time parameters saved next to the index.
+        - docstore (str): "memory" to pickle the docstore with the index, or "disk" to save it as a disk docstore.
+        - reranker (Optional[ExactReranker]): Exact vectors of a quantized index, referenced (or saved) next to it for re-ranking.
 
     Returns:
         - None
     """
 
+    if docstore not in DOCSTORE_FORMATS:
+        raise ValueError(f"Unknown docstore format {docstore}, expected memory or disk")
+
     directory = os.path.join(os.getcwd(), directory_path)
     if not os.path.exists(directory):
         os.makedirs(directory)
     file_path = os.path.join(directory, file_name + ".faiss")
 
-    vectorstore.save_local(file_path)
+    # Save to a temporary folder first
+    temporary_path = file_path + ".tmp"
+    if os.path.exists(temporary_path):
+        shutil.rmtree(temporary_path)
+
+    if docstore == "disk":
+        os.makedirs(temporary_path)
+        faiss.write_index(vectorstore.index, os.path.join(temporary_path, "index.faiss"))
+        save_disk_docstore(vectorstore, temporary_path)
+    else:
+        if isinstance(vectorstore.docstore, DiskDocstore):
+            vectorstore = to_in_memory_vectorstore(vectorstore)
+        vectorstore.save_local(temporary_path)
+    if reranker is not None:
+        reranker.save(temporary_path)
+    if manifest is not None:
+        with open(os.path.join(temporary_path, MANIFEST_FILE_NAME), "w") as f:
+            json.dump(manifest, f)
+    if index_params is not None:
+        with open(os.path.join(temporary_path, INDEX_PARAMS_FILE_NAME), "w") as f:
+            json.dump(index_params, f, indent=4)
+
+    # Then swap it into place
+    previous_path = file_path + PREVIOUS_VECTORSTORE_SUFFIX
+    if os.path.exists(previous_path):
+        if os.path.exists(file_path):
+            shutil.rmtree(previous_path)
+        else:
+            # The last save was interrupted between the two moves: the saved vectorstore goes back into place first
+            os.replace(previous_path, file_path)
+    if os.path.exists(file_path):
+        os.replace(file_path, previous_path)
+    os.replace(temporary_path, file_path)
+    if os.path.exists(previous_path):
+        shutil.rmtree(previous_path)
+
+
+def load_vectorstore(path_to_vectorstore: str, embeddings: Embeddings) -> FAISS:
+    """
+    Loads a saved vectorstore, opening its disk docstore if it was saved with one.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore.
+        - embeddings (Embeddings): The embeddings model used to embed the queries.
+
+    Returns:
+        - FAISS: The vectorstore. With a disk docstore, the text of a chunk is only read when a search returns it.
+    """
+
+    path_to_vectorstore = saved_vectorstore_path(path_to_vectorstore)
+    if not has_disk_docstore(path_to_vectorstore):
+        return FAISS.load_local(path_to_vectorstore, embeddings)
+
+    index = faiss.read_index(os.path.join(path_to_vectorstore, "index.faiss"))
+    docstore, index_to_docstore_id = load_disk_docstore(path_to_vectorstore)
+
+    return FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id)
+
+
+def load_vectorstore_manifest(
+    path_to_vectorstore: str,
+) -> Optional[Dict[str, Dict[str, object]]]:
+    """
+    Loads the manifest of a saved vectorstore.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - Optional[Dict[str, Dict[str, object]]]: The manifest, or None if the vectorstore has no manifest.
+    """
+
+    path_to_vectorstore = saved_vectorstore_path(path_to_vectorstore)
+    manifest_path = os.path.join(path_to_vectorstore, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def load_index_params(path_to_vectorstore: str) -> Dict[str, object]:
+    """
+    Loads the index factory spec and search-time parameters of a saved vectorstore.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore.
+
+    Returns:
+        - Dict[str, object]: The index parameters, or an empty dict if none were saved.
+    """
+
+    path_to_vectorstore = saved_vectorstore_path(path_to_vectorstore)
+    index_params_path = os.path.join(path_to_vectorstore, INDEX_PARAMS_FILE_NAME)
+    if not os.path.exists(index_params_path):
+        return {}
+
+    with open(index_params_path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,148 @@
+"""
+    This code defines how STEP 3 splits a vectorstore into shards.
+
+    A vectorstore saved as a single ".faiss" folder has to fit in the memory of one process, and is searched by one call.
+    With VECTORSTORE_SHARDS set to N greater than 1, STEP 3 builds N vectorstores instead, each holding the chunks of
+    the documents whose name hashes to it, and saves them next to each other in SAVING_VECTORSTORE_DIRECTORY as
+        <name>.shard-<i>-of-<N>.faiss, one folder per shard, saved like any other vectorstore, and
+        <name>.shards.json, the list of the shards, which tells STEP 4 to search them (see HELPERS/step_4_sharded_search.py).
+
+    Every chunk of a document is in the same shard, so STEP 3 in update mode only touches the shards of the changed documents.
+    The shards are built from the embeddings saved by STEP 2: changing the number of shards only runs STEP 3 again.
+
+    The functions:
+        shard_of tells the shard of a document,
+        shard_file_name and shard_path give the name and the path to the ".faiss" folder of a shard,
+        save_shards_manifest writes the list of the shards (or removes it, for a single vectorstore) and deletes stale shards, and
+        load_shards_manifest reads it back.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+
+from typing import Dict, List, Optional
+
+
+SHARDS_MANIFEST_SUFFIX = ".shards.json"
+
+
+def shard_of(document: str, shard_count: int) -> int:
+    """
+    Computes the shard of a document from a hash of its name.
+
+    Args:
+        - document (str): Name of the document.
+        - shard_count (int): Number of shards.
+
+    Returns:
+        - int: The shard of the document, between 0 and shard_count - 1.
+    """
+
+    digest = hashlib.sha1(document.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") % shard_count
+
+
+def _base_path(path_to_vectorstore: str) -> str:
+    # "<directory>/<name>.faiss" -> "<directory>/<name>"
+    return os.path.splitext(path_to_vectorstore)[0]
+
+
+def shard_file_name(file_name: str, shard: int, shard_count: int) -> str:
+    """
+    Gives the file name of a shard, as passed to save_vectorstore.
+
+    Args:
+        - file_name (str): Name of the vectorstore (SAVING_VECTORSTORE_FILE_NAME).
+        - shard (int): The shard.
+        - shard_count (int): Number of shards. With a single shard, the vectorstore keeps its own name.
+
+    Returns:
+        - str: The file name of the shard, without the ".faiss" extension.
+    """
+
+    if shard_count == 1:
+        return file_name
+    return f"{file_name}.shard-{shard}-of-{shard_count}"
+
+
+def shard_path(path_to_vectorstore: str, shard: int, shard_count: int) -> str:
+    """
+    Gives the path to the ".faiss" folder of a shard.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the unsharded vectorstore.
+        - shard (int): The shard.
+        - shard_count (int): Number of shards.
+
+    Returns:
+        - str: The path to the ".faiss" folder of the shard.
+    """
+
+    directory_path, file_name = os.path.split(_base_path(path_to_vectorstore))
+    return os.path.join(directory_path, shard_file_name(file_name, shard, shard_count) + ".faiss")
+
+
+def save_shards_manifest(path_to_vectorstore: str, shard_count: int) -> None:
+    """
+    Writes the list of the shards of a vectorstore, once every shard is saved, and deletes what previous builds left behind.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the unsharded vectorstore.
+        - shard_count (int): Number of shards. With a single shard, the list is removed so STEP 4 searches the single vectorstore.
+
+    Returns:
+        - None
+    """
+
+    manifest_path = _base_path(path_to_vectorstore) + SHARDS_MANIFEST_SUFFIX
+    shards = [
+        os.path.basename(shard_path(path_to_vectorstore, shard, shard_count))
+        for shard in range(shard_count)
+    ]
+
+    if shard_count == 1:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+    else:
+        # Replaced atomically: STEP 4 sees either the previous shards or the new ones
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"shard_count": shard_count, "shards": shards}, f, indent=4)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    # The unsharded vectorstore is stale once the vectorstore is sharded, and so are the shards of another shard count
+    if shard_count > 1 and os.path.exists(path_to_vectorstore):
+        shutil.rmtree(path_to_vectorstore)
+
+    directory_path, file_name = os.path.split(_base_path(path_to_vectorstore))
+    stale_shard = re.compile(re.escape(file_name) + r"\.shard-\d+-of-\d+\.faiss")
+    for entry in os.listdir(directory_path or "."):
+        if stale_shard.fullmatch(entry) and entry not in shards:
+            shutil.rmtree(os.path.join(directory_path, entry))
+
+
+def load_shards_manifest(path_to_vectorstore: str) -> Optional[Dict[str, object]]:
+    """
+    Reads the list of the shards of a vectorstore.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the unsharded vectorstore.
+
+    Returns:
+        - Optional[Dict[str, object]]: The number of shards and the paths to their ".faiss" folders,
+          or None if the vectorstore is not sharded.
+    """
+
+    manifest_path = _base_path(path_to_vectorstore) + SHARDS_MANIFEST_SUFFIX
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    directory_path = os.path.dirname(path_to_vectorstore)
+    shards: List[str] = [os.path.join(directory_path, shard) for shard in manifest["shards"]]
+
+    return {"shard_count": manifest["shard_count"], "shards": shards}
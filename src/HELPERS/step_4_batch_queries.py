@@ -0,0 +1,277 @@
+"""
+    This code defines the batch query mode of STEP 4, which answers a whole file of questions in one process.
+
+    Answering questions one process at a time loads the model and the vectorstore for every question.
+    The iter_batch_answers function loads nothing itself: it is given the models and the vectorstore once, and
+        embeds the queries batch_size at a time (one embed_documents call per batch),
+        searches the embeddings of every query with a single FAISS search (see HELPERS.step_4_batch_search),
+        answers the queries with the question-answering chain on a pool of generation_workers threads,
+        with at most twice that many answers in flight, and
+        yields the results in the order of the queries, as soon as each one is answered.
+
+    Every result carries its timings in milliseconds: the embedding and search times are the time of its batch
+    (or of the single search) divided by the number of queries in it, the generation time is its own,
+    and what the prompt prefix cache of the model saved on its generation (see HELPERS/step_4_prompt_cache.py).
+    With an AnswerCache, a query already answered from the same chunks is not generated again (see HELPERS/step_4_query_cache.py).
+
+    The read_queries function reads the queries from a JSONL file, one query per line, either as a JSON string
+    or as an object with a "query" and an optional "id", and the run_batch_queries function writes the results
+    to a JSONL file as they are yielded.
+"""
+
+import json
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing import Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain import FAISS
+from langchain.llms.base import LLM
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+from langchain.chains.question_answering import load_qa_chain
+
+from HELPERS.model_registry import last_prompt_cache_request
+from HELPERS.step_3_quantization import ExactReranker
+from HELPERS.step_4_batch_search import batch_similarity_search
+from HELPERS.step_4_query_cache import AnswerCache
+from HELPERS.step_4_query_service import document_to_dict
+from HELPERS.step_4_sharded_search import ShardedVectorstore
+
+
+def read_queries(file_path: str) -> List[Dict[str, object]]:
+    """
+    Reads the queries of a JSONL file.
+
+    Args:
+        - file_path (str): Path to the JSONL file, with one JSON string or {"query": ..., "id": ...} object per line.
+
+    Returns:
+        - List[Dict[str, object]]: The id and the query of every line. Lines without an id get their line number.
+    """
+
+    queries = []
+
+    with open(file_path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"query": item}
+            if not isinstance(item, dict) or not isinstance(item.get("query"), str):
+                raise ValueError(
+                    f"{file_path}:{line_number}: expected a string or an object with a \"query\" string"
+                )
+
+            queries.append({"id": item.get("id", line_number), "query": item["query"]})
+
+    return queries
+
+
+def _retrieve(
+    queries: List[str],
+    embeddings: Embeddings,
+    vectorstore: Union[FAISS, ShardedVectorstore],
+    k: int,
+    batch_size: int,
+    reranker: Optional[ExactReranker],
+    rerank_candidates: int,
+) -> Tuple[List[List[Document]], List[float], float]:
+    query_embeddings: List[List[float]] = []
+    embedding_ms: List[float] = []
+
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start : start + batch_size]
+        start_time = time.perf_counter()
+        query_embeddings.extend(embeddings.embed_documents(batch))
+        batch_ms = (time.perf_counter() - start_time) * 1000
+        embedding_ms.extend([batch_ms / len(batch)] * len(batch))
+
+    # A single search for every query
+    start_time = time.perf_counter()
+    documents = batch_similarity_search(
+        vectorstore,
+        np.asarray(query_embeddings, dtype=np.float32),
+        k=k,
+        reranker=reranker,
+        rerank_candidates=rerank_candidates,
+    )
+    search_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+
+    return documents, embedding_ms, search_ms
+
+
+def iter_batch_answers(
+    queries: List[Dict[str, object]],
+    embeddings: Embeddings,
+    vectorstore: Union[FAISS, ShardedVectorstore],
+    llm: Optional[LLM] = None,
+    k: int = 4,
+    batch_size: int = 32,
+    generation_workers: int = 1,
+    reranker: Optional[ExactReranker] = None,
+    rerank_candidates: int = 32,
+    answer_cache: Optional[AnswerCache] = None,
+) -> Iterator[Dict[str, object]]:
+    """
+    Searches and answers a list of queries, with batched embeddings, a single FAISS search and a bounded pool of generations.
+
+    Args:
+        - queries (List[Dict[str, object]]): The id and the query of every query, as returned by read_queries.
+        - embeddings (Embeddings): The embeddings model used to embed the queries.
+        - vectorstore (Union[FAISS, ShardedVectorstore]): The FAISS vectorstore, or the shards of a vectorstore, to search.
+        - llm (Optional[LLM]): The LLM used to answer the queries. If None, the queries are only searched.
+        - k (int): Number of documents retrieved per query.
+        - batch_size (int): Number of queries embedded at once.
+        - generation_workers (int): Number of answers generated at once.
+        - reranker (Optional[ExactReranker]): Re-ranks the candidates of a quantized index by exact distance.
+        - rerank_candidates (int): Number of candidates per query searched in the index before re-ranking.
+        - answer_cache (Optional[AnswerCache]): The answers already generated. If None, every query is answered by the LLM.
+
+    Yields:
+        - Dict[str, object]: For every query, in order: its id, the query, the answer (None without an LLM),
+          the documents it was answered from, the timings of its embedding, search and generation in milliseconds,
+          what the prompt prefix cache saved on its generation (None without an LLM or for a model without a cache),
+          and whether the answer came from the answer cache.
+    """
+
+    if not queries:
+        return
+
+    documents, embedding_ms, search_ms = _retrieve(
+        [item["query"] for item in queries],
+        embeddings=embeddings,
+        vectorstore=vectorstore,
+        k=k,
+        batch_size=max(1, batch_size),
+        reranker=reranker,
+        rerank_candidates=rerank_candidates,
+    )
+
+    def result(
+        i: int,
+        answer: Optional[str],
+        generation_ms: Optional[float],
+        prompt_cache: Optional[Dict[str, object]] = None,
+        cached: bool = False,
+    ) -> Dict[str, object]:
+        return {
+            "id": queries[i]["id"],
+            "query": queries[i]["query"],
+            "answer": answer,
+            "documents": [document_to_dict(document) for document in documents[i]],
+            "timings": {
+                "embedding_ms": embedding_ms[i],
+                "search_ms": search_ms,
+                "generation_ms": generation_ms,
+            },
+            "prompt_cache": prompt_cache,
+            "cached": cached,
+        }
+
+    if llm is None:
+        for i in range(len(queries)):
+            yield result(i, None, None)
+        return
+
+    # Loaded once, shared by every generation
+    chain = load_qa_chain(llm, chain_type="stuff")
+
+    def generate(i: int) -> Tuple[str, float, Optional[Dict[str, object]], bool]:
+        start_time = time.perf_counter()
+        query = queries[i]["query"]
+
+        answer = answer_cache.get(query, documents[i]) if answer_cache is not None else None
+        if answer is not None:
+            return answer, (time.perf_counter() - start_time) * 1000, None, True
+
+        answer = chain.run(input_documents=documents[i], question=query)
+        if answer_cache is not None:
+            answer_cache.put(query, documents[i], answer)
+        # The generation ran in this worker thread
+        return answer, (time.perf_counter() - start_time) * 1000, last_prompt_cache_request(), False
+
+    generation_workers = max(1, generation_workers)
+    in_flight: Deque[Tuple[int, Future]] = deque()
+
+    with ThreadPoolExecutor(max_workers=generation_workers) as executor:
+        try:
+            for i in range(len(queries)):
+                # Bound the answers waiting to be written, so they do not pile up in memory
+                while len(in_flight) >= 2 * generation_workers:
+                    j, future = in_flight.popleft()
+                    yield result(j, *future.result())
+                in_flight.append((i, executor.submit(generate, i)))
+
+            while in_flight:
+                j, future = in_flight.popleft()
+                yield result(j, *future.result())
+        finally:
+            # The consumer stopped early: do not start the queued generations
+            for _, future in in_flight:
+                future.cancel()
+
+
+def run_batch_queries(
+    input_file_path: str,
+    output_file_path: str,
+    embeddings: Embeddings,
+    vectorstore: Union[FAISS, ShardedVectorstore],
+    llm: Optional[LLM] = None,
+    k: int = 4,
+    batch_size: int = 32,
+    generation_workers: int = 1,
+    reranker: Optional[ExactReranker] = None,
+    rerank_candidates: int = 32,
+    answer_cache: Optional[AnswerCache] = None,
+) -> Dict[str, float]:
+    """
+    Answers the queries of a JSONL file and writes the results to a JSONL file, one line per query, as they are answered.
+
+    Args:
+        - input_file_path (str): Path to the JSONL file of queries (see read_queries).
+        - output_file_path (str): Path to the JSONL file of results (see iter_batch_answers).
+        - embeddings (Embeddings): The embeddings model used to embed the queries.
+        - vectorstore (Union[FAISS, ShardedVectorstore]): The FAISS vectorstore, or the shards of a vectorstore, to search.
+        - llm (Optional[LLM]): The LLM used to answer the queries. If None, the queries are only searched.
+        - k (int): Number of documents retrieved per query.
+        - batch_size (int): Number of queries embedded at once.
+        - generation_workers (int): Number of answers generated at once.
+        - reranker (Optional[ExactReranker]): Re-ranks the candidates of a quantized index by exact distance.
+        - rerank_candidates (int): Number of candidates per query searched in the index before re-ranking.
+        - answer_cache (Optional[AnswerCache]): The answers already generated. If None, every query is answered by the LLM.
+
+    Returns:
+        - Dict[str, float]: The number of queries, the total time in seconds and the number of queries per second.
+    """
+
+    queries = read_queries(input_file_path)
+    start_time = time.perf_counter()
+
+    with open(output_file_path, "w") as f:
+        for result in iter_batch_answers(
+            queries,
+            embeddings=embeddings,
+            vectorstore=vectorstore,
+            llm=llm,
+            k=k,
+            batch_size=batch_size,
+            generation_workers=generation_workers,
+            reranker=reranker,
+            rerank_candidates=rerank_candidates,
+            answer_cache=answer_cache,
+        ):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+
+    seconds = time.perf_counter() - start_time
+
+    return {
+        "queries": len(queries),
+        "seconds": seconds,
+        "queries_per_second": len(queries) / seconds if seconds > 0 else 0.0,
+    }
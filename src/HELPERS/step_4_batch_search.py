@@ -0,0 +1,77 @@
+"""
+    This code defines a function called batch_similarity_search that searches a FAISS vectorstore
+    for several queries at once.
+
+    FAISS.similarity_search embeds and searches one query per call. This function takes the embeddings of
+    many queries as a single matrix and runs one FAISS search over all of them, which lets FAISS
+    spread the work over its threads and pays the per-call overhead once.
+
+    The function returns, for every query, the k most similar documents, exactly as FAISS.similarity_search would.
+
+    When a reranker is given (a quantized index, see HELPERS.step_3_quantization), the index is searched for
+    rerank_candidates candidates per query, and the reranker keeps the k closest by exact distance.
+
+    A ShardedVectorstore (see HELPERS.step_4_sharded_search) is searched by its own worker processes,
+    each shard with its own reranker.
+"""
+
+from typing import List, Optional, Union
+
+import numpy as np
+from langchain import FAISS
+from langchain.schema import Document
+
+from HELPERS.step_3_quantization import ExactReranker
+from HELPERS.step_4_sharded_search import ShardedVectorstore
+
+
+def batch_similarity_search(
+    vectorstore: Union[FAISS, ShardedVectorstore],
+    query_embeddings: List[List[float]],
+    k: int = 4,
+    reranker: Optional[ExactReranker] = None,
+    rerank_candidates: int = 32,
+) -> List[List[Document]]:
+    """
+    Finds the k most similar documents to each of several query embeddings with a single FAISS search.
+
+    Args:
+        - vectorstore (Union[FAISS, ShardedVectorstore]): The FAISS vectorstore, or the shards of a vectorstore, to search.
+        - query_embeddings (List[List[float]]): The embedding of each query.
+        - k (int): Number of documents to return per query.
+        - reranker (Optional[ExactReranker]): Re-ranks the candidates of a quantized index by exact distance. If None, the index results are kept.
+        - rerank_candidates (int): Number of candidates per query searched in the index before re-ranking.
+
+    Returns:
+        - List[List[Document]]: The most similar documents to each query, most similar first.
+    """
+
+    if not len(query_embeddings):
+        return []
+
+    if isinstance(vectorstore, ShardedVectorstore):
+        return vectorstore.search(query_embeddings, k=k)
+
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+
+    if reranker is None:
+        _, indices = vectorstore.index.search(queries, k)
+    else:
+        # First phase in the compressed index, second phase on the exact vectors
+        _, candidates = vectorstore.index.search(queries, max(k, rerank_candidates))
+        indices = reranker.rerank(queries, candidates, k)
+
+    results = []
+    for row in indices:
+        documents = []
+        for i in row:
+            if i == -1:
+                # This happens when not enough docs are returned.
+                continue
+            document = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+            if not isinstance(document, Document):
+                raise ValueError(f"Could not find document for id {i}, got {document}")
+            documents.append(document)
+        results.append(documents)
+
+    return results
@@ -0,0 +1,171 @@
+"""
+    This code defines the functions used by STEP 4 to build the context of the question-answering prompt
+    from the chunks found by the similarity search.
+
+    The chunks of STEP 1 overlap (by 50 of their 100 characters by default), and the most similar chunks to a query are often
+    consecutive chunks of the same document: put side by side in the prompt, they repeat each other.
+
+    The merge_chunks function merges the chunks of the same document that follow each other (or are the same chunk)
+    back into a single span of the document, writing the text they share once.
+    The pack_context function then adds the spans to the context, the span of the most similar chunk first,
+    as long as the prompt still leaves the model room for its answer in its context window (n_ctx),
+    and reports the prompt tokens it saved compared to the prompt of the chunks as they were found.
+"""
+
+import re
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain.llms.base import LLM
+from langchain.schema import Document
+
+from HELPERS.step_4_streaming_answers import qa_prompt
+
+
+def _chunk_number(document: Document) -> Optional[int]:
+    match = re.fullmatch(r"chunk_(\d+)", str(document.metadata.get("chunk", "")))
+    if match is None or "source" not in document.metadata:
+        return None
+    return int(match.group(1))
+
+
+def _overlap_length(text: str, next_text: str) -> int:
+    # The longest end of text the next chunk starts with, made of whole words like the overlap of the text splitter
+    for length in range(min(len(text), len(next_text)), 0, -1):
+        if (
+            text.endswith(next_text[:length])
+            and (length == len(text) or text[-length - 1].isspace())
+            and (length == len(next_text) or next_text[length].isspace())
+        ):
+            return length
+    return 0
+
+
+def _join_chunks(text: str, next_text: str) -> str:
+    overlap = _overlap_length(text, next_text)
+    if overlap:
+        return text + next_text[overlap:]
+    # Consecutive chunks without any overlap were split on a space
+    return text + " " + next_text
+
+
+def merge_chunks(documents: List[Document]) -> List[Document]:
+    """
+    Merges the consecutive chunks of the same document into spans of the document.
+
+    Args:
+        - documents (List[Document]): The chunks found by the similarity search, most similar first,
+          with the "source" and "chunk" ("chunk_<i>") metadata of STEP 3.
+
+    Returns:
+        - List[Document]: The spans, in the order of their most similar chunk. Each one has the "source" of its chunks,
+          the "chunk" it starts with, the "chunks" it is made of and the "duplicates" of its chunks, if any.
+          Documents without chunk metadata are kept as they are.
+    """
+
+    # (rank of the most similar chunk, source, first chunk number, last chunk number, text, chunk names, duplicates)
+    spans: List[List] = []
+    others: List[Tuple[int, Document]] = []
+
+    numbered = [(rank, document, _chunk_number(document)) for rank, document in enumerate(documents)]
+    numbered.sort(key=lambda item: (str(item[1].metadata.get("source", "")), item[2] or 0))
+
+    for rank, document, number in numbered:
+        if number is None:
+            others.append((rank, document))
+            continue
+
+        source = document.metadata["source"]
+        last = spans[-1] if spans else None
+        if last is not None and last[1] == source and number <= last[3] + 1:
+            if number == last[3] + 1:
+                last[4] = _join_chunks(last[4], document.page_content)
+                last[3] = number
+                last[5].append(document.metadata["chunk"])
+                last[6].extend(document.metadata.get("duplicates", []))
+            # The same chunk found twice is only written once
+            last[0] = min(last[0], rank)
+            continue
+
+        spans.append(
+            [
+                rank,
+                source,
+                number,
+                number,
+                document.page_content,
+                [document.metadata["chunk"]],
+                list(document.metadata.get("duplicates", [])),
+            ]
+        )
+
+    merged = []
+    for rank, source, _, _, text, chunk_names, duplicates in spans:
+        metadata = {"source": source, "chunk": chunk_names[0], "chunks": chunk_names}
+        if duplicates:
+            metadata["duplicates"] = duplicates
+        merged.append((rank, Document(page_content=text, metadata=metadata)))
+
+    return [document for _, document in sorted(merged + others, key=lambda item: item[0])]
+
+
+def context_window(llm: LLM) -> Tuple[int, int]:
+    """
+    Finds the context window of an LLM, and the part of it its answer can take.
+
+    Args:
+        - llm (LLM): The LLM (LlamaCpp, or the stand-in LLM).
+
+    Returns:
+        - Tuple[int, int]: The number of tokens of the context window (n_ctx) and the maximum number of tokens of an answer.
+    """
+
+    return getattr(llm, "n_ctx", None) or 512, getattr(llm, "max_tokens", None) or 256
+
+
+def pack_context(
+    documents: List[Document],
+    query: str,
+    count_tokens: Callable[[str], int],
+    n_ctx: int,
+    max_answer_tokens: int,
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    Merges the chunks found for a query into spans, and keeps as many spans as the prompt has room for.
+
+    Args:
+        - documents (List[Document]): The chunks found by the similarity search, most similar first.
+        - query (str): The query to answer.
+        - count_tokens (Callable[[str], int]): Counts the tokens of a text with the tokenizer of the LLM.
+        - n_ctx (int): Number of tokens of the context window of the LLM.
+        - max_answer_tokens (int): Number of tokens of the context window left for the answer.
+
+    Returns:
+        - Tuple[List[Document], Dict[str, int]]: The spans to answer from, the span of the most similar chunk first,
+          and the numbers of chunks found, of spans and of spans kept, the token budget of the prompt,
+          the tokens of the prompt of the chunks as they were found and of the packed prompt, and the tokens saved.
+    """
+
+    budget = n_ctx - max_answer_tokens
+    spans = merge_chunks(documents)
+
+    packed: List[Document] = []
+    prompt_tokens = count_tokens(qa_prompt(packed, query))
+    for span in spans:
+        # Spans that do not fit are skipped: a shorter one after them may still fit
+        tokens = count_tokens(qa_prompt(packed + [span], query))
+        if tokens <= budget:
+            packed.append(span)
+            prompt_tokens = tokens
+
+    unpacked_prompt_tokens = count_tokens(qa_prompt(documents, query))
+
+    return packed, {
+        "chunks": len(documents),
+        "spans": len(spans),
+        "packed_spans": len(packed),
+        "budget_tokens": budget,
+        "unpacked_prompt_tokens": unpacked_prompt_tokens,
+        "prompt_tokens": prompt_tokens,
+        "saved_prompt_tokens": unpacked_prompt_tokens - prompt_tokens,
+    }
@@ -0,0 +1,256 @@
+"""
+    This code defines the PromptPrefixCache class, which keeps llama.cpp states evaluated up to the common prefixes
+    of the question-answering prompts, so the model only evaluates what comes after them.
+
+    Every prompt of the "stuff" question-answering chain starts with the same instructions, then the retrieved chunks
+    (the most similar first, so the same chunks often come first for related queries), then the question.
+    Evaluating that prompt is most of the time to the first token, and its beginning is the same from one query to the next.
+
+    Before a generation, the cache:
+        tokenizes the prompt and finds its prefix boundaries: the end of the instructions,
+        and the end of each of its first chunks (qa_prompt_prefixes),
+        restores the snapshot of the longest of these prefixes it holds (llama_cpp.Llama.load_state),
+        evaluates the prompt up to each boundary it does not hold yet, saving a snapshot (llama_cpp.Llama.save_state) at each, and
+        leaves the model evaluated up to the last boundary, so the generation only evaluates the rest of the prompt
+        (llama_cpp.Llama.generate keeps the tokens it already evaluated when the prompt starts with them).
+
+    The snapshots are keyed by their tokens, so a snapshot is only ever restored for a prompt that starts with exactly those tokens.
+    They are evicted least recently used first, so their total size stays under a memory budget.
+
+    The cache counts, overall (stats) and for the last generation of the calling thread (last_request_stats),
+    the lookups that restored a snapshot and the prompt tokens they saved from being evaluated.
+
+    Stand-in models do not evaluate prompts and generate without it.
+"""
+
+import threading
+from collections import OrderedDict
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.chains.question_answering.stuff_prompt import PROMPT
+
+
+# The instructions before the chunks, and the text between the chunks and the question
+_PROMPT_HEAD, _PROMPT_REST = PROMPT.template.split("{context}")
+_PROMPT_QUESTION = _PROMPT_REST.split("{question}")[0]
+_CONTEXT_SEPARATOR = "\n\n"
+
+# The logits of a snapshot are a Python list: a float object and its slot in the list
+_LOGIT_BYTES = 32
+
+
+def qa_prompt_prefixes(prompt: str, max_documents: int = 1) -> List[str]:
+    """
+    Finds the prefixes of a question-answering prompt worth caching.
+
+    Args:
+        - prompt (str): The prompt of the "stuff" question-answering chain.
+        - max_documents (int): Number of chunks, from the first one, to end a prefix at.
+
+    Returns:
+        - List[str]: The instructions, then the instructions and each of the first max_documents chunks. Empty for another prompt.
+    """
+
+    context_end = prompt.rfind(_PROMPT_QUESTION)
+    if not prompt.startswith(_PROMPT_HEAD) or context_end < len(_PROMPT_HEAD):
+        return []
+
+    prefixes = [_PROMPT_HEAD]
+    position = len(_PROMPT_HEAD)
+    for _ in range(max_documents):
+        # A chunk containing the separator only ends a prefix earlier: any prefix of the prompt is a valid key
+        separator = prompt.find(_CONTEXT_SEPARATOR, position, context_end)
+        if separator == -1:
+            break
+        position = separator + len(_CONTEXT_SEPARATOR)
+        prefixes.append(prompt[:position])
+
+    return prefixes
+
+
+def _common_prefix_length(a: List[int], b: List[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _state_size(state: Any) -> int:
+    size = getattr(state, "llama_state_size", None)
+    if size is None:
+        size = len(state.llama_state)
+    return size + _LOGIT_BYTES * sum(len(logits) for logits in getattr(state, "eval_logits", ()))
+
+
+class PromptPrefixCache:
+    """
+    Snapshots of a llama.cpp model evaluated up to the prefixes of the question-answering prompts, least recently used evicted first.
+
+    Args:
+        - max_bytes (int): Memory budget of the snapshots, in bytes. 0 disables the cache.
+        - max_documents (int): Number of chunks, from the first one, a snapshot can end at.
+    """
+
+    def __init__(self, max_bytes: int, max_documents: int = 1) -> None:
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+
+        self._states: "OrderedDict[Tuple[int, ...], Any]" = OrderedDict()
+        self._sizes: Dict[Tuple[int, ...], int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._last_request = threading.local()
+
+        self._lookups = 0
+        self._hits = 0
+        self._prompt_tokens = 0
+        self._saved_tokens = 0
+        self._snapshots = 0
+        self._evictions = 0
+
+    def _get(self, key: Tuple[int, ...], shorter_keys: List[Tuple[int, ...]]) -> Optional[Any]:
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                # The shorter prefixes of a prompt are shared by more prompts: they are evicted last
+                for shorter_key in reversed(shorter_keys):
+                    if shorter_key in self._states:
+                        self._states.move_to_end(shorter_key)
+            return state
+
+    def _put(self, key: Tuple[int, ...], state: Any) -> None:
+        size = _state_size(state)
+
+        with self._lock:
+            if size > self.max_bytes or key in self._states:
+                return
+
+            while self._states and self._bytes + size > self.max_bytes:
+                evicted, _ = self._states.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted)
+                self._evictions += 1
+
+            self._states[key] = state
+            self._sizes[key] = size
+            self._bytes += size
+            self._snapshots += 1
+
+    def prepare(self, llama: Any, prompt: str) -> Dict[str, object]:
+        """
+        Leaves a model evaluated up to the longest cacheable prefix of a prompt, restoring or saving its snapshots.
+        The caller must hold the lock of the model until the generation of the prompt is over.
+
+        Args:
+            - llama (llama_cpp.Llama): The model about to generate an answer to the prompt.
+            - prompt (str): The prompt.
+
+        Returns:
+            - Dict[str, object]: Whether a snapshot was restored, the tokens of the prompt,
+              and the tokens the snapshot saved from being evaluated.
+        """
+
+        request = {"hit": False, "prompt_tokens": 0, "saved_tokens": 0}
+
+        prefixes = qa_prompt_prefixes(prompt, self.max_documents) if self.max_bytes > 0 else []
+        if prefixes:
+            tokens = llama.tokenize(prompt.encode("utf-8"))
+            request["prompt_tokens"] = len(tokens)
+
+            # A prefix may tokenize differently at its end than inside the prompt: only the tokens both agree on are kept,
+            # and the last token of the prompt is always left to the generation
+            boundaries = sorted(
+                {
+                    min(
+                        _common_prefix_length(llama.tokenize(prefix.encode("utf-8")), tokens),
+                        len(tokens) - 1,
+                    )
+                    for prefix in prefixes
+                }
+                - {0}
+            )
+
+            position = 0
+            for i in reversed(range(len(boundaries))):
+                boundary = boundaries[i]
+                state = self._get(
+                    tuple(tokens[:boundary]), [tuple(tokens[:shorter]) for shorter in boundaries[:i]]
+                )
+                if state is not None:
+                    llama.load_state(state)
+                    position = boundary
+                    request["hit"] = True
+                    request["saved_tokens"] = boundary
+                    break
+
+            if position == 0:
+                llama.reset()
+            for boundary in boundaries:
+                if boundary <= position:
+                    continue
+                llama.eval(tokens[position:boundary])
+                position = boundary
+                self._put(tuple(tokens[:boundary]), llama.save_state())
+
+            with self._lock:
+                self._lookups += 1
+                self._hits += int(request["hit"])
+                self._prompt_tokens += request["prompt_tokens"]
+                self._saved_tokens += request["saved_tokens"]
+
+        self._last_request.stats = request
+        return dict(request)
+
+    def last_request_stats(self) -> Optional[Dict[str, object]]:
+        """
+        Reports the last prompt prepared by the calling thread.
+
+        Returns:
+            - Optional[Dict[str, object]]: The stats returned by prepare, or None if the thread never prepared a prompt.
+        """
+
+        stats = getattr(self._last_request, "stats", None)
+        return dict(stats) if stats is not None else None
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Reports the use of the cache since it was created.
+
+        Returns:
+            - Dict[str, object]: The lookups and the ones that restored a snapshot (and their rate),
+              the prompt tokens looked up and the ones saved from being evaluated (and their rate),
+              the snapshots held, saved and evicted, and the bytes they take.
+        """
+
+        with self._lock:
+            return {
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "hit_rate": self._hits / self._lookups if self._lookups else 0.0,
+                "prompt_tokens": self._prompt_tokens,
+                "saved_tokens": self._saved_tokens,
+                "saved_token_rate": self._saved_tokens / self._prompt_tokens
+                if self._prompt_tokens
+                else 0.0,
+                "snapshots": len(self._states),
+                "snapshots_saved": self._snapshots,
+                "evictions": self._evictions,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self) -> None:
+        """
+        Drops every snapshot.
+
+        Returns:
+            - None
+        """
+
+        with self._lock:
+            self._states.clear()
+            self._sizes.clear()
+            self._bytes = 0
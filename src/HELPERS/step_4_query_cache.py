@@ -0,0 +1,359 @@
+"""
+    This code defines the two caches STEP 4 answers repeated questions from.
+
+    The QueryEmbeddingCache class wraps the embeddings model with an in-memory cache of the embeddings of the last
+    max_entries queries, least recently used evicted first, so a repeated query is not embedded by the model again.
+
+    The AnswerCache class is a persistent on-disk cache of the answers of the LLM, stored in a single sqlite3 file
+    inside the cache directory (like the EmbeddingsCache of STEP 2). Each answer is keyed by:
+        the normalized query (normalize_query: lowercased, with its spaces and final punctuation collapsed),
+        the chunks it was answered from, in the order of the prompt (document_ids),
+        the identity of the GGML model (its path, size and modification time), and
+        the identity of the vectorstore (vectorstore_identity: the names, sizes and modification times of its files).
+    Rebuilding or updating the vectorstore with STEP 3 changes its identity, so the answers of the previous vectorstore
+    are never returned, and they are deleted the next time the cache is opened.
+
+    The query is still searched before its answer is looked up, so the chunks it would be answered from are part of the key.
+
+    Both caches count their hits and misses (stats).
+"""
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from typing import Dict, List, Optional
+
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+
+from HELPERS.step_2_embeddings_cache import model_identity
+from HELPERS.step_3_save_vectorstore import saved_vectorstore_path
+from HELPERS.step_3_shards import SHARDS_MANIFEST_SUFFIX, load_shards_manifest
+
+
+ANSWER_CACHE_FILE_NAME = "answer_cache.sqlite3"
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query, so near-identical queries share their cached answers.
+
+    Args:
+        - query (str): The query.
+
+    Returns:
+        - str: The query lowercased, with every run of spaces collapsed into one and without its final punctuation.
+    """
+
+    return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?!.").rstrip()
+
+
+def document_ids(documents: List[Document]) -> List[str]:
+    """
+    Identifies the chunks a list of documents is made of.
+
+    Args:
+        - documents (List[Document]): The documents, with the "source" and "chunk" (or "chunks", for merged spans) metadata of STEP 3.
+
+    Returns:
+        - List[str]: "<source>/<chunk>" for each document (with every chunk of a merged span), or a hash of its text
+          for a document without chunk metadata.
+    """
+
+    ids = []
+    for document in documents:
+        chunks = document.metadata.get("chunks") or [document.metadata.get("chunk")]
+        if "source" in document.metadata and all(chunks):
+            ids.append(f"{document.metadata['source']}/{'+'.join(chunks)}")
+        else:
+            ids.append(hashlib.sha256(document.page_content.encode("utf-8")).hexdigest())
+    return ids
+
+
+def vectorstore_identity(path_to_vectorstore: str) -> str:
+    """
+    Builds a string identifying a saved vectorstore (or its shards) by the names, sizes and modification times of its files.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the (unsharded) vectorstore.
+
+    Returns:
+        - str: The identity of the vectorstore. A vectorstore that does not exist on disk is identified by its path alone.
+    """
+
+    shards_manifest = load_shards_manifest(path_to_vectorstore)
+    folders = shards_manifest["shards"] if shards_manifest is not None else [path_to_vectorstore]
+
+    files = []
+    if shards_manifest is not None:
+        files.append(os.path.splitext(path_to_vectorstore)[0] + SHARDS_MANIFEST_SUFFIX)
+    for folder in map(saved_vectorstore_path, folders):
+        if os.path.isdir(folder):
+            files.extend(os.path.join(folder, name) for name in sorted(os.listdir(folder)))
+
+    parts = [os.path.abspath(path_to_vectorstore)]
+    for file_path in files:
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            parts.append(f"{os.path.basename(file_path)}|{stat.st_size}|{stat.st_mtime_ns}")
+
+    return "\n".join(parts)
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    Embeddings model caching the embeddings of the last queries in memory, least recently used evicted first.
+
+    Args:
+        - embeddings (Embeddings): The embeddings model that embeds the queries that are not cached.
+        - max_entries (int): Maximum number of embeddings kept.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_entries: int = 1024) -> None:
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, text: str) -> bool:
+        with self._lock:
+            return text in self._embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds a list of queries, only calling the embeddings model for the ones that are not cached.
+
+        Args:
+            - texts (List[str]): The queries to embed.
+
+        Returns:
+            - List[List[float]]: The embedding of each query.
+        """
+
+        results: List[Optional[List[float]]] = []
+        with self._lock:
+            for text in texts:
+                vector = self._embeddings.get(text)
+                if vector is not None:
+                    self._embeddings.move_to_end(text)
+                results.append(vector)
+
+        # A query repeated in the same batch is embedded once
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, results) if vector is None))
+        vectors = dict(zip(missing, self.embeddings.embed_documents(missing))) if missing else {}
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            for text, vector in vectors.items():
+                self._embeddings[text] = vector
+                self._embeddings.move_to_end(text)
+            while len(self._embeddings) > self.max_entries:
+                self._embeddings.popitem(last=False)
+
+        return [vector if vector is not None else vectors[text] for text, vector in zip(texts, results)]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query, only calling the embeddings model if it is not cached.
+
+        Args:
+            - text (str): The query to embed.
+
+        Returns:
+            - List[float]: The embedding of the query.
+        """
+
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Reports the use of the cache.
+
+        Returns:
+            - Dict[str, object]: The number of cached embeddings, the hits, the misses and the hit rate.
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._embeddings),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class AnswerCache:
+    """
+    Persistent, size-bounded cache of answers keyed by normalized query, chunks, model identity and vectorstore identity.
+
+    Args:
+        - cache_directory (str): Path to the directory where the cache file will be saved.
+        - model_path (str): Path to the GGML model the answers are generated with.
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the vectorstore the chunks are found in.
+        - max_entries (int): Maximum number of answers kept before the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_directory: str,
+        model_path: str,
+        path_to_vectorstore: str,
+        max_entries: int = 100_000,
+    ) -> None:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.model_identity = model_identity(model_path)
+        self.vectorstore_identity = vectorstore_identity(path_to_vectorstore)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # Used by the search thread and the generation threads of the query service, one at a time
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(cache_directory, ANSWER_CACHE_FILE_NAME), check_same_thread=False
+        )
+        # Every hit updates its entry: with a write-ahead log, a commit does not wait for the disk
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, vectorstore TEXT NOT NULL, answer TEXT NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)"
+        )
+        # The answers of a vectorstore that was rebuilt since can never be found again
+        self._connection.execute(
+            "DELETE FROM answers WHERE vectorstore != ?", (self._vectorstore_key(),)
+        )
+        self._connection.commit()
+        self._clock = self._connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM answers"
+        ).fetchone()[0]
+
+    def _vectorstore_key(self) -> str:
+        return hashlib.sha256(self.vectorstore_identity.encode("utf-8")).hexdigest()
+
+    def _key(self, query: str, documents: List[Document]) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                [
+                    self.model_identity,
+                    self.vectorstore_identity,
+                    normalize_query(query),
+                    document_ids(documents),
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get(self, query: str, documents: List[Document]) -> Optional[str]:
+        """
+        Looks up the answer to a query from a list of documents.
+
+        Args:
+            - query (str): The query.
+            - documents (List[Document]): The documents the query is answered from, in the order of the prompt.
+
+        Returns:
+            - Optional[str]: The cached answer, or None if it is not cached.
+        """
+
+        key = self._key(query, documents)
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT answer FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE answers SET last_used = ? WHERE key = ?", (self._tick(), key)
+            )
+            self._connection.commit()
+
+        return row[0]
+
+    def put(self, query: str, documents: List[Document], answer: str) -> None:
+        """
+        Stores the answer to a query from a list of documents, and evicts the least recently used answers if the cache is full.
+
+        Args:
+            - query (str): The query.
+            - documents (List[Document]): The documents the query was answered from, in the order of the prompt.
+            - answer (str): The answer.
+
+        Returns:
+            - None
+        """
+
+        key = self._key(query, documents)
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers (key, vectorstore, answer, last_used) VALUES (?, ?, ?, ?)",
+                (key, self._vectorstore_key(), answer, self._tick()),
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self) -> None:
+        count = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        self._connection.execute(
+            "DELETE FROM answers WHERE key IN "
+            "(SELECT key FROM answers ORDER BY last_used ASC LIMIT ?)",
+            (count - self.max_entries,),
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Reports the use of the cache.
+
+        Returns:
+            - Dict[str, object]: The number of cached answers, the hits, the misses and the hit rate.
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self) -> None:
+        """
+        Commits pending writes and closes the cache file.
+
+        Returns:
+            - None
+        """
+
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
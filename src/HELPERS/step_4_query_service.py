@@ -0,0 +1,557 @@
+"""
+    This code defines the QueryService class and the serve_query_service function used by STEP 4 to answer
+    queries from a long-running process, instead of loading the models and the vectorstore for every question.
+
+    The QueryService class keeps the embeddings model, the FAISS vectorstore and the LLM in memory and:
+        collects the queries that arrive at the same time (up to max_batch_size queries, or max_wait_ms milliseconds),
+        embeds them with a single embed_documents call and searches them with a single FAISS search (micro-batching),
+        then answers each of them with the question-answering chain, with at most max_concurrent_generations
+        generations running at once so the LLM is never oversubscribed.
+
+    The serve_query_service function exposes a QueryService as a small JSON over HTTP/1.1 server,
+    on a TCP host and port or on a Unix socket, with the routes:
+        GET /health returns the status of the service, the number of indexed chunks, and the loaded models
+        with the hit rate and the prompt tokens saved by their prompt prefix cache,
+        POST /search {"query": "..."} returns the most similar chunks to the query, and
+        POST /query {"query": "..."} returns the answer to the query and the chunks it was answered from, and
+        POST /query/stream {"query": "..."} streams the answer token by token, as JSON lines (chunked transfer encoding):
+        first the chunks, then one {"token": "..."} line per token, then the time to first token and tokens per second.
+    A streamed answer is cancelled as soon as its client disconnects, so the LLM does not keep generating for nobody.
+
+    With a QueryEmbeddingCache as its embeddings model, a repeated query skips the batching window (it has nothing to embed),
+    and with an AnswerCache, a query already answered from the same chunks is answered without the LLM
+    (see HELPERS/step_4_query_cache.py).
+"""
+
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from langchain import FAISS
+from langchain.llms.base import LLM
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+from langchain.chains.question_answering import load_qa_chain
+
+from HELPERS.model_registry import model_registry_stats, prompt_cache_stats
+from HELPERS.step_3_quantization import ExactReranker
+from HELPERS.step_4_query_cache import AnswerCache, QueryEmbeddingCache
+from HELPERS.step_4_batch_search import batch_similarity_search
+from HELPERS.step_4_sharded_search import ShardedVectorstore, vectorstore_size
+from HELPERS.step_4_streaming_answers import AnswerStream
+
+
+MAX_REQUEST_BODY_SIZE = 1024 * 1024
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+def document_to_dict(document: Document) -> Dict[str, object]:
+    """
+    Converts a Document to a JSON serializable dict.
+
+    Args:
+        - document (Document): The document to convert.
+
+    Returns:
+        - Dict[str, object]: The page content and the metadata of the document.
+    """
+
+    return {"page_content": document.page_content, "metadata": document.metadata}
+
+
+class QueryService:
+    """
+    Answers queries against a resident vectorstore, micro-batching the searches of concurrent queries.
+
+    Args:
+        - embeddings (Embeddings): The embeddings model used to embed the queries.
+        - vectorstore (Union[FAISS, ShardedVectorstore]): The FAISS vectorstore, or the shards of a vectorstore, to search.
+        - llm (Optional[LLM]): The LLM used to answer the queries. If None, the service only searches.
+        - k (int): Number of documents returned per query.
+        - max_batch_size (int): Maximum number of queries embedded and searched together.
+        - max_wait_ms (float): Maximum time the first query of a batch waits for more queries.
+        - max_concurrent_generations (int): Maximum number of answers generated at once.
+        - reranker (Optional[ExactReranker]): Re-ranks the candidates of a quantized index by exact distance. If None, the index results are kept.
+        - rerank_candidates (int): Number of candidates per query searched in the index before re-ranking.
+        - answer_cache (Optional[AnswerCache]): The answers already generated. If None, every query is answered by the LLM.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        vectorstore: Union[FAISS, ShardedVectorstore],
+        llm: Optional[LLM] = None,
+        k: int = 4,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5,
+        max_concurrent_generations: int = 1,
+        reranker: Optional[ExactReranker] = None,
+        rerank_candidates: int = 32,
+        answer_cache: Optional[AnswerCache] = None,
+    ) -> None:
+        self.embeddings = embeddings
+        self.vectorstore = vectorstore
+        self.llm = llm
+        self.k = k
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self.max_concurrent_generations = max(1, max_concurrent_generations)
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.answer_cache = answer_cache
+
+        # Loaded once, reused by every query
+        self.chain = load_qa_chain(llm, chain_type="stuff") if llm is not None else None
+
+        # The embeddings model is used by one batch at a time, the LLM by at most max_concurrent_generations queries
+        self._search_executor = ThreadPoolExecutor(max_workers=1)
+        self._generation_executor = ThreadPoolExecutor(
+            max_workers=self.max_concurrent_generations
+        )
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._generations: Optional[asyncio.Semaphore] = None
+
+        self.searched_queries = 0
+        self.searched_batches = 0
+
+    async def start(self) -> None:
+        """
+        Starts the task that collects the queries into batches. Must be called from the running event loop.
+
+        Returns:
+            - None
+        """
+
+        if self._batcher is not None:
+            return
+
+        self._queue = asyncio.Queue()
+        self._generations = asyncio.Semaphore(self.max_concurrent_generations)
+        self._batcher = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def close(self) -> None:
+        """
+        Stops the batching task and the executors.
+
+        Returns:
+            - None
+        """
+
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+
+        self._search_executor.shutdown(wait=False)
+        self._generation_executor.shutdown(wait=False)
+
+    async def _collect_batch(self) -> List[Tuple[str, asyncio.Future]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Take whatever else is already waiting, without waiting any longer
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+        return batch
+
+    def _search_batch(self, queries: List[str]) -> List[List[Document]]:
+        query_embeddings = self.embeddings.embed_documents(queries)
+        return batch_similarity_search(
+            self.vectorstore,
+            query_embeddings,
+            k=self.k,
+            reranker=self.reranker,
+            rerank_candidates=self.rerank_candidates,
+        )
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._collect_batch()
+            queries = [query for query, _ in batch]
+
+            try:
+                results = await loop.run_in_executor(
+                    self._search_executor, self._search_batch, queries
+                )
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            self.searched_queries += len(batch)
+            self.searched_batches += 1
+            for (_, future), documents in zip(batch, results):
+                # The caller may have given up on the query in the meantime
+                if not future.done():
+                    future.set_result(documents)
+
+    async def search(self, query: str) -> List[Document]:
+        """
+        Finds the k most similar documents to a query, in a batch with the other queries arriving at the same time.
+
+        Args:
+            - query (str): The query to search for.
+
+        Returns:
+            - List[Document]: The most similar documents to the query.
+        """
+
+        await self.start()
+
+        if isinstance(self.embeddings, QueryEmbeddingCache) and query in self.embeddings:
+            # Nothing to embed: waiting for other queries to batch with would only add latency
+            self.searched_queries += 1
+            return (
+                await asyncio.get_running_loop().run_in_executor(
+                    self._search_executor, self._search_batch, [query]
+                )
+            )[0]
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, future))
+
+        return await future
+
+    async def answer(self, query: str) -> Tuple[str, List[Document]]:
+        """
+        Answers a query with the question-answering chain, from the k most similar documents to the query.
+
+        Args:
+            - query (str): The query to answer.
+
+        Returns:
+            - Tuple[str, List[Document]]: The answer and the documents it was answered from.
+        """
+
+        if self.chain is None:
+            raise ValueError("This query service has no LLM to answer queries with")
+
+        answer_docs = await self.search(query)
+
+        answer = await self.cached_answer(query, answer_docs)
+        if answer is not None:
+            return answer, answer_docs
+
+        async with self._generations:
+            answer = await asyncio.get_running_loop().run_in_executor(
+                self._generation_executor, self._generate_answer, query, answer_docs
+            )
+
+        return answer, answer_docs
+
+    def _generate_answer(self, query: str, answer_docs: List[Document]) -> str:
+        # Runs in a generation thread: caching the answer there keeps its SQLite writes off the event loop
+        answer = self.chain.run(input_documents=answer_docs, question=query)
+        if self.answer_cache is not None:
+            self.answer_cache.put(query, answer_docs, answer)
+        return answer
+
+    async def cached_answer(self, query: str, answer_docs: List[Document]) -> Optional[str]:
+        """
+        Looks up the answer already generated for a query from the same documents.
+        The lookup (an SQLite read and write) runs in the search thread, not in the event loop.
+
+        Args:
+            - query (str): The query.
+            - answer_docs (List[Document]): The documents found for the query.
+
+        Returns:
+            - Optional[str]: The cached answer, or None if it is not cached (or the service has no answer cache).
+        """
+
+        if self.answer_cache is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            self._search_executor, self.answer_cache.get, query, answer_docs
+        )
+
+    async def stream_answer(self, stream: AnswerStream) -> AsyncIterator[str]:
+        """
+        Streams an answer, counting it among the max_concurrent_generations answers generated at once.
+
+        Args:
+            - stream (AnswerStream): The answer to stream, e.g. AnswerStream(service.llm, await service.search(query), query).
+
+        Yields:
+            - str: The text of each token. Closing the generator cancels the answer.
+        """
+
+        if self.llm is None:
+            raise ValueError("This query service has no LLM to answer queries with")
+
+        async with self._generations:
+            tokens = stream.astream(self._generation_executor)
+            try:
+                async for token in tokens:
+                    yield token
+            finally:
+                await tokens.aclose()
+
+            # Only a whole answer is worth answering the next identical query with
+            if self.answer_cache is not None and stream.completed:
+                await asyncio.get_running_loop().run_in_executor(
+                    self._generation_executor,
+                    self.answer_cache.put,
+                    stream.query,
+                    stream.answer_docs,
+                    stream.text,
+                )
+
+
+async def _read_request(
+    reader: asyncio.StreamReader,
+) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get("content-length", 0))
+    if content_length > MAX_REQUEST_BODY_SIZE:
+        raise ValueError("Request body too large")
+    body = await reader.readexactly(content_length) if content_length else b""
+
+    return method, path, headers, body
+
+
+def _write_response(
+    writer: asyncio.StreamWriter, status: int, payload: Dict[str, object], keep_alive: bool
+) -> None:
+    body = json.dumps(payload).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+
+
+async def _route(
+    service: QueryService, method: str, path: str, body: bytes
+) -> Tuple[int, Dict[str, object]]:
+    if path == "/health":
+        if method != "GET":
+            return 405, {"error": "Use GET"}
+        return 200, {
+            "status": "ok",
+            "chunks": vectorstore_size(service.vectorstore),
+            "searched_queries": service.searched_queries,
+            "searched_batches": service.searched_batches,
+            "models": model_registry_stats(),
+            "prompt_caches": prompt_cache_stats(),
+            "query_embedding_cache": service.embeddings.stats()
+            if isinstance(service.embeddings, QueryEmbeddingCache)
+            else None,
+            # Counting the cached answers is an SQLite query, kept off the event loop
+            "answer_cache": await asyncio.get_running_loop().run_in_executor(None, service.answer_cache.stats)
+            if service.answer_cache is not None
+            else None,
+        }
+
+    if path not in ("/search", "/query"):
+        return 404, {"error": f"Unknown route {path}"}
+    if method != "POST":
+        return 405, {"error": "Use POST"}
+
+    try:
+        query = json.loads(body or b"{}")["query"]
+    except (ValueError, KeyError, TypeError):
+        return 400, {"error": 'Expected a JSON body like {"query": "..."}'}
+    if not isinstance(query, str):
+        return 400, {"error": "The query must be a string"}
+
+    if path == "/search":
+        documents = await service.search(query)
+        return 200, {"documents": [document_to_dict(d) for d in documents]}
+
+    if service.chain is None:
+        return 400, {"error": "This query service has no LLM to answer queries with"}
+    answer, documents = await service.answer(query)
+    return 200, {
+        "answer": answer,
+        "documents": [document_to_dict(d) for d in documents],
+    }
+
+
+def _write_chunk(writer: asyncio.StreamWriter, payload: Dict[str, object]) -> None:
+    line = json.dumps(payload).encode("utf-8") + b"\n"
+    writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+
+
+async def _stream_route(
+    service: QueryService, method: str, body: bytes, writer: asyncio.StreamWriter, keep_alive: bool
+) -> None:
+    if method != "POST":
+        _write_response(writer, 405, {"error": "Use POST"}, keep_alive)
+        return
+    try:
+        query = json.loads(body or b"{}")["query"]
+    except (ValueError, KeyError, TypeError):
+        _write_response(writer, 400, {"error": 'Expected a JSON body like {"query": "..."}'}, keep_alive)
+        return
+    if not isinstance(query, str):
+        _write_response(writer, 400, {"error": "The query must be a string"}, keep_alive)
+        return
+    if service.llm is None:
+        _write_response(writer, 400, {"error": "This query service has no LLM to answer queries with"}, keep_alive)
+        return
+
+    # Nothing was sent yet: a failure is still answered with an error response, like the other routes
+    try:
+        documents = await service.search(query)
+        cached_answer = await service.cached_answer(query, documents)
+    except Exception as error:
+        _write_response(writer, 500, {"error": str(error)}, keep_alive)
+        return
+
+    writer.write(
+        (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/x-ndjson\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            "\r\n"
+        ).encode("latin-1")
+    )
+    _write_chunk(writer, {"documents": [document_to_dict(d) for d in documents]})
+
+    if cached_answer is not None:
+        # The whole answer at once
+        _write_chunk(writer, {"token": cached_answer})
+        _write_chunk(writer, {"stats": {"cached": True}})
+        writer.write(b"0\r\n\r\n")
+        return
+
+    stream = AnswerStream(service.llm, documents, query)
+    tokens = service.stream_answer(stream)
+    try:
+        async for token in tokens:
+            _write_chunk(writer, {"token": token})
+            # Raises ConnectionError once the client is gone, which cancels the answer
+            await writer.drain()
+        _write_chunk(writer, {"stats": {**stream.stats(), "cached": False}})
+    except ConnectionError:
+        raise
+    except Exception as error:
+        _write_chunk(writer, {"error": str(error)})
+    finally:
+        await tokens.aclose()
+
+    writer.write(b"0\r\n\r\n")
+
+
+async def _handle_connection(
+    service: QueryService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError) as error:
+                status = 413 if "too large" in str(error) else 400
+                _write_response(writer, status, {"error": str(error)}, False)
+                break
+            if request is None:
+                break
+
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+
+            if path.split("?")[0] == "/query/stream":
+                await _stream_route(service, method, body, writer, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+                continue
+
+            try:
+                status, payload = await _route(service, method, path.split("?")[0], body)
+            except Exception as error:
+                status, payload = 500, {"error": str(error)}
+
+            _write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_query_service(
+    service: QueryService,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: Optional[str] = None,
+) -> None:
+    """
+    Serves a QueryService over HTTP/1.1 until the task is cancelled.
+
+    Args:
+        - service (QueryService): The query service to serve.
+        - host (str): Host to listen on.
+        - port (int): Port to listen on.
+        - unix_socket (Optional[str]): Path of a Unix socket to listen on instead of the host and port.
+
+    Returns:
+        - None
+    """
+
+    await service.start()
+
+    def handler(reader, writer):
+        return _handle_connection(service, reader, writer)
+
+    if unix_socket:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        print(f"\n############# SERVING QUERIES ON {unix_socket} #############\n")
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print(f"\n############# SERVING QUERIES ON http://{host}:{port} #############\n")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
@@ -0,0 +1,315 @@
+"""
+    This code defines the ShardedVectorstore class used by STEP 4 to search a vectorstore split into shards by STEP 3
+    (see HELPERS/step_3_shards.py).
+
+    Every shard is loaded by its own worker process, started when the ShardedVectorstore is created,
+    so the shards are held in the memory of several processes and searched at the same time.
+    A search embeds the queries once, in the calling process, then:
+        sends the query embeddings to every worker,
+        every worker searches its shard for the k most similar chunks of each query (with the search-time parameters,
+        and the exact re-ranking of a quantized index, its shard was saved with) and sends back their distances and Documents, and
+        the k closest of the N * k results of each query are kept.
+    Since every chunk is in exactly one shard and every shard returns its own k closest chunks, the k closest of all of them
+    are the k closest chunks of the whole vectorstore: the results are the same as the search of the unsharded vectorstore
+    (only chunks at exactly the same distance can come in another order).
+
+    The load_search_vectorstore function opens the vectorstore STEP 4 searches: the shards if STEP 3 saved any,
+    the single vectorstore otherwise, with its search-time parameters and its reranker.
+"""
+
+import os
+import signal
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import Connection
+
+from typing import Callable, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain import FAISS
+from langchain.schema import Document
+from langchain.embeddings.base import Embeddings
+
+from HELPERS.model_registry import LazyEmbeddings
+from HELPERS.step_3_build_vectorstore import apply_search_parameters
+from HELPERS.step_3_quantization import ExactReranker, load_exact_reranker
+from HELPERS.step_3_save_vectorstore import (
+    load_index_params,
+    load_vectorstore,
+    saved_vectorstore_path,
+)
+from HELPERS.step_3_shards import load_shards_manifest
+
+
+def _search_shard(
+    vectorstore: FAISS,
+    reranker: Optional[ExactReranker],
+    rerank_candidates: int,
+    query_embeddings: np.ndarray,
+    k: int,
+) -> Tuple[np.ndarray, List[List[Document]]]:
+    if reranker is None:
+        distances, indices = vectorstore.index.search(query_embeddings, k)
+        if vectorstore.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            # The most similar first, like the L2 distances the results are merged by
+            distances = -distances
+    else:
+        _, candidates = vectorstore.index.search(query_embeddings, max(k, rerank_candidates))
+        distances, indices = reranker.rerank(query_embeddings, candidates, k, return_distances=True)
+
+    # Only the missing results are infinitely far: a candidate without an exact vector is still a result
+    distances = np.minimum(distances, np.finfo(np.float32).max)
+    distances = np.where(indices == -1, np.inf, distances).astype(np.float32)
+
+    documents = []
+    for row in indices:
+        # The missing results (-1) come last
+        documents.append(
+            [
+                vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+                for i in row
+                if i != -1
+            ]
+        )
+
+    return distances, documents
+
+
+def _shard_worker(connection: Connection, path_to_shard: str, omp_threads: int) -> None:
+    # Ctrl+C reaches the whole process group: the parent process stops the workers itself, with close
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        faiss.omp_set_num_threads(omp_threads)
+        path_to_shard = saved_vectorstore_path(path_to_shard)
+
+        # The queries are embedded by the parent process: the embeddings model is never loaded here
+        vectorstore = load_vectorstore(path_to_shard, LazyEmbeddings(model_path=""))
+        index_params = load_index_params(path_to_shard)
+        apply_search_parameters(
+            vectorstore.index,
+            nprobe=index_params.get("nprobe"),
+            ef_search=index_params.get("ef_search"),
+        )
+        reranker = load_exact_reranker(path_to_shard)
+        rerank_candidates = index_params.get("rerank_candidates", 32)
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+        return
+
+    connection.send(("ready", vectorstore.index.ntotal))
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+
+        query_embeddings, k = message
+        try:
+            result = _search_shard(vectorstore, reranker, rerank_candidates, query_embeddings, k)
+            connection.send(("ok", result))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+
+class ShardedVectorstore:
+    """
+    Searches the shards of a vectorstore in parallel, one worker process per shard, and merges their results.
+
+    Args:
+        - shard_paths (List[str]): Paths to the ".faiss" folders of the shards.
+        - embedding_function (Callable[[str], List[float]]): Embeds a query, for similarity_search.
+    """
+
+    def __init__(
+        self, shard_paths: List[str], embedding_function: Callable[[str], List[float]]
+    ) -> None:
+        self.shard_paths = shard_paths
+        self.embedding_function = embedding_function
+
+        # Spawned rather than forked: a forked child can inherit locks held by the OpenMP threads of FAISS
+        context = multiprocessing.get_context("spawn")
+        omp_threads = max(1, (os.cpu_count() or 1) // len(shard_paths))
+
+        self._connections: List[Connection] = []
+        self._processes = []
+        for path_to_shard in shard_paths:
+            connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=_shard_worker,
+                args=(child_connection, path_to_shard, omp_threads),
+                daemon=True,
+            )
+            process.start()
+            child_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+        # One search at a time goes through the pipes
+        self._lock = threading.Lock()
+
+        try:
+            self.shard_sizes = self._receive_all()
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def ntotal(self) -> int:
+        """
+        The number of chunks of every shard.
+        """
+
+        return sum(self.shard_sizes)
+
+    def _receive_all(self) -> List[object]:
+        results = []
+        errors = []
+        for path_to_shard, connection in zip(self.shard_paths, self._connections):
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                status, result = "error", "the worker process exited"
+            if status == "error":
+                errors.append(f"{path_to_shard}: {result}")
+            results.append(result)
+
+        if errors:
+            raise RuntimeError("The shard workers failed:\n" + "\n".join(errors))
+        return results
+
+    def search(self, query_embeddings: List[List[float]], k: int = 4) -> List[List[Document]]:
+        """
+        Finds the k most similar documents to each of several query embeddings in every shard.
+
+        Args:
+            - query_embeddings (List[List[float]]): The embedding of each query.
+            - k (int): Number of documents to return per query.
+
+        Returns:
+            - List[List[Document]]: The most similar documents to each query, most similar first.
+        """
+
+        if not len(query_embeddings):
+            return []
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+
+        with self._lock:
+            # Every shard is searched at the same time
+            for connection in self._connections:
+                connection.send((queries, k))
+            shard_results = self._receive_all()
+
+        # (queries, shards * k) distances, with the documents of every shard side by side
+        distances = np.concatenate([shard_distances for shard_distances, _ in shard_results], axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+        results = []
+        for i, row in enumerate(order):
+            documents = []
+            for position in row:
+                if not np.isfinite(distances[i, position]):
+                    continue
+                shard, rank = divmod(int(position), k)
+                documents.append(shard_results[shard][1][i][rank])
+            results.append(documents)
+
+        return results
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        """
+        Finds the k most similar documents to a query, like FAISS.similarity_search.
+
+        Args:
+            - query (str): The query to search for.
+            - k (int): Number of documents to return.
+
+        Returns:
+            - List[Document]: The most similar documents to the query, most similar first.
+        """
+
+        return self.search([self.embedding_function(query)], k=k)[0]
+
+    def close(self) -> None:
+        """
+        Stops the worker processes.
+
+        Returns:
+            - None
+        """
+
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
+        self._processes = []
+
+    def __enter__(self) -> "ShardedVectorstore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def load_search_vectorstore(
+    path_to_vectorstore: str, embeddings: Embeddings
+) -> Tuple[Union[FAISS, ShardedVectorstore], Optional[ExactReranker], int]:
+    """
+    Opens the vectorstore searched by STEP 4: its shards if STEP 3 sharded it, the single vectorstore otherwise.
+
+    Args:
+        - path_to_vectorstore (str): Path to the ".faiss" folder of the (unsharded) vectorstore.
+        - embeddings (Embeddings): The embeddings model used to embed the queries.
+
+    Returns:
+        - Tuple[Union[FAISS, ShardedVectorstore], Optional[ExactReranker], int]: The vectorstore, with its search-time parameters,
+          the reranker of a quantized index and its number of candidates. The shards re-rank their own results, so a
+          ShardedVectorstore comes without a reranker.
+    """
+
+    shards_manifest = load_shards_manifest(path_to_vectorstore)
+    if shards_manifest is not None:
+        return ShardedVectorstore(shards_manifest["shards"], embeddings.embed_query), None, 32
+
+    path_to_vectorstore = saved_vectorstore_path(path_to_vectorstore)
+    vectorstore = load_vectorstore(path_to_vectorstore, embeddings)
+    index_params = load_index_params(path_to_vectorstore)
+    apply_search_parameters(
+        vectorstore.index,
+        nprobe=index_params.get("nprobe"),
+        ef_search=index_params.get("ef_search"),
+    )
+
+    return (
+        vectorstore,
+        # A quantized index is searched in two phases, with the exact vectors saved next to it
+        load_exact_reranker(path_to_vectorstore),
+        index_params.get("rerank_candidates", 32),
+    )
+
+
+def vectorstore_size(vectorstore: Union[FAISS, ShardedVectorstore]) -> int:
+    """
+    Counts the chunks of a vectorstore, sharded or not.
+
+    Args:
+        - vectorstore (Union[FAISS, ShardedVectorstore]): The vectorstore.
+
+    Returns:
+        - int: The number of chunks.
+    """
+
+    if isinstance(vectorstore, ShardedVectorstore):
+        return vectorstore.ntotal
+    return vectorstore.index.ntotal
@@ -0,0 +1,234 @@
+"""
+    This code defines the AnswerStream class used by STEP 4 to stream the answer to a query token by token,
+    instead of waiting for the question-answering chain to return the whole answer.
+
+    The prompt is the one the "stuff" question-answering chain builds (the text of the documents, then the question),
+    and the tokens come from LlamaCpp.stream (or StandInLLM.stream) as the model generates them.
+
+    An AnswerStream can be consumed:
+        with a for loop, in the calling thread, or
+        with an async for loop over astream, which generates the tokens in a worker thread and hands them to the event loop.
+
+    It can be cancelled (cancel, or simply stopping the loop, e.g. when the client of the query service disconnects):
+    the generation stops at the next token, which also releases the model shared with the embeddings.
+
+    For every answer it records the time to the first token, the number of tokens and the tokens per second (stats),
+    with the prompt tokens the prompt prefix cache of the model saved from being evaluated (see HELPERS/step_4_prompt_cache.py),
+    and the generation is recorded as a "stream_answer" span when the instrumentation is enabled (see HELPERS/instrumentation.py).
+
+    The qa_prompt function builds the prompt of the chain, and stream_llm_tokens yields the tokens of an LLM for a prompt.
+"""
+
+import time
+import asyncio
+import threading
+from concurrent.futures import Executor
+
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain.llms.base import LLM
+from langchain.schema import Document
+from langchain.chains.question_answering.stuff_prompt import PROMPT
+
+from HELPERS.instrumentation import span
+from HELPERS.model_registry import last_prompt_cache_request
+
+
+def qa_prompt(answer_docs: List[Document], query: str) -> str:
+    """
+    Builds the prompt the "stuff" question-answering chain sends to the LLM.
+
+    Args:
+        - answer_docs (List[Document]): The documents to answer from.
+        - query (str): The query to answer.
+
+    Returns:
+        - str: The prompt.
+    """
+
+    return PROMPT.format(
+        context="\n\n".join(document.page_content for document in answer_docs),
+        question=query,
+    )
+
+
+def stream_llm_tokens(llm: LLM, prompt: str) -> Iterator[str]:
+    """
+    Yields the tokens of the answer of an LLM to a prompt, as they are generated.
+
+    Args:
+        - llm (LLM): The LLM. An LLM without a stream method yields its whole answer as a single token.
+        - prompt (str): The prompt.
+
+    Yields:
+        - str: The text of each token.
+    """
+
+    if not hasattr(llm, "stream"):
+        yield llm(prompt)
+        return
+
+    chunks = llm.stream(prompt)
+    try:
+        for chunk in chunks:
+            yield chunk["choices"][0]["text"]
+    finally:
+        # Stops the generation if the caller stopped early
+        chunks.close()
+
+
+class AnswerStream:
+    """
+    The answer to a query, streamed token by token, with its time to first token and tokens per second.
+
+    Args:
+        - llm (LLM): The LLM used to answer.
+        - answer_docs (List[Document]): The documents to answer from.
+        - query (str): The query to answer.
+    """
+
+    def __init__(self, llm: LLM, answer_docs: List[Document], query: str) -> None:
+        self.llm = llm
+        self.answer_docs = answer_docs
+        self.query = query
+        self.prompt = qa_prompt(answer_docs, query)
+
+        self.tokens: List[str] = []
+        self.completed = False
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.prompt_cache: Optional[Dict[str, object]] = None
+
+        self._cancelled = threading.Event()
+        self._started = False
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Whether the stream was cancelled before the end of the answer.
+        """
+
+        return self._cancelled.is_set()
+
+    @property
+    def text(self) -> str:
+        """
+        The answer streamed so far.
+        """
+
+        return "".join(self.tokens)
+
+    def cancel(self) -> None:
+        """
+        Stops the generation at the next token. Can be called from any thread.
+
+        Returns:
+            - None
+        """
+
+        if not self.completed:
+            self._cancelled.set()
+
+    def __iter__(self) -> Iterator[str]:
+        if self._started:
+            raise RuntimeError("An AnswerStream can only be consumed once")
+        self._started = True
+
+        self.start_time = time.perf_counter()
+        tokens = stream_llm_tokens(self.llm, self.prompt)
+
+        with span("stream_answer") as stream_span:
+            try:
+                for token in tokens:
+                    if self._cancelled.is_set():
+                        break
+                    if self.first_token_time is None:
+                        self.first_token_time = time.perf_counter()
+                        # The prompt was prepared by this thread, just before its first token
+                        self.prompt_cache = last_prompt_cache_request()
+                    self.tokens.append(token)
+                    yield token
+                else:
+                    self.completed = True
+            finally:
+                # Also reached when the caller stops iterating: the answer was not read to the end
+                if not self.completed:
+                    self._cancelled.set()
+                tokens.close()
+                self.end_time = time.perf_counter()
+                stream_span.count(tokens=len(self.tokens))
+
+    async def astream(self, executor: Optional[Executor] = None) -> AsyncIterator[str]:
+        """
+        Yields the tokens of the answer in the event loop, while they are generated in a worker thread.
+
+        Args:
+            - executor (Optional[Executor]): The executor the generation runs in. If None, the default executor of the loop.
+
+        Yields:
+            - str: The text of each token. Closing the generator (or cancelling its task) cancels the stream.
+        """
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        def put(item: object) -> None:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop is closed: nobody is reading anymore
+                self.cancel()
+
+        def generate() -> None:
+            try:
+                for token in self:
+                    put(token)
+            except Exception as error:
+                put(error)
+            put(end)
+
+        loop.run_in_executor(executor, generate)
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # The caller stopped reading (e.g. the client disconnected): the worker thread stops at the next token
+            self.cancel()
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Reports the timings of the answer.
+
+        Returns:
+            - Dict[str, object]: The time to first token and the total time in milliseconds, the number of tokens,
+              the tokens per second after the first token, whether the stream was completed or cancelled,
+              and what the prompt prefix cache saved (None for a model without one).
+        """
+
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        generation_seconds = (
+            end_time - self.first_token_time if self.first_token_time is not None else 0.0
+        )
+
+        return {
+            "time_to_first_token_ms": (self.first_token_time - self.start_time) * 1000
+            if self.first_token_time is not None
+            else None,
+            "total_ms": (end_time - self.start_time) * 1000 if self.start_time is not None else None,
+            "tokens": len(self.tokens),
+            # The first token is the end of the prompt processing, the others are the generation
+            "tokens_per_second": (len(self.tokens) - 1) / generation_seconds
+            if generation_seconds > 0
+            else 0.0,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "prompt_cache": self.prompt_cache,
+        }
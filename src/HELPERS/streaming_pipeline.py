@@ -0,0 +1,234 @@
+"""
+    This code defines the streaming ingest pipeline, which runs STEP 1, STEP 2 and STEP 3 in a single pass:
+
+        load -> split -> embed -> add to index
+
+    The documents flow through generators in fixed-size batches of chunks, so the memory used by the
+    pipeline itself is bounded by the batch size and the queue sizes, not by the size of the corpus
+    (the FAISS index and its docstore still grow with the corpus, as they do in STEP 3).
+
+    Every stage only pulls from the previous one when it is ready for more work:
+        the documents are loaded and split ahead of time in a background thread, through a bounded queue (prefetch),
+        the embedding stage pulls batches of chunks only when the model or a worker of the pool is free, and
+        the index stage adds each batch of embeddings to the FAISS index as soon as it is embedded.
+
+    Along the way, the chunks of each document are saved as JSON or to the chunk store (like STEP 1) and the embeddings are written
+    to the embeddings file (like STEP 2), so the per-step scripts can still be used on the result.
+    When a ChunkDeduplicator is given, duplicate chunks are removed before they reach the embedding stage.
+"""
+
+import queue
+import threading
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain import FAISS
+
+from HELPERS.model_registry import LazyEmbeddings
+from HELPERS.step_1_chunk_store import ChunkStoreWriter, chunk_store_path
+from HELPERS.step_1_deduplicate_chunks import ChunkDeduplicator
+from HELPERS.step_1_load_documents import iter_loaded_documents
+from HELPERS.step_1_save_chunked_docs import remove_deleted_documents, save_documents
+from HELPERS.step_2_embedding_batches import embed_chunk_batches, iter_chunk_batches
+from HELPERS.step_2_embeddings_store import EmbeddingsStoreWriter
+from HELPERS.step_3_build_vectorstore import add_to_vectorstore, build_vectorstore
+
+
+_ITEM = 0
+_END = 1
+_ERROR = 2
+
+
+def prefetch(iterable: Iterable[Any], max_buffered: int) -> Iterator[Any]:
+    """
+    Runs an iterable in a background thread, keeping at most max_buffered items ahead of the consumer.
+
+    The background thread blocks as soon as max_buffered items are waiting,
+    so a slow consumer slows the producer down instead of letting items pile up in memory.
+
+    Args:
+        - iterable (Iterable[Any]): The iterable to run in the background.
+        - max_buffered (int): Maximum number of items produced ahead of the consumer.
+
+    Yields:
+        - Any: The items of the iterable, in order.
+    """
+
+    buffer: queue.Queue = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+
+    def put(message: Tuple[int, Any]) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put((_ITEM, item)):
+                    return
+            put((_END, None))
+        except BaseException as error:
+            put((_ERROR, error))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            kind, value = buffer.get()
+            if kind == _END:
+                break
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        # Unblock the producer if the consumer stops early
+        stop.set()
+
+
+def _iter_document_chunks(
+    documents: Iterable[Dict[str, Union[str, List[Dict[str, str]]]]],
+    save_json_chunks_directory: Optional[str],
+    chunk_store_writer: Optional[ChunkStoreWriter] = None,
+) -> Iterator[Tuple[str, str, str]]:
+    # Flatten the documents into chunks, saving the chunks of each document as it passes
+    for document in documents:
+        if chunk_store_writer is not None:
+            chunk_store_writer.add_document(document)
+        elif save_json_chunks_directory:
+            save_documents(
+                documents=[document], save_json_chunks_directory=save_json_chunks_directory
+            )
+
+        for chunk in document["chunks"]:
+            for key, value in chunk.items():
+                yield document["name"], key, value
+                break
+
+
+def stream_ingest(
+    docs_directory_path: str,
+    path_to_ggml_model: str,
+    batch_size: int = 32,
+    queue_size: int = 4,
+    save_json_chunks_directory: Optional[str] = None,
+    embeddings_file_path: Optional[str] = None,
+    cache_directory: Optional[str] = None,
+    cache_max_entries: int = 1_000_000,
+    workers: int = 0,
+    threads_per_worker: Optional[int] = None,
+    loading_workers: int = 0,
+    chunk_size: int = 100,
+    chunk_overlap: int = 50,
+    tokenizer_model_path: Optional[str] = None,
+    deduplicator: Optional[ChunkDeduplicator] = None,
+    chunk_format: str = "json",
+    embeddings_dtype: str = "float32",
+) -> Optional[FAISS]:
+    """
+    Loads, splits and embeds the documents of a directory, and adds them to a FAISS index, in a single streaming pass.
+
+    Args:
+        - docs_directory_path (str): Path to directory containing documents.
+        - path_to_ggml_model (str): Path to the LlamaCppEmbeddings model.
+        - batch_size (int): Number of chunks embedded and added to the index at once.
+        - queue_size (int): Maximum number of documents loaded and split ahead of the embedding stage.
+        - save_json_chunks_directory (Optional[str]): Path to the directory where the JSON chunks are saved. If None, they are not saved.
+        - embeddings_file_path (Optional[str]): Path to the ".embeddings" file to write. If None, the embeddings are not saved.
+        - cache_directory (Optional[str]): Path to the directory of the embeddings cache. If None, no cache is used.
+        - cache_max_entries (int): Maximum number of embeddings kept in the cache.
+        - workers (int): Number of worker processes embedding the chunks. If 0, the chunks are embedded in this process.
+        - threads_per_worker (Optional[int]): Number of llama.cpp threads in each worker.
+        - loading_workers (int): Number of worker processes loading and splitting the documents. If 0, they are loaded in a background thread.
+        - chunk_size (int): Maximum size of a chunk.
+        - chunk_overlap (int): Size of the text repeated between two consecutive chunks.
+        - tokenizer_model_path (Optional[str]): Path to the GGML model whose tokenizer measures the sizes. If None, in characters.
+        - deduplicator (Optional[ChunkDeduplicator]): Removes the duplicate chunks before they are embedded. If None, every chunk is kept.
+        - chunk_format (str): "json" to save one JSON file per document, or "store" to save a single chunk store.
+        - embeddings_dtype (str): Data type of the rows of the embeddings file: "float32", "float16" or "int8".
+
+    Returns:
+        - Optional[FAISS]: FAISS index created from the documents, or None if the directory has no chunks.
+    """
+
+    documents = iter_loaded_documents(
+        docs_directory_path,
+        workers=loading_workers,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        tokenizer_model_path=tokenizer_model_path,
+    )
+    if deduplicator is not None:
+        documents = deduplicator.iter_deduplicated(documents)
+    documents = prefetch(documents, queue_size)
+
+    chunk_store_writer = None
+    if save_json_chunks_directory and chunk_format == "store":
+        chunk_store_writer = ChunkStoreWriter(chunk_store_path(save_json_chunks_directory))
+
+    embedded_batches = embed_chunk_batches(
+        batches=iter_chunk_batches(
+            chunks=_iter_document_chunks(
+                documents, save_json_chunks_directory, chunk_store_writer
+            ),
+            batch_size=batch_size,
+        ),
+        path_to_ggml_model=path_to_ggml_model,
+        cache_directory=cache_directory,
+        cache_max_entries=cache_max_entries,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+    )
+
+    writer = None
+    if embeddings_file_path:
+        writer = EmbeddingsStoreWriter(embeddings_file_path, dtype=embeddings_dtype)
+
+    faiss: Optional[FAISS] = None
+    completed = False
+
+    try:
+        for references, texts, vectors in embedded_batches:
+            if writer is not None:
+                writer.append(vectors=vectors, references=references)
+
+            if faiss is None:
+                faiss = build_vectorstore(
+                    texts=texts,
+                    embeddings=np.asarray(vectors, dtype=np.float32),
+                    references=references,
+                    embedding=LazyEmbeddings(path_to_ggml_model),
+                )
+            else:
+                add_to_vectorstore(
+                    faiss,
+                    texts=texts,
+                    embeddings=np.asarray(vectors, dtype=np.float32),
+                    references=references,
+                )
+        completed = True
+
+        # Like STEP 1, remove the JSON chunks of the documents deleted since the last run
+        if save_json_chunks_directory and chunk_format == "json":
+            remove_deleted_documents(save_json_chunks_directory, docs_directory_path)
+    finally:
+        if writer is not None:
+            if completed:
+                writer.close()
+            else:
+                # An interrupted run leaves the previous embeddings file in place
+                writer.abort()
+        if chunk_store_writer is not None:
+            if completed:
+                chunk_store_writer.close()
+            else:
+                # An interrupted run leaves the previous chunk store in place
+                chunk_store_writer.abort()
+
+    return faiss
@@ -0,0 +1,110 @@
+"""
+    This code is a Python script that runs STEP 1, STEP 2 and STEP 3 in a single streaming pass:
+    it loads the documents from a directory, splits them into smaller chunks, embeds the chunks and
+    adds them to a FAISS vector store, one batch of chunks at a time.
+
+    The memory used by the pipeline is bounded by STREAMING_BATCH_SIZE and STREAMING_QUEUE_SIZE instead of the size of the corpus.
+
+    Along the way, the chunks are saved (as JSON files, or to the chunk store with CHUNK_STORE_FORMAT="store") and the embeddings are saved to the embeddings file,
+    exactly as STEP 1 and STEP 2 would, so the per-step scripts can still be run on the result.
+    The chunks are sized and deduplicated with the same settings as STEP 1 (CHUNK_SIZE, CHUNK_OVERLAP,
+    CHUNK_SIZE_UNIT, CHUNK_DEDUPLICATION).
+
+    The script then saves the vector store using the save_vectorstore function.
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.step_1_deduplicate_chunks import ChunkDeduplicator, save_chunk_references
+from HELPERS.step_2_embeddings_store import EMBEDDINGS_FILE_EXTENSION
+from HELPERS.step_2_loading_chunks import iter_chunks
+from HELPERS.step_3_build_vectorstore import build_vectorstore_manifest, set_chunk_references
+from HELPERS.step_3_save_vectorstore import save_vectorstore
+from HELPERS.step_3_shards import save_shards_manifest
+from HELPERS.streaming_pipeline import stream_ingest
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n####################### STREAMING DOCUMENTS INTO THE VECTORSTORE ########################\n")
+
+    docs_directory_path = os.getenv("DIRECTORY_DOCUMENTS_TO_LOAD")
+    save_json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+
+    saving_embeddings_file_name: str = os.getenv("SAVING_EMBEDDINGS_FILE_NAME")
+    saving_embeddings_directory: str = os.getenv("SAVING_EMBEDDINGS_DIRECTORY")
+    embeddings_file_path = os.path.join(
+        saving_embeddings_directory, saving_embeddings_file_name + EMBEDDINGS_FILE_EXTENSION
+    )
+
+    deduplicator = None
+    if os.getenv("CHUNK_DEDUPLICATION", "off") != "off":
+        deduplicator = ChunkDeduplicator(
+            mode=os.getenv("CHUNK_DEDUPLICATION"),
+            near_threshold=float(os.getenv("CHUNK_NEAR_DUPLICATE_THRESHOLD", "0.9")),
+        )
+
+    vectorstore = stream_ingest(
+        docs_directory_path=docs_directory_path,
+        path_to_ggml_model=path_to_ggml_model,
+        batch_size=int(os.getenv("STREAMING_BATCH_SIZE", "32")),
+        queue_size=int(os.getenv("STREAMING_QUEUE_SIZE", "4")),
+        save_json_chunks_directory=save_json_chunks_directory,
+        embeddings_file_path=embeddings_file_path,
+        cache_directory=os.getenv("EMBEDDINGS_CACHE_DIRECTORY"),
+        cache_max_entries=int(os.getenv("EMBEDDINGS_CACHE_MAX_ENTRIES", "1000000")),
+        workers=int(os.getenv("EMBEDDINGS_WORKERS", "0")),
+        threads_per_worker=int(os.getenv("EMBEDDINGS_THREADS_PER_WORKER", "0")) or None,
+        loading_workers=int(os.getenv("DOCUMENT_LOADING_WORKERS", "0")),
+        chunk_size=int(os.getenv("CHUNK_SIZE", "100")),
+        chunk_overlap=int(os.getenv("CHUNK_OVERLAP", "50")),
+        tokenizer_model_path=(
+            path_to_ggml_model
+            if os.getenv("CHUNK_SIZE_UNIT", "characters") == "tokens"
+            else None
+        ),
+        deduplicator=deduplicator,
+        chunk_format=os.getenv("CHUNK_STORE_FORMAT", "json"),
+        embeddings_dtype=os.getenv("EMBEDDINGS_STORE_DTYPE", "float32"),
+    )
+
+    if save_json_chunks_directory:
+        save_chunk_references(deduplicator, save_json_chunks_directory)
+    if deduplicator is not None:
+        print(deduplicator.report())
+
+    print("\n####################### VECTORSTORE CREATED ########################\n")
+
+    if vectorstore is None:
+        print("No chunks were found in " + str(docs_directory_path))
+    else:
+        if deduplicator is not None:
+            # The duplicates of a chunk may come after it was added: they are listed once every document was read
+            set_chunk_references(vectorstore, deduplicator.references)
+
+        print("\n####################### SAVING VECTORSTORE ########################\n")
+
+        saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
+        saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
+        save_vectorstore(
+            vectorstore=vectorstore,
+            file_name=saving_vectorstore_file_name,
+            directory_path=saving_vectorstore_directory,
+            manifest=build_vectorstore_manifest(iter_chunks(save_json_chunks_directory)),
+            docstore=os.getenv("VECTORSTORE_DOCSTORE", "disk"),
+        )
+        # The streamed vectorstore is never sharded: STEP 4 must not search the shards of a previous STEP 3
+        save_shards_manifest(
+            os.path.join(saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"),
+            shard_count=1,
+        )
+
+        print("\n####################### VECTORSTORE SAVED ########################\n")
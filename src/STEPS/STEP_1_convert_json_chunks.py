@@ -0,0 +1,36 @@
+"""
+    This code is a Python script that imports the "<document> Chunks.json" files saved by an earlier STEP 1
+    into a single chunk store (chunks.chunkstore, see HELPERS/step_1_chunk_store.py) in the same directory.
+
+    Once the chunk store exists, STEP 2 and STEP 3 read it instead of the JSON files,
+    so the documents do not have to be loaded and split again. The JSON files are left untouched.
+"""
+
+import os
+import sys
+import time
+from dotenv import load_dotenv
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.step_1_chunk_store import chunk_store_path, convert_json_chunks
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n####################### CONVERTING JSON CHUNKS ########################\n")
+
+    json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
+
+    start_time = time.perf_counter()
+    chunk_count = convert_json_chunks(json_chunks_directory)
+
+    print(
+        f"IMPORTED {chunk_count} CHUNKS INTO {chunk_store_path(json_chunks_directory)} "
+        f"IN {time.perf_counter() - start_time:.2f}s"
+    )
+
+    print("\n####################### CHUNK STORE SAVED ########################\n")
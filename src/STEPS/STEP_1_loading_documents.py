@@ -3,35 +3,60 @@
     
     The script uses the os, sys, and dotenv modules to handle file paths and environment variables, and the langchain library to load and split the documents. 
     
-    The load_documents function takes a directory path as input, iterates through all the files in the directory, determines the file type, loads the document using the appropriate loader, splits the document into smaller chunks using a CharacterTextSplitter, and returns a list of dictionaries containing the document name and chunked data. 
+    The load_documents function takes a directory path as input, iterates through all the files in the directory, determines the file type, loads the document using the appropriate loader, splits the document into smaller chunks using a CharacterTextSplitter, and returns a list of dictionaries containing the document name and chunked data. The loading and splitting itself is done by iter_loaded_documents from HELPERS.step_1_load_documents, which the streaming pipeline shares. 
     
     The script then saves the chunked data as JSON files in a specified directory using the save_documents function.
+    When DOCUMENT_LOADING_WORKERS is greater than 0, the files are loaded and split by that many worker processes,
+    and each document is saved as soon as its result arrives, in filename order.
+    The size and overlap of the chunks (CHUNK_SIZE, CHUNK_OVERLAP) are measured in characters, or in tokens of the model
+    when CHUNK_SIZE_UNIT is "tokens". When CHUNK_DEDUPLICATION is "exact" or "near", duplicate chunks are removed
+    before they are saved, and the locations of the duplicates are saved in duplicate_chunks.json.
+    When CHUNK_STORE_FORMAT is "store" (it is "json" by default), the chunks are saved to a single chunk store
+    (chunks.chunkstore, see HELPERS/step_1_chunk_store.py) instead of one JSON file per document.
+    The JSON files of the documents deleted from DIRECTORY_DOCUMENTS_TO_LOAD since the last run are removed.
 """
 
 import os
 import sys
 from dotenv import load_dotenv
 
-from langchain.document_loaders import UnstructuredFileLoader
-from langchain.document_loaders import PyPDFLoader
-
-from langchain.text_splitter import CharacterTextSplitter
-
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Union
 
 # Add src directory to Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.instrumentation import instrument_iterator, instrumented
+from HELPERS.step_1_deduplicate_chunks import ChunkDeduplicator, save_chunk_references
+from HELPERS.step_1_load_documents import iter_loaded_documents
 from HELPERS.step_1_save_chunked_docs import save_documents
 
 
+def _document_counts(document: Dict[str, Union[str, List[Dict[str, str]]]]) -> Dict[str, int]:
+    return {"files": 1, "chunks": len(document["chunks"])}
+
+
+@instrumented(
+    "load_documents",
+    lambda documents, _: {
+        "files": len(documents),
+        "chunks": sum(len(document["chunks"]) for document in documents),
+    },
+)
 def load_documents(
     docs_directory_path: str,
+    workers: int = 0,
+    chunk_size: int = 100,
+    chunk_overlap: int = 50,
+    tokenizer_model_path: Optional[str] = None,
 ) -> List[Dict[str, Union[str, List[Dict[str, str]]]]]:
     """
     Load documents from a directory and split them into smaller chunks.
 
     Args:
         docs_directory_path (str): Path to directory containing documents.
+        workers (int): Number of worker processes loading the documents in parallel. If 0, they are loaded one after the other.
+        chunk_size (int): Maximum size of a chunk.
+        chunk_overlap (int): Size of the text repeated between two consecutive chunks.
+        tokenizer_model_path (Optional[str]): Path to the GGML model whose tokenizer measures the sizes. If None, in characters.
 
     Returns:
         List[Dict[str, Union[str, List[Dict[str, str]]]]]: A list of dictionaries containing the name and chunked data of each document in the directory. Each dictionary has the following keys:
@@ -39,64 +64,73 @@ def load_documents(
             - 'chunks': A list of dictionaries containing the chunked data of the document. Each dictionary has a key in the format 'chunk_i' (where i is the chunk number) and a value that is the text content of the chunk.
     """
 
-    result = []
-
-    # Iterate through all the files in the directory
-    for file_name in os.listdir(docs_directory_path):
-        file_path = os.path.join(docs_directory_path, file_name)
-
-        # Determine loader based on file type
-        if file_name.endswith(".pdf"):
-            loader = PyPDFLoader(file_path=file_path)
-        else:
-            loader = UnstructuredFileLoader(file_path=file_path)
-
-        # Load document
-        document = loader.load()
-
-        # Split document into smaller chunks
-        text_splitter = CharacterTextSplitter(
-            separator=" ",
-            chunk_size=100,
-            chunk_overlap=50,
-            length_function=len,
+    return list(
+        iter_loaded_documents(
+            docs_directory_path=docs_directory_path,
+            workers=workers,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            tokenizer_model_path=tokenizer_model_path,
         )
-
-        chunks = [
-            {"chunk_" + str(i + 1): chunk.page_content}
-            for i, chunk in enumerate(text_splitter.split_documents(documents=document))
-        ]
-
-        # Add document name and chunked data to result list
-        file_name = os.path.splitext(file_name)[0]
-        result.append({"name": file_name, "chunks": chunks})
-
-    return result
+    )
 
 
 """################# CALLING THE FUNCTION #################"""
 
-print("\n####################### LOADING DOCUMENTS ########################\n")
-
-load_dotenv()  # Load environment variables from .env file
-
-docs_directory_path = os.getenv("DIRECTORY_DOCUMENTS_TO_LOAD")
-
-# Load documents
-loaded_and_chunked_docs = load_documents(docs_directory_path=docs_directory_path)
-
-print("\n####################### DOCUMENTS LOADED ########################\n")
+if __name__ == "__main__":
+    print("\n####################### LOADING DOCUMENTS ########################\n")
+
+    load_dotenv()  # Load environment variables from .env file
+
+    docs_directory_path = os.getenv("DIRECTORY_DOCUMENTS_TO_LOAD")
+    document_loading_workers = int(os.getenv("DOCUMENT_LOADING_WORKERS", "0"))
+    chunk_size = int(os.getenv("CHUNK_SIZE", "100"))
+    chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "50"))
+    chunk_deduplication = os.getenv("CHUNK_DEDUPLICATION", "off")
+
+    # Measure the chunks in tokens of the model instead of characters
+    tokenizer_model_path = None
+    if os.getenv("CHUNK_SIZE_UNIT", "characters") == "tokens":
+        tokenizer_model_path = os.getenv("PATH_TO_GGML_MODEL")
+
+    # Load documents lazily, so each document is saved as soon as it is loaded
+    loaded_and_chunked_docs = instrument_iterator(
+        "load_documents",
+        iter_loaded_documents(
+            docs_directory_path=docs_directory_path,
+            workers=document_loading_workers,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            tokenizer_model_path=tokenizer_model_path,
+        ),
+        _document_counts,
+    )
+
+    # Remove the duplicate chunks before they are saved, keeping track of where they were
+    deduplicator = None
+    if chunk_deduplication != "off":
+        deduplicator = ChunkDeduplicator(
+            mode=chunk_deduplication,
+            near_threshold=float(os.getenv("CHUNK_NEAR_DUPLICATE_THRESHOLD", "0.9")),
+        )
+        loaded_and_chunked_docs = deduplicator.iter_deduplicated(loaded_and_chunked_docs)
 
+    save_json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
 
-print("\n####################### DOCUMENT CHUNKS LOADED ########################\n")
+    # Save documents, removing the JSON chunks of the documents deleted since the last run
+    deleted_documents = save_documents(
+        documents=loaded_and_chunked_docs,
+        save_json_chunks_directory=save_json_chunks_directory,
+        chunk_format=os.getenv("CHUNK_STORE_FORMAT", "json"),
+        docs_directory_path=docs_directory_path,
+    )
+    save_chunk_references(deduplicator, save_json_chunks_directory)
 
-save_json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
+    if deleted_documents:
+        print(f"REMOVED THE CHUNKS OF {len(deleted_documents)} DELETED DOCUMENT(S): {', '.join(deleted_documents)}")
 
-# Save documents
-save_documents(
-    documents=loaded_and_chunked_docs,
-    save_json_chunks_directory=save_json_chunks_directory,
-)
+    if deduplicator is not None:
+        print(deduplicator.report())
 
 
-print("\n####################### DOCUMENT CHUNKS SAVED ########################\n")
+    print("\n####################### DOCUMENT CHUNKS SAVED ########################\n")
@@ -14,24 +14,88 @@
     the LlamaCppEmbeddings model to generate embeddings. 
     
     The embeddings are then added to a list, which is returned by the function.
+    The chunks are read from the chunk store written by STEP 1 (see HELPERS/step_1_chunk_store.py),
+    or from the JSON files when the directory has no chunk store.
+
+    The iter_embeddings function does the same work one batch of chunks at a time and yields each batch
+    together with the (document, chunk id) of its chunks, so that save_embeddings can write
+    the embeddings file incrementally instead of holding every embedding in memory.
+
+    When a cache directory is given, every chunk is first looked up in an EmbeddingsCache,
+    and only the chunks that are new or changed are passed to the LlamaCppEmbeddings model.
+    The model itself is only loaded if at least one chunk is missing from the cache.
+
+    When workers is greater than 0, the missing chunks are embedded by a pool of worker processes
+    that each load the model once, and the run reports its throughput in chunks per second.
 """
 
 import os
 import sys
-import json
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 from langchain.embeddings.base import Embeddings
-from langchain.embeddings import LlamaCppEmbeddings
 from dotenv import load_dotenv
 
 # Add src directory to Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.instrumentation import instrument_iterator, instrumented
 from HELPERS.step_2_save_embeddings import save_embeddings
+from HELPERS.step_2_embedding_batches import embed_chunk_batches, iter_chunk_batches
+from HELPERS.step_2_loading_chunks import iter_chunks
+
+
+def iter_embeddings(
+    load_json_chunks_directory: str,
+    path_to_ggml_model: str,
+    cache_directory: Optional[str] = None,
+    cache_max_entries: int = 1_000_000,
+    workers: int = 0,
+    threads_per_worker: Optional[int] = None,
+    batch_size: int = 32,
+) -> Iterator[Tuple[List[Tuple[str, str]], List[List[float]]]]:
+    """
+    Creates embeddings for text documents using the LlamaCppEmbeddings model, one batch of chunks at a time.
+
+    Args:
+        - load_json_chunks_directory (str): Path to directory containing JSON files with text documents.
+        - path_to_ggml_model (str): Path to the LlamaCppEmbeddings model.
+        - cache_directory (Optional[str]): Path to the directory of the embeddings cache. If None, no cache is used.
+        - cache_max_entries (int): Maximum number of embeddings kept in the cache.
+        - workers (int): Number of worker processes embedding the chunks. If 0, the chunks are embedded in this process.
+        - threads_per_worker (Optional[int]): Number of llama.cpp threads in each worker. Defaults to an even split of the CPU cores.
+        - batch_size (int): Number of chunks embedded at once.
+
+    Yields:
+        - Tuple[List[Tuple[str, str]], List[List[float]]]: The (document, chunk id) of every chunk of a batch, and their embeddings.
+    """
 
+    embedded_batches = embed_chunk_batches(
+        batches=iter_chunk_batches(
+            chunks=iter_chunks(load_json_chunks_directory), batch_size=batch_size
+        ),
+        path_to_ggml_model=path_to_ggml_model,
+        cache_directory=cache_directory,
+        cache_max_entries=cache_max_entries,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+    )
 
+    for references, _, vectors in embedded_batches:
+        yield references, vectors
+
+
+@instrumented(
+    "create_embeddings",
+    lambda embeddings, _: {"chunks": len(embeddings), "vectors": len(embeddings)},
+)
 def create_embeddings(
-    load_json_chunks_directory: str, path_to_ggml_model: str
+    load_json_chunks_directory: str,
+    path_to_ggml_model: str,
+    cache_directory: Optional[str] = None,
+    cache_max_entries: int = 1_000_000,
+    workers: int = 0,
+    threads_per_worker: Optional[int] = None,
+    batch_size: int = 32,
 ) -> List[Embeddings]:
     """
     Creates embeddings for text documents using the LlamaCppEmbeddings model.
@@ -39,61 +103,71 @@ def create_embeddings(
     Args:
         - load_json_chunks_directory (str): Path to directory containing JSON files with text documents.
         - path_to_ggml_model (str): Path to the LlamaCppEmbeddings model.
+        - cache_directory (Optional[str]): Path to the directory of the embeddings cache. If None, no cache is used.
+        - cache_max_entries (int): Maximum number of embeddings kept in the cache.
+        - workers (int): Number of worker processes embedding the chunks. If 0, the chunks are embedded in this process.
+        - threads_per_worker (Optional[int]): Number of llama.cpp threads in each worker. Defaults to an even split of the CPU cores.
+        - batch_size (int): Number of chunks embedded at once.
 
     Returns:
         - List[Embeddings]: A list of embeddings for the text documents.
     """
 
-    # Load LlamaCppEmbeddings object
-    embeddings = LlamaCppEmbeddings(model_path=path_to_ggml_model)
+    all_embeddings: list = []
 
-    # Embed text from JSON files in directory using LlamaCppEmbeddings
-    all_embeddings: list[Embeddings] = []
-
-    for filename in os.listdir(load_json_chunks_directory):
-        if filename.endswith(".json"):
-            with open(os.path.join(load_json_chunks_directory, filename), "r") as f:
-                documents = json.load(f)
-
-            # texts = [doc["chunk_x"] for doc in documents]
-            texts: list = []
-            for doc in documents:
-                for key, value in doc.items():
-                    texts.append(value)
-                    break
-
-            embeddings_list = embeddings.embed_documents(texts)
-            all_embeddings.extend(embeddings_list)
+    for _, vectors in iter_embeddings(
+        load_json_chunks_directory=load_json_chunks_directory,
+        path_to_ggml_model=path_to_ggml_model,
+        cache_directory=cache_directory,
+        cache_max_entries=cache_max_entries,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        batch_size=batch_size,
+    ):
+        all_embeddings.extend(vectors)
 
     return all_embeddings
 
 
 """################# CALLING THE FUNCTION #################"""
 
-load_dotenv()  # Load environment variables from .env file
-
-print("\n####################### CREATING EMBEDDINGS ########################\n")
-
-load_json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
-path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
-
-# Creating the embeddings
-embeddings = create_embeddings(
-    load_json_chunks_directory=load_json_chunks_directory,
-    path_to_ggml_model=path_to_ggml_model,
-)
-
-print("\n####################### EMBEDDINGS CREATED ########################\n")
-
-print("\n####################### SAVING EMBEDDINGS ########################\n")
-# Saving the embeddings with a specified filename
-saving_embeddings_file_name: str = os.getenv("SAVING_EMBEDDINGS_FILE_NAME")
-saving_embeddings_directory: str = os.getenv("SAVING_EMBEDDINGS_DIRECTORY")
-
-save_embeddings(
-    embeddings=embeddings,
-    file_name=saving_embeddings_file_name,
-    directory_path=saving_embeddings_directory,
-)
-
-print("\n####################### EMBEDDINGS SAVED ########################\n")
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n####################### CREATING EMBEDDINGS ########################\n")
+
+    load_json_chunks_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+    embeddings_cache_directory: str = os.getenv("EMBEDDINGS_CACHE_DIRECTORY")
+    embeddings_cache_max_entries = int(os.getenv("EMBEDDINGS_CACHE_MAX_ENTRIES", "1000000"))
+    embeddings_workers = int(os.getenv("EMBEDDINGS_WORKERS", "0"))
+    embeddings_threads_per_worker = int(os.getenv("EMBEDDINGS_THREADS_PER_WORKER", "0"))
+    embeddings_batch_size = int(os.getenv("EMBEDDINGS_BATCH_SIZE", "32"))
+
+    # Creating the embeddings, batch by batch, as they are saved
+    embeddings = instrument_iterator(
+        "create_embeddings",
+        iter_embeddings(
+            load_json_chunks_directory=load_json_chunks_directory,
+            path_to_ggml_model=path_to_ggml_model,
+            cache_directory=embeddings_cache_directory,
+            cache_max_entries=embeddings_cache_max_entries,
+            workers=embeddings_workers,
+            threads_per_worker=embeddings_threads_per_worker or None,
+            batch_size=embeddings_batch_size,
+        ),
+        lambda batch: {"chunks": len(batch[1]), "vectors": len(batch[1])},
+    )
+
+    # Saving the embeddings with a specified filename
+    saving_embeddings_file_name: str = os.getenv("SAVING_EMBEDDINGS_FILE_NAME")
+    saving_embeddings_directory: str = os.getenv("SAVING_EMBEDDINGS_DIRECTORY")
+
+    save_embeddings(
+        embeddings=embeddings,
+        file_name=saving_embeddings_file_name,
+        directory_path=saving_embeddings_directory,
+        dtype=os.getenv("EMBEDDINGS_STORE_DTYPE", "float32"),
+    )
+
+    print("\n####################### EMBEDDINGS CREATED AND SAVED ########################\n")
@@ -2,97 +2,451 @@
     This code defines a function called create_vectorstore_from_json that creates a FAISS index 
     from text embeddings extracted from JSON files in a specified directory. 
 
-    The function takes two arguments: 
-        json_files_directory which is the path to the directory containing the JSON files, and 
-        model_path which is the path to the model used for generating embeddings. 
+    The function takes five arguments: 
+        json_files_directory which is the path to the directory containing the JSON files, 
+        model_path which is the path to the model used for generating embeddings, 
+        index_factory which is the FAISS index factory spec of the index (e.g. "Flat", "IVF1024,Flat" or "HNSW32"), 
+        training_sample_size which is the maximum number of embeddings the index is trained on, and 
+        shard which is the optional shard of the index and the number of shards. 
 
     The function: 
-        loads the embeddings, 
-        reads the JSON files, 
+        loads the embeddings and their manifest, 
+        reads the chunks (from the chunk store written by STEP 1, or from the JSON files), 
         extracts the text values, 
-        creates text embedding pairs, and 
-        creates a FAISS index from the pairs.
+        creates text embedding pairs by looking up the (document, chunk id) of each embedding in the manifest, and 
+        creates a FAISS index from the pairs, where every vector is identified by the stable id of its chunk.
+
+    The update_vectorstore_from_json function loads the saved FAISS index instead, and compares its manifest
+    (a hash of the chunks of every document) with the JSON files: it only adds the vectors of new or changed documents
+    and removes the vectors of changed or deleted ones. The result is then saved atomically with its new manifest.
+    Either way, the chunks that STEP 1 found duplicates of (CHUNK_DEDUPLICATION) list them in their "duplicates" metadata,
+    as (document, chunk id) pairs read from duplicate_chunks.json, so a chunk found by STEP 4 reports all of its sources.
+
+    The type of FAISS index is chosen with a FAISS index factory spec (VECTORSTORE_INDEX_FACTORY, e.g. "IVF1024,Flat" or "HNSW32"),
+    trained on a sample of VECTORSTORE_TRAINING_SAMPLE_SIZE embeddings if needed. The spec and the search-time parameters
+    (VECTORSTORE_NPROBE, VECTORSTORE_EF_SEARCH) are saved next to the index so STEP 4 searches it the same way.
+    When VECTORSTORE_EVALUATION_QUERIES is greater than 0, the index is evaluated against exact search (recall@k, p50/p99 latency).
+    With VECTORSTORE_QUANTIZATION set to "float16" or "int8", the index stores its vectors with a scalar quantizer, and the rows
+    of the (float32) embeddings file are referenced next to it so STEP 4 can re-rank VECTORSTORE_RERANK_CANDIDATES candidates
+    of the index by exact distance; the memory saved is reported, and the evaluation reports the recall@k with and without
+    the re-ranking. A quantized embeddings file (EMBEDDINGS_STORE_DTYPE) has no exact vectors, and is refused.
+    With VECTORSTORE_DOCSTORE="disk" (the default), the text of the chunks is saved as a disk docstore next to the index
+    (see HELPERS/step_3_disk_docstore.py) instead of being pickled with it, so STEP 4 only reads the chunks it returns.
+    With VECTORSTORE_SHARDS greater than 1, the vectorstore is split by a hash of the document names into that many shards,
+    each built, evaluated and saved as a vectorstore of its own (see HELPERS/step_3_shards.py), which STEP 4 searches in parallel.
 """
 
-import json
 import os
 import sys
+import json
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 from langchain import FAISS
-from langchain.embeddings import LlamaCppEmbeddings
 from dotenv import load_dotenv
 
 # Add src directory to Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.instrumentation import instrumented
+from HELPERS.model_registry import LazyEmbeddings
+from HELPERS.step_1_deduplicate_chunks import load_chunk_references
+from HELPERS.step_2_embeddings_store import EMBEDDINGS_FILE_EXTENSION, embeddings_store_dtype
+from HELPERS.step_2_loading_chunks import iter_chunks, load_chunk_texts, load_document_chunks
+from HELPERS.step_3_build_vectorstore import (
+    add_to_vectorstore,
+    apply_search_parameters,
+    build_vectorstore,
+    chunk_id,
+    build_vectorstore_manifest,
+    diff_vectorstore_manifest,
+    remove_from_vectorstore,
+    set_chunk_references,
+    supports_remove_ids,
+)
+from HELPERS.step_3_index_evaluation import evaluate_index
+from HELPERS.step_3_quantization import (
+    ExactReranker,
+    quantization_memory,
+    quantized_index_factory,
+)
 from HELPERS.step_3_loading_embeddings import load_embeddings
-from HELPERS.step_3_save_vectorstore import save_vectorstore
+from HELPERS.step_3_save_vectorstore import (
+    load_index_params,
+    load_vectorstore,
+    load_vectorstore_manifest,
+    save_vectorstore,
+)
+from HELPERS.step_3_shards import (
+    load_shards_manifest,
+    save_shards_manifest,
+    shard_file_name,
+    shard_of,
+)
+
+
+def _embeddings_path() -> str:
+    load_embeddings_directory: str = os.getenv("SAVING_EMBEDDINGS_DIRECTORY")
+    load_embeddings_file_name: str = os.getenv("SAVING_EMBEDDINGS_FILE_NAME")
+
+    return os.path.join(
+        load_embeddings_directory, load_embeddings_file_name + EMBEDDINGS_FILE_EXTENSION
+    )
+
+
+def _load_saved_embeddings(
+    shard: Optional[Tuple[int, int]] = None,
+) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
+    loaded_embeddings, references = load_embeddings(file_path=_embeddings_path())
+    if shard is None:
+        return loaded_embeddings, references
+
+    # Only the rows of the documents of the shard (read into memory, one shard at a time)
+    rows = [
+        row
+        for row, (document, _) in enumerate(references)
+        if shard_of(document, shard[1]) == shard[0]
+    ]
+    return np.asarray(loaded_embeddings[rows], dtype=np.float32).reshape(
+        len(rows), loaded_embeddings.shape[1]
+    ), [references[row] for row in rows]
 
 
-def create_vectorstore_from_json(json_files_directory: str, model_path: str) -> FAISS:
+def _exact_reranker(shard: Optional[Tuple[int, int]] = None) -> ExactReranker:
+    # The rows of the float32 embeddings file are the exact vectors: they are memory-mapped, not copied
+    embeddings_path = _embeddings_path()
+    loaded_embeddings, references = load_embeddings(file_path=embeddings_path)
+    rows = [
+        row
+        for row, (document, _) in enumerate(references)
+        if shard is None or shard_of(document, shard[1]) == shard[0]
+    ]
+
+    return ExactReranker(
+        ids=np.array([chunk_id(*references[row]) for row in rows], dtype=np.int64),
+        embeddings=loaded_embeddings,
+        rows=np.array(rows, dtype=np.int64),
+        embeddings_file=embeddings_path,
+    )
+
+
+@instrumented(
+    "create_vectorstore_from_json",
+    lambda faiss, _: {"vectors": faiss.index.ntotal},
+)
+def create_vectorstore_from_json(
+    json_files_directory: str,
+    model_path: str,
+    index_factory: str = "Flat",
+    training_sample_size: int = 100_000,
+    shard: Optional[Tuple[int, int]] = None,
+) -> FAISS:
     """
     Creates a FAISS index from text embeddings extracted from JSON files in the specified directory.
 
     Args:
         - json_files_directory (str): Path to directory containing JSON files.
         - model_path (str): Path to model used for generating embeddings.
+        - index_factory (str): FAISS index factory spec, e.g. "Flat", "IVF1024,Flat", "HNSW32" or "IVF1024,PQ32".
+        - training_sample_size (int): Maximum number of embeddings used to train the index, if its type needs training.
+        - shard (Optional[Tuple[int, int]]): The shard and the number of shards, to only index the documents of one shard.
 
     Returns:
         - FAISS: FAISS index created from text embedding pairs.
     """
 
-    # Load embeddings
-    embeddings = LlamaCppEmbeddings(model_path=model_path)
+    # Every vector is precomputed: the model is only loaded if the vectorstore embeds a query
+    embeddings = LazyEmbeddings(model_path=model_path)
 
-    load_embeddings_directory: str = os.getenv("SAVING_EMBEDDINGS_DIRECTORY")
-    load_embeddings_file_name: str = os.getenv("SAVING_EMBEDDINGS_FILE_NAME")
+    loaded_embeddings, references = _load_saved_embeddings(shard)
 
-    embeddings_path = os.path.join(
-        load_embeddings_directory, load_embeddings_file_name + ".pkl"
+    # Pair each embedding with the text of the chunk its manifest row points to
+    texts = load_chunk_texts(json_files_directory, references)
+    faiss = build_vectorstore(
+        texts=texts,
+        embeddings=loaded_embeddings,
+        references=references,
+        embedding=embeddings,
+        index_factory=index_factory,
+        training_sample_size=training_sample_size,
     )
 
-    loaded_embeddings = load_embeddings(file_path=embeddings_path)
+    return faiss
+
+
+@instrumented(
+    "update_vectorstore_from_json",
+    lambda faiss, _: {"vectors": faiss.index.ntotal},
+)
+def update_vectorstore_from_json(
+    json_files_directory: str,
+    model_path: str,
+    path_to_vectorstore: str,
+    manifest: Dict[str, Dict[str, object]],
+    index_factory: str = "Flat",
+    training_sample_size: int = 100_000,
+    shard: Optional[Tuple[int, int]] = None,
+) -> FAISS:
+    """
+    Updates a saved FAISS index with the documents that were added, changed or deleted since it was saved.
+
+    Only the vectors of new or changed documents are added, and only the vectors of changed or deleted documents are removed.
+    If there is no saved FAISS index (or it has no manifest), a new one is created from every document.
+    So is it when vectors must be removed from an index type that cannot remove them (HNSW).
+    The saved FAISS index keeps its index type: index_factory and training_sample_size only apply to a new one.
+
+    Args:
+        - json_files_directory (str): Path to directory containing JSON files.
+        - model_path (str): Path to model used for generating embeddings.
+        - path_to_vectorstore (str): Path to the saved FAISS index.
+        - manifest (Dict[str, Dict[str, object]]): The vectorstore manifest of the JSON files.
+        - index_factory (str): FAISS index factory spec used if a new FAISS index is created.
+        - training_sample_size (int): Maximum number of embeddings used to train a new FAISS index.
+        - shard (Optional[Tuple[int, int]]): The shard and the number of shards, if the FAISS index is a shard.
+          The manifest must then only hold the documents of the shard.
+
+    Returns:
+        - FAISS: The updated FAISS index.
+    """
+
+    saved_manifest = load_vectorstore_manifest(path_to_vectorstore)
+    if saved_manifest is None:
+        print("No saved vectorstore manifest found, creating the vectorstore from scratch")
+        return create_vectorstore_from_json(
+            json_files_directory=json_files_directory,
+            model_path=model_path,
+            index_factory=index_factory,
+            training_sample_size=training_sample_size,
+            shard=shard,
+        )
+
+    embeddings = LazyEmbeddings(model_path=model_path)
+    faiss = load_vectorstore(path_to_vectorstore, embeddings)
+
+    changed, deleted = diff_vectorstore_manifest(saved_manifest, manifest)
+
+    if any(document in saved_manifest for document in changed + deleted) and not supports_remove_ids(
+        faiss.index
+    ):
+        # e.g. an HNSW index: its changed and deleted documents cannot be removed, it is built again
+        print(
+            "The vectorstore index cannot remove vectors (e.g. HNSW), "
+            "rebuilding the vectorstore from scratch instead of updating it"
+        )
+        return create_vectorstore_from_json(
+            json_files_directory=json_files_directory,
+            model_path=model_path,
+            index_factory=index_factory,
+            training_sample_size=training_sample_size,
+            shard=shard,
+        )
+
+    # Remove the vectors of changed and deleted documents
+    removed_count = 0
+    for document in changed + deleted:
+        if document in saved_manifest:
+            removed_count += remove_from_vectorstore(
+                faiss, saved_manifest[document]["chunk_ids"]
+            )
 
-    texts: list = []
-    for filename in os.listdir(json_files_directory):
-        if filename.endswith(".json"):
-            with open(os.path.join(json_files_directory, filename), "r") as f:
-                chunks = json.load(f)
+    # Add the vectors of new and changed documents
+    added_count = 0
+    if changed:
+        loaded_embeddings, references = _load_saved_embeddings(shard)
+        row_by_reference = {reference: row for row, reference in enumerate(references)}
 
-            for chunk in chunks:
-                for key, value in chunk.items():
-                    texts.append(value)
-                    break
+        for document in changed:
+            chunks = load_document_chunks(json_files_directory, document)
+            document_references = [(document, chunk) for chunk, _ in chunks]
+            rows = [row_by_reference[reference] for reference in document_references]
 
-    text_embedding = list(zip(texts, loaded_embeddings))
-    faiss = FAISS.from_embeddings(embedding=embeddings, text_embeddings=text_embedding)
+            add_to_vectorstore(
+                faiss,
+                texts=[text for _, text in chunks],
+                embeddings=loaded_embeddings[rows],
+                references=document_references,
+            )
+            added_count += len(rows)
+
+    print(
+        f"UPDATED VECTORSTORE: {len(changed)} new or changed and {len(deleted)} deleted document(s), "
+        f"{added_count} vector(s) added, {removed_count} vector(s) removed"
+    )
 
     return faiss
 
 
+def _create_and_save_vectorstore(
+    json_files_directory: str,
+    model_path: str,
+    vectorstore_directory: str,
+    file_name: str,
+    manifest: Dict[str, Dict[str, object]],
+    index_params: Dict[str, object],
+    update: bool,
+    evaluation_queries: int,
+    shard: Optional[Tuple[int, int]] = None,
+) -> None:
+    index_params = dict(index_params)
+    vectorstore_path = os.path.join(vectorstore_directory, file_name + ".faiss")
+
+    if update:
+        # An updated vectorstore keeps the index type it was created with
+        saved_index_params = load_index_params(vectorstore_path)
+        if "index_factory" in saved_index_params:
+            index_params["index_factory"] = saved_index_params["index_factory"]
+            index_params["quantization"] = saved_index_params.get("quantization", "none")
+
+    store_dtype = embeddings_store_dtype(_embeddings_path())
+    if index_params["quantization"] != "none" and store_dtype != "float32":
+        # Re-ranking by quantized rows would not be exact, and the recall would be measured against them
+        raise ValueError(
+            f"VECTORSTORE_QUANTIZATION={index_params['quantization']} needs the exact (float32) rows of the embeddings file, "
+            f"but it holds {store_dtype} rows: run STEP 2 again with EMBEDDINGS_STORE_DTYPE=float32"
+        )
+
+    if update:
+        vectorstore = update_vectorstore_from_json(
+            json_files_directory=json_files_directory,
+            model_path=model_path,
+            path_to_vectorstore=vectorstore_path,
+            manifest=manifest,
+            index_factory=quantized_index_factory(
+                index_params["index_factory"], index_params["quantization"]
+            ),
+            training_sample_size=index_params["training_sample_size"],
+            shard=shard,
+        )
+    else:
+        vectorstore = create_vectorstore_from_json(
+            json_files_directory=json_files_directory,
+            model_path=model_path,
+            index_factory=quantized_index_factory(
+                index_params["index_factory"], index_params["quantization"]
+            ),
+            training_sample_size=index_params["training_sample_size"],
+            shard=shard,
+        )
+
+    apply_search_parameters(
+        vectorstore.index, nprobe=index_params["nprobe"], ef_search=index_params["ef_search"]
+    )
+
+    # A kept chunk found by STEP 4 also lists the duplicates STEP 1 removed, with their own (document, chunk id)
+    referenced_count = set_chunk_references(vectorstore, load_chunk_references(json_files_directory))
+    if referenced_count:
+        print(f"{referenced_count} chunk(s) list the duplicates STEP 1 removed")
+
+    print("\n####################### VECTORSTORE CREATED ########################\n")
+
+    reranker = None
+    if index_params["quantization"] != "none":
+        # The exact vectors are referenced next to the quantized index, to re-rank its candidates
+        reranker = _exact_reranker(shard)
+        index_params["memory"] = quantization_memory(vectorstore.index)
+        print(
+            f"QUANTIZED INDEX ({index_params['quantization']}): "
+            f"{index_params['memory']['vectors_bytes'] / 2**20:.1f} MiB of vectors instead of "
+            f"{index_params['memory']['float32_vectors_bytes'] / 2**20:.1f} MiB, "
+            f"{index_params['memory']['saved_bytes'] / 2**20:.1f} MiB saved"
+        )
+
+    if evaluation_queries > 0:
+        print("\n####################### EVALUATING VECTORSTORE INDEX ########################\n")
+
+        loaded_embeddings, references = _load_saved_embeddings(shard)
+        ids = np.array([chunk_id(*reference) for reference in references], dtype=np.int64)
+
+        index_params["evaluation"] = evaluate_index(
+            index=vectorstore.index,
+            embeddings=loaded_embeddings,
+            ids=ids,
+            query_count=evaluation_queries,
+            training_sample_size=index_params["training_sample_size"],
+            reranker=reranker,
+            rerank_candidates=index_params["rerank_candidates"],
+        )
+        # The recall is measured against exact search over the rows of the embeddings file, as STEP 2 stored them
+        index_params["evaluation"]["ground_truth"] = f"exact search over the {store_dtype} embeddings"
+        if store_dtype != "float32":
+            print(
+                f"WARNING: the embeddings file holds {store_dtype} rows (EMBEDDINGS_STORE_DTYPE), "
+                "the recall is measured against them, not against the float32 embeddings"
+            )
+        print(json.dumps(index_params, indent=4))
+
+
+    print("\n####################### SAVING VECTORSTORE ########################\n")
+
+    save_vectorstore(
+        vectorstore=vectorstore,
+        file_name=file_name,
+        directory_path=vectorstore_directory,
+        manifest=manifest,
+        index_params=index_params,
+        docstore=os.getenv("VECTORSTORE_DOCSTORE", "disk"),
+        reranker=reranker,
+    )
+
+    print("\n####################### VECTORSTORE SAVED ########################\n")
+
+
 """################# CALLING THE FUNCTION #################"""
 
-load_dotenv()  # Load environment variables from .env file
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
 
-print("\n####################### CREATING VECTORSTORE ########################\n")
+    print("\n####################### CREATING VECTORSTORE ########################\n")
 
-path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
-json_files_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+    json_files_directory = os.getenv("DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS")
 
-vectorstore = create_vectorstore_from_json(
-    json_files_directory=json_files_directory, model_path=path_to_ggml_model
-)
+    saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
+    saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
+    vectorstore_path = os.path.join(
+        saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"
+    )
 
-print("\n####################### VECTORSTORE CREATED ########################\n")
+    index_params = {
+        "index_factory": os.getenv("VECTORSTORE_INDEX_FACTORY", "Flat"),
+        "quantization": os.getenv("VECTORSTORE_QUANTIZATION", "none"),
+        "rerank_candidates": int(os.getenv("VECTORSTORE_RERANK_CANDIDATES", "32")),
+        "training_sample_size": int(os.getenv("VECTORSTORE_TRAINING_SAMPLE_SIZE", "100000")),
+        "nprobe": int(os.getenv("VECTORSTORE_NPROBE", "16")),
+        "ef_search": int(os.getenv("VECTORSTORE_EF_SEARCH", "64")),
+    }
+    evaluation_queries = int(os.getenv("VECTORSTORE_EVALUATION_QUERIES", "0"))
+    shard_count = int(os.getenv("VECTORSTORE_SHARDS", "1"))
 
+    # Hash every document of the JSON files, to find what changed since the last build
+    manifest = build_vectorstore_manifest(iter_chunks(json_files_directory))
 
-print("\n####################### SAVING VECTORSTORE ########################\n")
+    update = os.getenv("VECTORSTORE_UPDATE_MODE", "rebuild") == "update"
+    saved_shards_manifest = load_shards_manifest(vectorstore_path)
+    saved_shard_count = 1 if saved_shards_manifest is None else saved_shards_manifest["shard_count"]
+    if update and saved_shard_count != shard_count:
+        # The documents moved to other shards: every shard is built again, from the saved embeddings
+        print(f"The vectorstore has {saved_shard_count} shard(s) instead of {shard_count}, rebuilding it")
+        update = False
 
-saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
-saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
-save_vectorstore(
-    vectorstore=vectorstore,
-    file_name=saving_vectorstore_file_name,
-    directory_path=saving_vectorstore_directory,
-)
+    for shard in range(shard_count):
+        if shard_count > 1:
+            print(f"\n####################### SHARD {shard + 1} OF {shard_count} ########################\n")
+
+        _create_and_save_vectorstore(
+            json_files_directory=json_files_directory,
+            model_path=path_to_ggml_model,
+            vectorstore_directory=saving_vectorstore_directory,
+            file_name=shard_file_name(saving_vectorstore_file_name, shard, shard_count),
+            manifest={
+                document: document_manifest
+                for document, document_manifest in manifest.items()
+                if shard_of(document, shard_count) == shard
+            },
+            index_params=index_params,
+            update=update,
+            evaluation_queries=evaluation_queries,
+            shard=(shard, shard_count) if shard_count > 1 else None,
+        )
 
-print("\n####################### VECTORSTORE SAVED ########################\n")
+    # STEP 4 searches the shards once they are all saved
+    save_shards_manifest(vectorstore_path, shard_count)
@@ -0,0 +1,125 @@
+"""
+    This code runs STEP 4 over a whole file of questions in a single pass.
+
+    The embeddings model, the FAISS vectorstore and the LLM are loaded once, the questions of the
+    QUERY_BATCH_INPUT_FILE JSONL file are embedded in batches and searched with a single FAISS search,
+    and the answers are generated by a bounded pool of workers (see HELPERS/step_4_batch_queries.py).
+
+    The results are written to the QUERY_BATCH_OUTPUT_FILE JSONL file as they are answered, one line per question,
+    with the chunks each answer was generated from and the retrieval and generation timings.
+
+    Example of an input file:
+        {"id": "q1", "query": "What is this document about?"}
+        "Who wrote it?"
+"""
+
+
+import os
+import sys
+from dotenv import load_dotenv
+
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.instrumentation import span
+from HELPERS.model_registry import (
+    get_embeddings_model,
+    get_llm_model,
+    model_registry_stats,
+    prompt_cache_stats,
+)
+from HELPERS.step_4_batch_queries import run_batch_queries
+from HELPERS.step_4_query_cache import AnswerCache, QueryEmbeddingCache
+from HELPERS.step_4_sharded_search import ShardedVectorstore, load_search_vectorstore
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n####################### ANSWERING THE QUERIES ########################\n")
+
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+
+    saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
+    saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
+    vectorstore_path = os.path.join(
+        saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"
+    )
+
+    input_file_path: str = os.getenv("QUERY_BATCH_INPUT_FILE")
+    output_file_path: str = os.getenv("QUERY_BATCH_OUTPUT_FILE")
+    generate_answers = os.getenv("QUERY_BATCH_GENERATE", "true").lower() == "true"
+
+    # Load everything once: the embeddings model and the LLM share one copy of the GGML model
+    # (a query repeated in the file is not embedded again)
+    embeddings = QueryEmbeddingCache(
+        get_embeddings_model(path_to_ggml_model),
+        max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", "1024")),
+    )
+
+    # The shards of a sharded vectorstore are loaded and searched by worker processes
+    vectorstore, reranker, rerank_candidates = load_search_vectorstore(vectorstore_path, embeddings)
+
+    # The answers of a vectorstore rebuilt since the last run are dropped when the cache is opened
+    answer_cache_directory = os.getenv("ANSWER_CACHE_DIRECTORY")
+    answer_cache = (
+        AnswerCache(
+            answer_cache_directory,
+            model_path=path_to_ggml_model,
+            path_to_vectorstore=vectorstore_path,
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "100000")),
+        )
+        if answer_cache_directory and generate_answers
+        else None
+    )
+
+    with span("batch_queries") as batch_span:
+        summary = run_batch_queries(
+            input_file_path,
+            output_file_path,
+            embeddings=embeddings,
+            vectorstore=vectorstore,
+            llm=get_llm_model(path_to_ggml_model) if generate_answers else None,
+            k=4,
+            batch_size=int(os.getenv("QUERY_BATCH_SIZE", "32")),
+            generation_workers=int(os.getenv("QUERY_BATCH_GENERATION_WORKERS", "1")),
+            # A quantized index is searched in two phases, with the exact vectors saved next to it
+            reranker=reranker,
+            rerank_candidates=rerank_candidates,
+            answer_cache=answer_cache,
+        )
+        batch_span.count(queries=summary["queries"])
+
+    if isinstance(vectorstore, ShardedVectorstore):
+        vectorstore.close()
+
+    embeddings_stats = embeddings.stats()
+    print(
+        f"QUERY EMBEDDINGS: {embeddings_stats['hits']} CACHED, {embeddings_stats['misses']} EMBEDDED"
+    )
+    if answer_cache is not None:
+        answer_stats = answer_cache.stats()
+        print(f"ANSWERS: {answer_stats['hits']} CACHED, {answer_stats['misses']} GENERATED")
+        answer_cache.close()
+
+    print(
+        f"ANSWERED {summary['queries']} QUERIES IN {summary['seconds']:.2f}s "
+        f"({summary['queries_per_second']:.2f} QUERIES/s), RESULTS IN {output_file_path}"
+    )
+
+    for stats in model_registry_stats():
+        print(
+            f"\nMODEL {stats['model_path']}: LOADED IN {stats['load_seconds']:.2f}s, "
+            f"{stats['resident_memory_bytes'] / 2**20:.1f} MiB RESIDENT"
+        )
+
+    for stats in prompt_cache_stats():
+        print(
+            f"\nPROMPT CACHE OF {stats['model_path']}: {stats['hits']}/{stats['lookups']} HITS, "
+            f"{stats['saved_tokens']}/{stats['prompt_tokens']} PROMPT TOKENS SAVED, "
+            f"{stats['snapshots']} SNAPSHOTS ({stats['bytes'] / 2**20:.1f} MiB)"
+        )
+
+    print("\n####################### QUERIES ANSWERED ########################\n")
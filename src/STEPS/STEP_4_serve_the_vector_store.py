@@ -0,0 +1,102 @@
+"""
+    This code runs STEP 4 as a long-running query service.
+
+    The embeddings model, the FAISS vectorstore and the LLM are loaded once when the service starts,
+    instead of once per question as in STEP_4_use_the_vector_store.py.
+
+    The service then answers queries over HTTP (or a Unix socket) with the QueryService class,
+    which embeds and searches the queries arriving at the same time in a single batch,
+    and limits how many answers are generated at once.
+
+    The embeddings of the last QUERY_EMBEDDING_CACHE_MAX_ENTRIES queries are kept in memory, and with an ANSWER_CACHE_DIRECTORY
+    the answers are kept on disk, so repeated questions are answered without the model (see HELPERS/step_4_query_cache.py).
+
+    Example:
+        curl -X POST http://127.0.0.1:8000/query -d '{"query": "What is this document about?"}'
+"""
+
+
+import os
+import sys
+import asyncio
+from dotenv import load_dotenv
+
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.model_registry import get_embeddings_model, get_llm_model
+from HELPERS.step_4_query_cache import AnswerCache, QueryEmbeddingCache
+from HELPERS.step_4_query_service import QueryService, serve_query_service
+from HELPERS.step_4_sharded_search import ShardedVectorstore, load_search_vectorstore
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
+
+    print("\n##################### LOADING THE QUERY SERVICE #####################\n")
+
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+
+    saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
+    saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
+    vectorstore_path = os.path.join(
+        saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"
+    )
+
+    # Load everything once: the embeddings model and the LLM share one copy of the GGML model
+    # (a repeated query is not embedded again)
+    embeddings = QueryEmbeddingCache(
+        get_embeddings_model(path_to_ggml_model),
+        max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", "1024")),
+    )
+
+    # The shards of a sharded vectorstore are loaded and searched by worker processes
+    vectorstore, reranker, rerank_candidates = load_search_vectorstore(vectorstore_path, embeddings)
+
+    # The answers of a vectorstore rebuilt since the last run are dropped when the cache is opened
+    answer_cache_directory = os.getenv("ANSWER_CACHE_DIRECTORY")
+    answer_cache = (
+        AnswerCache(
+            answer_cache_directory,
+            model_path=path_to_ggml_model,
+            path_to_vectorstore=vectorstore_path,
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "100000")),
+        )
+        if answer_cache_directory
+        else None
+    )
+
+    service = QueryService(
+        embeddings=embeddings,
+        vectorstore=vectorstore,
+        llm=get_llm_model(path_to_ggml_model),
+        k=4,
+        max_batch_size=int(os.getenv("QUERY_SERVICE_MAX_BATCH_SIZE", "16")),
+        max_wait_ms=float(os.getenv("QUERY_SERVICE_MAX_WAIT_MS", "5")),
+        max_concurrent_generations=int(
+            os.getenv("QUERY_SERVICE_MAX_CONCURRENT_GENERATIONS", "1")
+        ),
+        # A quantized index is searched in two phases, with the exact vectors saved next to it
+        reranker=reranker,
+        rerank_candidates=rerank_candidates,
+        answer_cache=answer_cache,
+    )
+
+    try:
+        asyncio.run(
+            serve_query_service(
+                service,
+                host=os.getenv("QUERY_SERVICE_HOST", "127.0.0.1"),
+                port=int(os.getenv("QUERY_SERVICE_PORT", "8000")),
+                unix_socket=os.getenv("QUERY_SERVICE_UNIX_SOCKET") or None,
+            )
+        )
+    except KeyboardInterrupt:
+        print("\n####################### QUERY SERVICE STOPPED #######################\n")
+    finally:
+        if isinstance(vectorstore, ShardedVectorstore):
+            vectorstore.close()
+        if answer_cache is not None:
+            answer_cache.close()
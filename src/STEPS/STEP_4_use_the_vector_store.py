@@ -1,23 +1,58 @@
 """
     using_vectorstore_similarity_search: This function takes in a path to a pre-trained language model, a path to a vector store, and a query string. It first embeds the query text using the pre-trained language model, then loads the vector store using the FAISS library. Finally, it uses the vector store to find the k most similar documents to the query, where k is set to 4 in this implementation. The function returns a list of Document objects, where each Document represents one of the most similar documents to the query.
 
+    Both functions get the model from the model registry (HELPERS.model_registry), so the GGML file is loaded once
+    and shared by the embeddings model and the LLM.
+
+    packing_context: This function takes in a path to a pre-trained language model, the list of Document objects found for a query, and the query string itself. It merges the consecutive (overlapping) chunks of the same document into spans of the document and keeps as many spans as fit in the context window of the model, leaving room for the answer (see HELPERS.step_4_context_packing). It returns the spans and the prompt tokens they saved. With QA_CONTEXT_PACKING="true" (the default), the script answers from the spans instead of the chunks.
+
     Q_and_A_implementation: This function takes in a path to a pre-trained language model, a list of Document objects representing the most similar documents to a query, and the query string itself. It loads a pre-trained question-answering model using the load_qa_chain function from the langchain.chains.question_answering module, and applies this model to the list of Document objects and the query string to generate an answer. The function returns the answer as a string.
 
-    The code then loads environment variables from a .env file, sets up the paths to the pre-trained language model and the vector store, and defines the query string. It calls using_vectorstore_similarity_search to find the most similar documents to the query, and then calls Q_and_A_implementation to generate an answer to the query using the pre-trained question-answering model. Finally, it prints the answer to the console.
+    Q_and_A_streaming: This function takes the same arguments as Q_and_A_implementation, but returns an AnswerStream (HELPERS.step_4_streaming_answers) instead of the answer: iterating it yields the tokens of the answer as the model generates them, and its stats method reports the time to first token and the tokens per second. With QA_STREAMING="true" (the default), the script prints the answer as it is streamed.
+
+    With an ANSWER_CACHE_DIRECTORY, the answer to a query already answered from the same chunks, with the same model and vectorstore, is read from the AnswerCache (HELPERS.step_4_query_cache) instead of being generated again.
+
+    The code then loads environment variables from a .env file, sets up the paths to the pre-trained language model and the vector store, and reads the query string (QUERY, "What is this document about?" by default). It calls using_vectorstore_similarity_search to find the most similar documents to the query, and then calls Q_and_A_implementation to generate an answer to the query using the pre-trained question-answering model. Finally, it prints the answer to the console.
 
 """
 
 
 import os
-from typing import List
+import sys
+from functools import partial
+from typing import Dict, List, Tuple
 from dotenv import load_dotenv
 
-from langchain.embeddings import LlamaCppEmbeddings
-from langchain import FAISS, LlamaCpp
 from langchain.schema import Document
 from langchain.chains.question_answering import load_qa_chain
 
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from HELPERS.instrumentation import instrumented
+from HELPERS.model_registry import (
+    count_tokens,
+    get_embeddings_model,
+    get_llm_model,
+    last_prompt_cache_request,
+    model_registry_stats,
+    prompt_cache_stats,
+)
+from HELPERS.step_4_batch_search import batch_similarity_search
+from HELPERS.step_4_context_packing import context_window, pack_context
+from HELPERS.step_4_query_cache import AnswerCache
+from HELPERS.step_4_sharded_search import ShardedVectorstore, load_search_vectorstore
+from HELPERS.step_4_streaming_answers import AnswerStream, qa_prompt
+
 
+def _prompt_tokens(model_path: str, answer_docs: List[Document], query: str) -> int:
+    # The prompt of the "stuff" chain: the documents, one after the other, and the question
+    return count_tokens(model_path, qa_prompt(answer_docs, query))
+
+
+@instrumented(
+    "using_vectorstore_similarity_search",
+    lambda answer_docs, _: {"queries": 1, "documents": len(answer_docs)},
+)
 def using_vectorstore_similarity_search(
     model_path: str, path_to_vectorstore: str, query: str
 ) -> List[Document]:
@@ -33,18 +68,80 @@ def using_vectorstore_similarity_search(
     Returns:
         List[Document]: A list of the most similar documents to the query.
     """
-    # Embed the query text
-    llama = LlamaCppEmbeddings(model_path=model_path)
+    # Embed the query text, with the model shared with Q_and_A_implementation
+    llama = get_embeddings_model(model_path)
 
-    # Load the FAISS vectorstore
-    faiss = FAISS.load_local(path_to_vectorstore, llama)
+    # Load the FAISS vectorstore (or its shards), with the search-time parameters it was saved with
+    # (with a disk docstore, only the text of the k chunks found is read)
+    faiss, reranker, rerank_candidates = load_search_vectorstore(path_to_vectorstore, llama)
 
     # Find the most similar documents to the query
-    answer_docs = faiss.similarity_search(query, k=4)
+    try:
+        if reranker is None:
+            answer_docs = faiss.similarity_search(query, k=4)
+        else:
+            # A quantized index: its candidates are re-ranked with the exact vectors saved next to it
+            answer_docs = batch_similarity_search(
+                faiss,
+                [llama.embed_query(query)],
+                k=4,
+                reranker=reranker,
+                rerank_candidates=rerank_candidates,
+            )[0]
+    finally:
+        if isinstance(faiss, ShardedVectorstore):
+            faiss.close()
 
     return answer_docs
 
 
+@instrumented(
+    "packing_context",
+    lambda result, _: {
+        "chunks": result[1]["chunks"],
+        "spans": result[1]["packed_spans"],
+        "saved_prompt_tokens": result[1]["saved_prompt_tokens"],
+    },
+)
+def packing_context(
+    model_path: str, answer_docs: List[Document], query: str
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    This function takes in the documents found for a query, merges the overlapping chunks of the same document,
+    and keeps as many of them as fit in the context window of the LLM.
+
+    Args:
+        model_path (str): Path to the LlamaCpp model.
+        answer_docs (List[Document]): The most similar documents to the query, most similar first.
+        query (str): The query to answer.
+
+    Returns:
+        Tuple[List[Document], Dict[str, int]]: The documents to answer from, and the prompt tokens they saved.
+    """
+    # The token budget is the context window of the LLM, less the room left for the answer
+    n_ctx, max_answer_tokens = context_window(get_llm_model(model_path))
+
+    return pack_context(
+        answer_docs,
+        query,
+        count_tokens=partial(count_tokens, model_path),
+        n_ctx=n_ctx,
+        max_answer_tokens=max_answer_tokens,
+    )
+
+
+@instrumented(
+    "Q_and_A_implementation",
+    lambda answer, arguments: {
+        "queries": 1,
+        "prompt_tokens": _prompt_tokens(
+            arguments["model_path"], arguments["answer_docs"], arguments["query"]
+        ),
+        "completion_tokens": count_tokens(arguments["model_path"], answer),
+        # The prompt tokens restored from the prompt prefix cache instead of being evaluated
+        "prompt_cached_tokens": (last_prompt_cache_request() or {}).get("saved_tokens", 0),
+    },
+)
 def Q_and_A_implementation(
     model_path: str, answer_docs: List[Document], query: str
 ) -> str:
@@ -61,7 +158,8 @@ def Q_and_A_implementation(
         str: The answer to the query.
     """
     # Load the question answering chain
-    chain = load_qa_chain(LlamaCpp(model_path=model_path), chain_type="stuff")
+    # The LLM shares the GGML model already loaded to embed the query
+    chain = load_qa_chain(get_llm_model(model_path), chain_type="stuff")
 
     # Use the chain to find the answer to the query
     Q_and_A_answer = chain.run(input_documents=answer_docs, question=query)
@@ -69,29 +167,116 @@ def Q_and_A_implementation(
     return Q_and_A_answer
 
 
+def Q_and_A_streaming(
+    model_path: str, answer_docs: List[Document], query: str
+) -> AnswerStream:
+    """
+    This function takes in a list of documents and a query, and streams the answer of the LLM
+    to the prompt of the question answering chain, token by token.
+
+    Args:
+        model_path (str): Path to the LlamaCpp model.
+        answer_docs (List[Document]): A list of documents to search for the answer.
+        query (str): The query to search for.
+
+    Returns:
+        AnswerStream: The answer, whose tokens are generated as it is iterated.
+    """
+    # The LLM shares the GGML model already loaded to embed the query
+    return AnswerStream(get_llm_model(model_path), answer_docs, query)
+
+
 """################# CALLING THE FUNCTION #################"""
 
-load_dotenv()  # Load environment variables from .env file
+if __name__ == "__main__":
+    load_dotenv()  # Load environment variables from .env file
 
-path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
+    path_to_ggml_model: str = os.getenv("PATH_TO_GGML_MODEL")
 
-saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
-saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
-vectorstore_path = os.path.join(
-    saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"
-)
+    saving_vectorstore_file_name: str = os.getenv("SAVING_VECTORSTORE_FILE_NAME")
+    saving_vectorstore_directory: str = os.getenv("SAVING_VECTORSTORE_DIRECTORY")
+    vectorstore_path = os.path.join(
+        saving_vectorstore_directory, saving_vectorstore_file_name + ".faiss"
+    )
 
-query = "What is this document about?"
+    query: str = os.getenv("QUERY") or "What is this document about?"
 
-answer_docs = using_vectorstore_similarity_search(
-    model_path=path_to_ggml_model, path_to_vectorstore=vectorstore_path, query=query
-)
+    answer_docs = using_vectorstore_similarity_search(
+        model_path=path_to_ggml_model, path_to_vectorstore=vectorstore_path, query=query
+    )
 
+    if os.getenv("QA_CONTEXT_PACKING", "true").lower() == "true":
+        # Answer from the merged spans of the chunks found, within the context window of the model
+        answer_docs, packing_stats = packing_context(
+            model_path=path_to_ggml_model, answer_docs=answer_docs, query=query
+        )
+        print(
+            f"\nPACKED {packing_stats['chunks']} CHUNKS INTO {packing_stats['packed_spans']} SPANS: "
+            f"{packing_stats['prompt_tokens']} PROMPT TOKENS INSTEAD OF {packing_stats['unpacked_prompt_tokens']} "
+            f"({packing_stats['saved_prompt_tokens']} SAVED)"
+        )
 
-Q_and_A_answer = Q_and_A_implementation(
-    model_path=path_to_ggml_model, answer_docs=answer_docs, query=query
-)
+    # The answers of a vectorstore rebuilt since the last run are dropped when the cache is opened
+    answer_cache_directory = os.getenv("ANSWER_CACHE_DIRECTORY")
+    answer_cache = (
+        AnswerCache(
+            answer_cache_directory,
+            model_path=path_to_ggml_model,
+            path_to_vectorstore=vectorstore_path,
+            max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "100000")),
+        )
+        if answer_cache_directory
+        else None
+    )
+    cached_answer = answer_cache.get(query, answer_docs) if answer_cache is not None else None
+
+    if cached_answer is not None:
+        print("\n\n############################# ANSWER #########################\n\n")
+        print(cached_answer)
+        print("\n(FROM THE ANSWER CACHE)")
+    elif os.getenv("QA_STREAMING", "true").lower() == "true":
+        print("\n\n############################# ANSWER #########################\n\n")
+
+        # Print every token as soon as it is generated
+        answer_stream = Q_and_A_streaming(
+            model_path=path_to_ggml_model, answer_docs=answer_docs, query=query
+        )
+        for token in answer_stream:
+            print(token, end="", flush=True)
+        print()
+
+        answer_stats = answer_stream.stats()
+        print(
+            f"\nTIME TO FIRST TOKEN: {answer_stats['time_to_first_token_ms'] or 0:.0f}ms, "
+            f"{answer_stats['tokens']} TOKENS AT {answer_stats['tokens_per_second']:.1f} TOKENS/s"
+        )
+
+        if answer_cache is not None and answer_stream.completed:
+            answer_cache.put(query, answer_docs, answer_stream.text)
+    else:
+        Q_and_A_answer = Q_and_A_implementation(
+            model_path=path_to_ggml_model, answer_docs=answer_docs, query=query
+        )
+
+
+        print("\n\n############################# ANSWER #########################\n\n")
+        print(Q_and_A_answer)
+
+        if answer_cache is not None:
+            answer_cache.put(query, answer_docs, Q_and_A_answer)
+
+    if answer_cache is not None:
+        answer_cache.close()
 
+    for stats in model_registry_stats():
+        print(
+            f"\nMODEL {stats['model_path']}: LOADED IN {stats['load_seconds']:.2f}s, "
+            f"{stats['resident_memory_bytes'] / 2**20:.1f} MiB RESIDENT"
+        )
 
-print("\n\n############################# ANSWER #########################\n\n")
-print(Q_and_A_answer)
+    for stats in prompt_cache_stats():
+        print(
+            f"\nPROMPT CACHE OF {stats['model_path']}: {stats['hits']}/{stats['lookups']} HITS, "
+            f"{stats['saved_tokens']}/{stats['prompt_tokens']} PROMPT TOKENS SAVED, "
+            f"{stats['snapshots']} SNAPSHOTS ({stats['bytes'] / 2**20:.1f} MiB)"
+        )
@@ -0,0 +1,225 @@
+"""
+    This code is the command line interface of the pipeline: a single entry point for every step.
+
+    The commands:
+        ingest loads and chunks the documents (STEP 1), or runs STEPS 1 to 3 in a single pass with --streaming,
+        or imports the JSON chunks of an earlier STEP 1 into a chunk store with --convert-json,
+        embed creates and saves the embeddings of the chunks (STEP 2),
+        index creates and saves the vectorstore (STEP 3),
+        query answers a question (STEP 4), or a JSONL file of questions with --batch,
+        serve runs STEP 4 as a long-running query service, and
+        startup measures how long the CLI and every command take to start, and which packages their imports spend it in.
+
+    Every command runs the step script of the STEPS directory, with the settings of the .env file
+    (and of --env-file); the options of a command override the matching environment variables.
+
+    Only the standard library is imported here: langchain, FAISS and the models are imported by the step script
+    of the command that runs, so "python cli.py --help" (or a command's --help) starts in a fraction of a second.
+
+    Example:
+        python src/cli.py query "What is this document about?"
+"""
+
+import os
+import sys
+import runpy
+import argparse
+
+from typing import Dict, List, Optional
+
+
+SRC_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# The step script behind every command (the first one is the default of the command)
+STEP_SCRIPTS: Dict[str, str] = {
+    "ingest": os.path.join("STEPS", "STEP_1_loading_documents.py"),
+    "embed": os.path.join("STEPS", "STEP_2_create_embeddings.py"),
+    "index": os.path.join("STEPS", "STEP_3_create_vector_store.py"),
+    "query": os.path.join("STEPS", "STEP_4_use_the_vector_store.py"),
+    "serve": os.path.join("STEPS", "STEP_4_serve_the_vector_store.py"),
+}
+STREAMING_INGEST_SCRIPT = os.path.join("STEPS", "STEP_1_2_3_streaming_ingest.py")
+CONVERT_JSON_CHUNKS_SCRIPT = os.path.join("STEPS", "STEP_1_convert_json_chunks.py")
+BATCH_QUERIES_SCRIPT = os.path.join("STEPS", "STEP_4_batch_queries.py")
+
+
+def run_step(script: str, environment: Optional[Dict[str, Optional[str]]] = None) -> None:
+    """
+    Runs a step script as if it was run with "python <script>".
+
+    Args:
+        - script (str): Path to the step script, relative to the src directory.
+        - environment (Optional[Dict[str, Optional[str]]]): Environment variables set before the step runs. None values are left unset.
+
+    Returns:
+        - None
+    """
+
+    for name, value in (environment or {}).items():
+        if value is not None:
+            os.environ[name] = str(value)
+
+    path = os.path.join(SRC_DIRECTORY, script)
+    sys.argv = [path]
+    runpy.run_path(path, run_name="__main__")
+
+
+def _ingest(arguments: argparse.Namespace) -> None:
+    if arguments.streaming:
+        run_step(STREAMING_INGEST_SCRIPT)
+    elif arguments.convert_json:
+        run_step(CONVERT_JSON_CHUNKS_SCRIPT)
+    else:
+        run_step(STEP_SCRIPTS["ingest"])
+
+
+def _embed(arguments: argparse.Namespace) -> None:
+    run_step(STEP_SCRIPTS["embed"])
+
+
+def _index(arguments: argparse.Namespace) -> None:
+    run_step(STEP_SCRIPTS["index"])
+
+
+def _query(arguments: argparse.Namespace) -> None:
+    if arguments.batch:
+        run_step(
+            BATCH_QUERIES_SCRIPT,
+            {
+                "QUERY_BATCH_INPUT_FILE": arguments.batch,
+                "QUERY_BATCH_OUTPUT_FILE": arguments.output,
+            },
+        )
+    else:
+        run_step(STEP_SCRIPTS["query"], {"QUERY": arguments.question})
+
+
+def _serve(arguments: argparse.Namespace) -> None:
+    run_step(
+        STEP_SCRIPTS["serve"],
+        {
+            "QUERY_SERVICE_HOST": arguments.host,
+            "QUERY_SERVICE_PORT": arguments.port,
+            "QUERY_SERVICE_UNIX_SOCKET": arguments.unix_socket,
+        },
+    )
+
+
+def _startup(arguments: argparse.Namespace) -> None:
+    import json
+
+    from HELPERS.startup_times import startup_report
+
+    print("\n####################### MEASURING THE STARTUP TIMES ########################\n")
+
+    report = startup_report(SRC_DIRECTORY, STEP_SCRIPTS, top=arguments.top)
+
+    for command, measurements in report.items():
+        print(f"{command:<12} {measurements['seconds']:>8.3f}s", end="")
+        if "import_seconds" in measurements:
+            print(
+                f"  ({measurements['import_seconds']:.3f}s importing {measurements['modules']} modules)"
+            )
+            for package in measurements["packages"]:
+                print(
+                    f"{'':<13}{package['seconds']:>8.3f}s  {package['package']} ({package['modules']} modules)"
+                )
+        else:
+            print()
+
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"\nSAVED IN {arguments.output}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the parser of the command line.
+
+    Returns:
+        - argparse.ArgumentParser: The parser, with a subparser per command. Every subparser sets the "handler" of its command.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="cli.py", description="Embed documents with LLaMA and LangChain, and query them."
+    )
+    parser.add_argument(
+        "--env-file", help="A .env file to read the settings from, before the .env file found by the steps."
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    ingest = commands.add_parser("ingest", help="STEP 1: load and chunk the documents.")
+    ingest_mode = ingest.add_mutually_exclusive_group()
+    ingest_mode.add_argument(
+        "--streaming", action="store_true", help="Run STEPS 1 to 3 in a single streaming pass."
+    )
+    ingest_mode.add_argument(
+        "--convert-json",
+        action="store_true",
+        help="Import the JSON chunks of an earlier STEP 1 into a chunk store.",
+    )
+    ingest.set_defaults(handler=_ingest)
+
+    embed = commands.add_parser("embed", help="STEP 2: create and save the embeddings of the chunks.")
+    embed.set_defaults(handler=_embed)
+
+    index = commands.add_parser("index", help="STEP 3: create and save the vectorstore.")
+    index.set_defaults(handler=_index)
+
+    query = commands.add_parser("query", help="STEP 4: answer a question, or a file of questions.")
+    query.add_argument("question", nargs="?", help="The question (QUERY).")
+    query.add_argument(
+        "--batch", metavar="INPUT_FILE", help="Answer the questions of a JSONL file (QUERY_BATCH_INPUT_FILE)."
+    )
+    query.add_argument(
+        "--output", metavar="OUTPUT_FILE", help="Where --batch writes the answers (QUERY_BATCH_OUTPUT_FILE)."
+    )
+    query.set_defaults(handler=_query)
+
+    serve = commands.add_parser("serve", help="STEP 4 as a long-running query service.")
+    serve.add_argument("--host", help="Host to listen on (QUERY_SERVICE_HOST).")
+    serve.add_argument("--port", type=int, help="Port to listen on (QUERY_SERVICE_PORT).")
+    serve.add_argument("--unix-socket", help="Unix socket to listen on instead (QUERY_SERVICE_UNIX_SOCKET).")
+    serve.set_defaults(handler=_serve)
+
+    startup = commands.add_parser(
+        "startup", help="Measure the startup time of the CLI and the import time of every command."
+    )
+    startup.add_argument("--top", type=int, default=10, help="Number of packages reported per command.")
+    startup.add_argument("--output", help="A JSON file to save the measurements in.")
+    startup.set_defaults(handler=_startup)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Runs the command of a command line.
+
+    Args:
+        - argv (Optional[List[str]]): The arguments of the command line. If None, sys.argv[1:].
+
+    Returns:
+        - None
+    """
+
+    arguments = build_parser().parse_args(argv)
+
+    if arguments.env_file:
+        from dotenv import load_dotenv
+
+        load_dotenv(arguments.env_file)
+
+    # The helpers are imported from the src directory, like the step scripts do
+    if SRC_DIRECTORY not in sys.path:
+        sys.path.append(SRC_DIRECTORY)
+
+    arguments.handler(arguments)
+
+
+"""################# CALLING THE FUNCTION #################"""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+    Tests of the query service of STEP 4 (HELPERS/step_4_query_service.py), with the stand-in embeddings model and LLM,
+    so they run without a model file.
+
+    Run them from the root of the repository with:
+        python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+# Add src directory to Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from HELPERS.stand_in_models import HashEmbeddings, StandInLLM
+from HELPERS.step_3_build_vectorstore import build_vectorstore
+from HELPERS.step_4_query_cache import AnswerCache
+from HELPERS.step_4_query_service import QueryService, serve_query_service
+
+
+TOPICS = ["faiss", "llama", "langchain", "embeddings", "chunks", "vectors", "queries", "answers"]
+QUERIES = [f"what do the documents say about {topic}" for topic in TOPICS]
+
+
+def _build_service(**kwargs) -> QueryService:
+    embeddings = HashEmbeddings(dimension=32)
+    texts = [
+        f"document {document} explains {topic} and how {TOPICS[(i + 1) % len(TOPICS)]} relate to it"
+        for document in range(5)
+        for i, topic in enumerate(TOPICS)
+    ]
+    references = [(f"doc{i // len(TOPICS)}", f"chunk_{i % len(TOPICS)}") for i in range(len(texts))]
+    vectorstore = build_vectorstore(
+        texts=texts,
+        embeddings=np.array(embeddings.embed_documents(texts), dtype=np.float32),
+        references=references,
+        embedding=embeddings,
+    )
+
+    return QueryService(embeddings, vectorstore, llm=StandInLLM(), **kwargs)
+
+
+async def _request(
+    unix_socket: str, method: str, path: str, payload: Optional[Dict[str, object]] = None
+) -> Tuple[int, str, bytes]:
+    reader, writer = await asyncio.open_unix_connection(unix_socket)
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(
+        (
+            f"{method} {path} HTTP/1.1\r\n"
+            "Host: localhost\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        ).encode("latin-1")
+        + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ")[1])
+    if b"transfer-encoding: chunked" not in head.lower():
+        return status, head.decode("latin-1"), body
+
+    # Chunked transfer encoding: "<size in hex>\r\n<data>\r\n", until a chunk of size 0
+    data = b""
+    while True:
+        size_line, _, body = body.partition(b"\r\n")
+        size = int(size_line, 16)
+        if size == 0:
+            return status, head.decode("latin-1"), data
+        data += body[:size]
+        body = body[size + 2 :]
+
+
+class QueryServiceSearchTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.service = _build_service(k=4, max_batch_size=16, max_wait_ms=50)
+        await self.service.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.service.close()
+
+    async def test_concurrent_searches_are_micro_batched(self) -> None:
+        results = await asyncio.gather(*(self.service.search(query) for query in QUERIES))
+
+        self.assertEqual(self.service.searched_queries, len(QUERIES))
+        self.assertLess(self.service.searched_batches, self.service.searched_queries)
+
+        # Batching does not change what every query finds
+        for query, documents in zip(QUERIES, results):
+            expected = self.service.vectorstore.similarity_search(query, k=4)
+            self.assertEqual(
+                [document.page_content for document in documents],
+                [document.page_content for document in expected],
+            )
+
+    async def test_answer_uses_the_documents_found(self) -> None:
+        answer, documents = await self.service.answer(QUERIES[0])
+
+        self.assertEqual(len(documents), 4)
+        self.assertEqual(
+            answer, self.service.chain.run(input_documents=documents, question=QUERIES[0])
+        )
+
+
+class QueryServiceRoutesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.unix_socket = os.path.join(self.directory.name, "query_service.sock")
+        self.service = _build_service(k=4, max_wait_ms=5)
+        self.server = asyncio.create_task(
+            serve_query_service(self.service, unix_socket=self.unix_socket)
+        )
+        while not os.path.exists(self.unix_socket):
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self) -> None:
+        self.server.cancel()
+        try:
+            await self.server
+        except asyncio.CancelledError:
+            pass
+        self.directory.cleanup()
+
+    async def test_query(self) -> None:
+        status, _, body = await _request(self.unix_socket, "POST", "/query", {"query": QUERIES[1]})
+        response = json.loads(body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(response["documents"]), 4)
+        # The answer of the question-answering chain to the documents returned with it
+        documents = [Document(**document) for document in response["documents"]]
+        self.assertEqual(
+            response["answer"],
+            self.service.chain.run(input_documents=documents, question=QUERIES[1]),
+        )
+
+        _, _, search_body = await _request(self.unix_socket, "POST", "/search", {"query": QUERIES[1]})
+        self.assertEqual(json.loads(search_body)["documents"], response["documents"])
+
+    async def test_query_stream(self) -> None:
+        _, _, body = await _request(self.unix_socket, "POST", "/query", {"query": QUERIES[2]})
+        expected = json.loads(body)
+
+        status, head, body = await _request(
+            self.unix_socket, "POST", "/query/stream", {"query": QUERIES[2]}
+        )
+        lines = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+
+        self.assertEqual(status, 200)
+        self.assertIn("application/x-ndjson", head)
+        # First the documents, then the tokens, then the stats
+        self.assertEqual(lines[0]["documents"], expected["documents"])
+        self.assertEqual("".join(line["token"] for line in lines[1:-1]), expected["answer"])
+        self.assertEqual(lines[-1]["stats"]["cached"], False)
+        self.assertEqual(lines[-1]["stats"]["tokens"], len(lines) - 2)
+
+    async def test_failed_search_is_answered_with_an_error(self) -> None:
+        async def failing_search(query: str):
+            raise RuntimeError("the vectorstore is gone")
+
+        self.service.search = failing_search
+
+        for path in ("/query", "/query/stream"):
+            status, head, body = await _request(self.unix_socket, "POST", path, {"query": QUERIES[3]})
+
+            self.assertEqual(status, 500)
+            self.assertIn("application/json", head)
+            self.assertEqual(json.loads(body), {"error": "the vectorstore is gone"})
+
+    async def test_answer_cache_runs_off_the_event_loop(self) -> None:
+        self.service.answer_cache = AnswerCache(
+            self.directory.name, "stand-in:32", os.path.join(self.directory.name, "vectorstore.faiss")
+        )
+        cache_threads = []
+        for method in ("get", "put"):
+            cache_method = getattr(self.service.answer_cache, method)
+
+            def recorded(*args, cache_method=cache_method, method=method):
+                cache_threads.append((method, threading.current_thread()))
+                return cache_method(*args)
+
+            setattr(self.service.answer_cache, method, recorded)
+
+        # Each answer is generated and cached, then answered from the cache
+        for path, query in (("/query", QUERIES[4]), ("/query/stream", QUERIES[5])):
+            await _request(self.unix_socket, "POST", path, {"query": query})
+            _, _, body = await _request(self.unix_socket, "POST", "/query/stream", {"query": query})
+            self.assertEqual(json.loads(body.decode("utf-8").splitlines()[-1])["stats"]["cached"], True)
+
+        self.assertEqual([method for method, _ in cache_threads], ["get", "put", "get"] * 2)
+        for _, thread in cache_threads:
+            self.assertIsNot(thread, threading.main_thread())
+        self.service.answer_cache.close()
+
+    async def test_bad_request(self) -> None:
+        status, _, body = await _request(self.unix_socket, "POST", "/query/stream", {"question": "?"})
+
+        self.assertEqual(status, 400)
+        self.assertIn("error", json.loads(body))
+
+
+if __name__ == "__main__":
+    unittest.main()
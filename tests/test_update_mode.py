@@ -0,0 +1,95 @@
+"""
+    Tests of the update mode of STEP 3 (VECTORSTORE_UPDATE_MODE="update"): STEP 1, STEP 2 and STEP 3 are run
+    on a synthetic corpus with the stand-in embeddings model, so they run without a model file.
+
+    Run them from the root of the repository with:
+        python -m unittest discover tests
+"""
+
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+
+from typing import Set
+
+import faiss
+
+# Add src directory to Python path
+SRC_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.append(SRC_DIRECTORY)
+from HELPERS.benchmark_corpus import generate_corpus
+from HELPERS.stand_in_models import HashEmbeddings
+from HELPERS.step_3_save_vectorstore import load_vectorstore, load_vectorstore_manifest
+
+
+STEPS = [
+    "STEP_1_loading_documents.py",
+    "STEP_2_create_embeddings.py",
+    "STEP_3_create_vector_store.py",
+]
+
+
+class UpdateModeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.docs_directory = os.path.join(self.directory.name, "documents")
+        self.vectorstore_path = os.path.join(self.directory.name, "vectorstore", "vectorstore.faiss")
+        self.environment = dict(
+            os.environ,
+            PATH_TO_GGML_MODEL="stand-in:32",
+            DIRECTORY_DOCUMENTS_TO_LOAD=self.docs_directory,
+            DIRECTORY_FOR_DOCUMENTS_JSON_CHUNKS=os.path.join(self.directory.name, "chunks"),
+            SAVING_EMBEDDINGS_DIRECTORY=os.path.join(self.directory.name, "embeddings"),
+            SAVING_EMBEDDINGS_FILE_NAME="embeddings",
+            SAVING_VECTORSTORE_DIRECTORY=os.path.join(self.directory.name, "vectorstore"),
+            SAVING_VECTORSTORE_FILE_NAME="vectorstore",
+            VECTORSTORE_UPDATE_MODE="update",
+        )
+        self.environment.pop("CHUNK_STORE_FORMAT", None)
+
+        generate_corpus(self.docs_directory, document_count=4, words_per_document=200)
+        self._run_steps()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def _run_steps(self) -> None:
+        for step in STEPS:
+            subprocess.run(
+                [sys.executable, os.path.join(SRC_DIRECTORY, "STEPS", step)],
+                cwd=self.directory.name,
+                env=self.environment,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+    def _index_ids(self) -> Set[int]:
+        vectorstore = load_vectorstore(self.vectorstore_path, HashEmbeddings(dimension=32))
+        return set(faiss.vector_to_array(vectorstore.index.id_map).tolist())
+
+    def test_deleted_document_is_removed_from_the_index(self) -> None:
+        chunk_ids = load_vectorstore_manifest(self.vectorstore_path)["document_00001"]["chunk_ids"]
+        self.assertTrue(set(chunk_ids) <= self._index_ids())
+
+        os.remove(os.path.join(self.docs_directory, "document_00001.pdf"))
+        self._run_steps()
+
+        self.assertNotIn("document_00001", load_vectorstore_manifest(self.vectorstore_path))
+        self.assertFalse(set(chunk_ids) & self._index_ids())
+
+    def test_document_failing_to_load_is_kept_in_the_index(self) -> None:
+        chunk_ids = load_vectorstore_manifest(self.vectorstore_path)["document_00002"]["chunk_ids"]
+
+        with open(os.path.join(self.docs_directory, "document_00002.pdf"), "w") as f:
+            f.write("not a PDF")
+        self._run_steps()
+
+        self.assertIn("document_00002", load_vectorstore_manifest(self.vectorstore_path))
+        self.assertTrue(set(chunk_ids) <= self._index_ids())
+
+
+if __name__ == "__main__":
+    unittest.main()